@@ -18,4 +18,12 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
-from anycall.rpc import RPCSystem, create_tcp_rpc_system
\ No newline at end of file
+import sys
+
+try:
+    from anycall.rpc import RPCSystem, create_tcp_rpc_system, create_shm_rpc_system
+except ImportError:
+    # The Twisted based implementation requires Python 2.
+    # On Python 3 only `anycall.aio` is available.
+    if sys.version_info[0] < 3:
+        raise
\ No newline at end of file
@@ -0,0 +1,933 @@
+# Copyright (c) 2014 Stefan C. Mueller
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+asyncio implementation of the packet, connection pool and RPC layers
+for Python 3.
+
+It speaks the same wire protocol as :mod:`anycall.rpc`: the same
+framing, handshake and pickled messages (protocol 2, with the message
+classes named as in :mod:`anycall.rpc`). Twisted and asyncio peers can
+call each other's functions. Strings sent by Python 2 peers are decoded
+as latin-1.
+
+Calls return :class:`asyncio.Future` objects that can be awaited
+directly. Registered functions may be coroutine functions, they run as
+tasks. Cancelling a call cancels the task on the remote peer, and a call
+cancelled by the callee raises :class:`asyncio.CancelledError` on the
+caller. Calls in progress fail with :class:`ConnectionError` when the
+last connection to the peer is lost, unless the stub was created as
+idempotent, in which case they are sent again as with Twisted.
+
+Unlike :class:`anycall.rpc.RPCSystem` there is no ping loop. A call
+only fails if the connection is lost, not if the peer stops responding
+while the connection stays open. Use :func:`asyncio.wait_for` to limit
+how long to wait.
+Remote objects, batches and relayed broadcasts are not supported.
+"""
+
+import asyncio
+import binascii
+import inspect
+import io
+import logging
+import pickle
+import socket
+import struct
+import traceback
+import uuid
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+#: Packet type names shared with :mod:`anycall.connectionpool` and :mod:`anycall.rpc`.
+HANDSHAKE = "PoolProtocol_handshake"
+MESSAGE_TYPE = "RPC"
+
+_PING = uuid.uuid5(uuid.NAMESPACE_URL, "ping")
+
+#: Seconds to wait before sending a replayed call again if it could not be sent.
+REPLAY_DELAY = 0.5
+
+#: Module under which the message classes are pickled.
+_WIRE_MODULE = "anycall.rpc"
+
+
+def create_tcp_rpc_system(hostname=None, port=0, loop=None, max_replays=3):
+    """
+    Creates a TCP based :class:`RPCSystem`.
+
+    :param hostname: Name under which peers reach us. Defaults to the FQDN.
+
+    :param port: Port to listen on. `0` for an arbitrary free port.
+
+    :param max_replays: See :class:`RPCSystem`.
+    """
+    return RPCSystem(ConnectionPool(hostname, port, loop=loop), max_replays)
+
+
+def typehash(typename):
+    """
+    Transforms a typename to a number. Same as :func:`anycall.packetprotocol.typehash`.
+    """
+    return binascii.crc32(typename.encode("ascii")) & 0xffffffff
+
+
+class PacketProtocol(asyncio.Protocol):
+    """
+    asyncio version of :class:`anycall.packetprotocol.PacketProtocol`.
+
+    Each packet is sent with a header containing its length and the
+    hash of its type name.
+    """
+
+    _header = struct.Struct(">II")
+
+    def __init__(self):
+        self.transport = None
+        self._buffer = bytearray()
+        self._type_register = {}
+
+    def register_type(self, typename):
+        """
+        Registers a type name so that it may be used to send and receive packages.
+
+        :raises ValueError: If there is a hash code collision.
+        """
+        typekey = typehash(typename)
+        if typekey in self._type_register:
+            raise ValueError("Type name collision. Type %s has the same hash." % repr(self._type_register[typekey]))
+        self._type_register[typekey] = typename
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        buf = self._buffer
+        buf.extend(data)
+        size = self._header.size
+        offset = 0
+        while len(buf) - offset >= size:
+            packet_length, typekey = self._header.unpack_from(buf, offset)
+            end = offset + size + packet_length
+            if len(buf) < end:
+                break
+            packet = bytes(buf[offset + size:end])
+            offset = end
+
+            typename = self._type_register.get(typekey, None)
+            if typename is None:
+                self.on_unregistered_type(typekey, packet)
+            else:
+                self.packet_received(typename, packet)
+        del buf[:offset]
+
+    def send_packet(self, typename, packet):
+        """
+        Send a packet.
+
+        :param typename: A previously registered typename.
+
+        :param packet: Bytes with the content of the packet.
+        """
+        typekey = typehash(typename)
+        if typename != self._type_register.get(typekey, None):
+            raise ValueError("Cannot send packet with unregistered type %s." % repr(typename))
+        self.transport.writelines((self._header.pack(len(packet), typekey), packet))
+
+    def packet_received(self, typename, packet):
+        raise ValueError("abstract")
+
+    def on_unregistered_type(self, typekey, packet):
+        """
+        Invoked if a packet with an unregistered type was received.
+
+        Default behaviour is to log and close the connection.
+        """
+        logger.error("Missing handler for typekey %s in %s. Closing connection." % (typekey, type(self).__name__))
+        self.transport.close()
+
+
+class ConnectionPool(object):
+    """
+    asyncio version of :class:`anycall.connectionpool.ConnectionPool` for TCP.
+
+    Opens one connection per peer on demand and keeps it open. Peers
+    are identified by `hostname:port`.
+    """
+
+    def __init__(self, hostname=None, port=0, interface=None, loop=None):
+        """
+        :param hostname: Name under which peers reach us. Defaults to the FQDN.
+
+        :param port: Port to listen on. `0` for an arbitrary free port.
+
+        :param interface: Interface to listen on. `None` for all IPv4 interfaces.
+        """
+        # `getfqdn()` may block on a DNS query. Do it only once.
+        self._own_fqdn = socket.getfqdn()
+        self.hostname = hostname or self._own_fqdn
+        self.port = port
+        self.interface = interface
+        self.loop = loop
+        self.ownid = None
+
+        self._server = None
+        self._typenames = set()
+
+        #: Maps `peer -> [protocol]` of the connections with completed handshake.
+        self._connections = {}
+
+        #: Maps `peer -> [(typename, data, future)]` waiting for a connection.
+        self._send_queues = {}
+
+        #: Invoked with `peer, typename, data` for each received packet.
+        self.packet_received = None
+
+        #: Optional callback invoked with the peer's id
+        #: when the last connection to that peer is closed.
+        self.connection_lost = None
+
+    def register_type(self, typename):
+        """
+        Registers a type name so that it may be used to send and receive packages.
+        """
+        PacketProtocol().register_type(typename)
+        self._typenames.add(typename)
+
+    def open(self, packet_received):
+        """
+        Opens the port.
+
+        :returns: Future that completes when we are ready to receive.
+        """
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        self.packet_received = packet_received
+
+        # Like Twisted we listen on IPv4 only. With `host=None` asyncio would
+        # also bind IPv6, on a different port if `port` is zero.
+        opened = self.loop.create_future()
+        task = asyncio.ensure_future(self.loop.create_server(lambda: PoolProtocol(self),
+                                                            self.interface or "0.0.0.0", self.port),
+                                     loop=self.loop)
+
+        def listening(task):
+            if task.exception() is not None:
+                opened.set_exception(task.exception())
+                return
+            self._server = task.result()
+            port = self._server.sockets[0].getsockname()[1]
+            self.ownid = "%s:%s" % (self.hostname, port)
+            logger.debug("Port opened. Own-ID:%s" % self.ownid)
+            opened.set_result(None)
+        task.add_done_callback(listening)
+        return opened
+
+    def close(self):
+        """
+        Stop listening for new connections and close all open connections.
+
+        :returns: Future that completes once the port is closed.
+        """
+        self._server.close()
+        for peer, queue in list(self._send_queues.items()):
+            self._fail_queue(peer, ConnectionError("Connection pool closed."))
+        for protocol in [c for conns in self._connections.values() for c in conns]:
+            protocol.transport.close()
+        return asyncio.ensure_future(self._server.wait_closed(), loop=self.loop)
+
+    def send(self, peer, typename, data):
+        """
+        Sends a packet to a peer, connecting to it first if necessary.
+
+        :returns: Future that completes once the packet is passed to the
+          transport, or fails if we cannot connect.
+        """
+        future = self.loop.create_future()
+        connections = self._connections.get(peer, None)
+        if connections:
+            connections[0].send_packet(typename, data)
+            future.set_result(None)
+            return future
+
+        queue = self._send_queues.get(peer, None)
+        if queue is None:
+            queue = self._send_queues[peer] = []
+            self._connect(peer)
+        queue.append((typename, data, future))
+        return future
+
+    def _connect(self, peer):
+        logger.debug("Opening connection to %s..." % peer)
+        host, port = peer.rsplit(":", 1)
+        if host == self._own_fqdn:
+            host = "localhost"
+        task = asyncio.ensure_future(self.loop.create_connection(lambda: PoolProtocol(self, peer),
+                                                                host, int(port)), loop=self.loop)
+
+        def connected(task):
+            if task.cancelled():
+                self._fail_queue(peer, ConnectionError("Connecting to %s was cancelled." % peer))
+            elif task.exception() is not None:
+                self._fail_queue(peer, task.exception())
+        task.add_done_callback(connected)
+
+    def _fail_queue(self, peer, exc):
+        for _, _, future in self._send_queues.pop(peer, ()):
+            if not future.done():
+                future.set_exception(exc)
+
+    def _connection_made(self, protocol):
+        peer = protocol.peer
+        logger.debug("Connection established with %s" % peer)
+        self._connections.setdefault(peer, []).append(protocol)
+        for typename, data, future in self._send_queues.pop(peer, ()):
+            if not future.done():
+                protocol.send_packet(typename, data)
+                future.set_result(None)
+
+    def _connection_lost(self, protocol):
+        peer = protocol.peer
+        logger.debug("Lost connection to %s" % peer)
+        connections = self._connections.get(peer, [])
+        if protocol in connections:
+            connections.remove(protocol)
+            if not connections:
+                del self._connections[peer]
+                if self.connection_lost is not None:
+                    self.connection_lost(peer)
+
+    def _handshake_failed(self, protocol, exc):
+        if protocol.peer is not None:
+            self._fail_queue(protocol.peer, exc or ConnectionError("Handshake with %s failed." % protocol.peer))
+
+
+class PoolProtocol(PacketProtocol):
+    """
+    Connection of a :class:`ConnectionPool`. Both sides start by sending
+    their id, see :class:`anycall.connectionpool.PoolProtocol`.
+    """
+
+    def __init__(self, pool, peer=None):
+        PacketProtocol.__init__(self)
+        self.pool = pool
+        self.peer = peer
+
+        #: Own id of the peer's process. Equal to `peer` unless the
+        #: peer accepted this connection on a shared port.
+        self.worker = None
+
+        self.handshake_completed = False
+        self.register_type(HANDSHAKE)
+        for typename in pool._typenames:
+            self.register_type(typename)
+
+    def connection_made(self, transport):
+        PacketProtocol.connection_made(self, transport)
+        self.send_packet(HANDSHAKE, self.pool.ownid.encode("latin-1"))
+
+    def connection_lost(self, exc):
+        if self.handshake_completed:
+            self.pool._connection_lost(self)
+        else:
+            self.pool._handshake_failed(self, exc)
+
+    def packet_received(self, typename, packet):
+        if typename == HANDSHAKE:
+            worker, _, shared_id = packet.decode("latin-1").partition("\0")
+            peer = shared_id or worker
+            if self.peer and self.peer not in (peer, worker):
+                logger.error("Peer says it is %s, but we expected %s. Closing connection." % (repr(peer), repr(self.peer)))
+                self.transport.close()
+                return
+            self.peer = self.peer or peer
+            self.worker = worker
+            self.handshake_completed = True
+            self.pool._connection_made(self)
+        elif not self.handshake_completed:
+            logger.error("Expected handshake, got %s. Closing connection." % repr(typename))
+            self.transport.close()
+        else:
+            self.pool.packet_received(self.peer, typename, packet)
+
+
+class RPCSystem(object):
+    """
+    asyncio version of :class:`anycall.rpc.RPCSystem`.
+    """
+
+    #: Default RPCSystem. Used while unpickling function stubs.
+    default = None
+
+    def __init__(self, connectionpool, max_replays=3):
+        """
+        :param max_replays: How often we try to send an idempotent call again
+           if the connection to the peer is lost while the call is in progress.
+        """
+        self._connectionpool = connectionpool
+        self._connectionpool.register_type(MESSAGE_TYPE)
+        self._connectionpool.connection_lost = self._connection_lost
+
+        #: Maps `functionid -> function`.
+        self._functions = {}
+
+        #: Maps `identity -> functionid`.
+        self._function_ids = {}
+
+        #: Calls we made. Maps `(peerid, callid) -> future`.
+        self._local_to_remote = {}
+
+        #: Calls made to us. Maps `(peerid, callid) -> future`.
+        self._remote_to_local = {}
+
+        #: Pickled idempotent calls in progress. Maps `(peerid, callid) -> data`.
+        self._replayable = {}
+        self._max_replays = max_replays
+
+        #: Maps `(peerid, callid) -> TimerHandle` of replays waiting to be sent again.
+        self._replay_timers = {}
+
+        self._functions[_PING] = self._ping
+        self._opened = False
+
+    @property
+    def ownid(self):
+        return self._connectionpool.ownid
+
+    @property
+    def loop(self):
+        return self._connectionpool.loop
+
+    def open(self):
+        """
+        Opens the port.
+
+        :returns: Future that completes when we are ready to make and receive calls.
+        """
+        future = self._connectionpool.open(self._packet_received)
+
+        def opened(_):
+            self._opened = True
+        future.add_done_callback(opened)
+        return future
+
+    def close(self):
+        """
+        Stop listening for new connections and close all open connections.
+        """
+        assert self._opened, "RPC System is not opened"
+        for timer in self._replay_timers.values():
+            timer.cancel()
+        self._replay_timers.clear()
+        self._replayable.clear()
+        return self._connectionpool.close()
+
+    def get_function_url(self, function, name=None):
+        """
+        Registers the given callable and returns the URL that can be used
+        to invoke it from remote.
+
+        The callable may return a future or be a coroutine function.
+
+        :param name: Register the function under a well-known name, see
+          :meth:`anycall.rpc.RPCSystem.get_function_url`.
+        """
+        assert self._opened, "RPC System is not opened"
+        if name is not None:
+            functionid = _named_function_id(name)
+        else:
+            functionid = self._function_ids.get(_identity(function), None) or uuid.uuid1()
+        self._functions[functionid] = function
+        self._function_ids[_identity(function)] = functionid
+        return "anycall://%s/functions/%s" % (self.ownid, functionid.hex)
+
+    def unregister_function(self, function_or_url):
+        """
+        Removes a function, given either the callable or its URL.
+
+        :returns: `True` if the function was registered.
+        """
+        if isinstance(function_or_url, str):
+            _, functionid = _parse_url(function_or_url, "functions", "function")
+        else:
+            functionid = self._function_ids.get(_identity(function_or_url), None)
+        function = self._functions.pop(functionid, None)
+        if function is None:
+            return False
+        self._function_ids.pop(_identity(function), None)
+        return True
+
+    def create_function_stub(self, url, idempotent=False):
+        """
+        Create a callable that will invoke the given remote function.
+
+        The stub returns an :class:`asyncio.Future`. Cancelling it cancels
+        the call on the remote peer.
+
+        :param idempotent: If the function can safely be invoked more than
+          once for the same call. If so, calls in progress are sent again when
+          the connection to the peer is lost.
+        """
+        assert self._opened, "RPC System is not opened"
+        peerid, functionid = _parse_url(url, "functions", "function")
+        return _RPCFunctionStub(peerid, functionid, self, idempotent)
+
+    def _invoke_function(self, peerid, functionid, args, kwargs, idempotent=False):
+        future = self.loop.create_future()
+
+        if peerid == self.ownid:
+            function = self._functions.get(functionid, None)
+            if function is None:
+                future.set_exception(ValueError("Call for unregistered function."))
+                return future
+            try:
+                result = self._start(function, args, kwargs)
+            except Exception as e:
+                future.set_exception(e)
+                return future
+            if asyncio.isfuture(result):
+                return result
+            future.set_result(result)
+            return future
+
+        callid = uuid.uuid1()
+        key = (peerid, callid)
+        try:
+            data = _dumps(_Call(callid, functionid, args, kwargs))
+        except Exception as e:
+            logger.exception("Pickling of the call has failed.")
+            future.set_exception(e)
+            return future
+
+        self._local_to_remote[key] = future
+        if idempotent:
+            self._replayable[key] = data
+
+        def completed(future):
+            self._forget_replay(key)
+            # Still registered means that the caller cancelled the call.
+            if self._local_to_remote.pop(key, None) is not None and future.cancelled():
+                self._reply(peerid, _CallCancel(callid))
+        future.add_done_callback(completed)
+
+        sent = self._connectionpool.send(peerid, MESSAGE_TYPE, data)
+
+        def send_completed(sent):
+            if future.done():
+                return
+            if sent.cancelled():
+                self._local_to_remote.pop(key, None)
+                future.cancel()
+            elif sent.exception() is not None:
+                future.set_exception(sent.exception())
+        sent.add_done_callback(send_completed)
+        return future
+
+    def _send(self, peerid, obj):
+        return self._connectionpool.send(peerid, MESSAGE_TYPE, _dumps(obj))
+
+    def _packet_received(self, peerid, typename, data):
+        try:
+            if typename != MESSAGE_TYPE:
+                raise ValueError("Received unexpected packet type:%s" % typename)
+            obj = _loads(data)
+            logger.debug("Received %r from %s" % (obj, peerid))
+
+            if isinstance(obj, _Call):
+                self._Call_received(peerid, obj)
+            elif isinstance(obj, _CallReturn):
+                self._CallReturn_received(peerid, obj)
+            elif isinstance(obj, _CallFail):
+                self._CallFail_received(peerid, obj)
+            elif isinstance(obj, _CallCancel):
+                self._CallCancel_received(peerid, obj)
+            else:
+                raise ValueError("Received unknown object type")
+        except Exception:
+            logger.exception("error while receiving package from %r" % (peerid,))
+
+    def _Call_received(self, peerid, obj):
+        key = (peerid, obj.callid)
+        if key in self._remote_to_local:
+            logger.debug("Ignoring duplicate call %r from %s." % (obj.callid, peerid))
+            return
+
+        function = self._functions.get(obj.functionid, None)
+        if function is None:
+            logger.warning("Call %r from %s for unregistered function." % (obj.callid, peerid))
+            self._reply(peerid, _CallFail(obj.callid, ValueError("Call for unregistered function.")))
+            return
+
+        try:
+            result = self._start(function, obj.args, obj.kwargs)
+        except Exception as e:
+            self._reply(peerid, _CallFail(obj.callid, e))
+            return
+
+        if not asyncio.isfuture(result):
+            self._reply_return(peerid, obj.callid, result)
+            return
+
+        self._remote_to_local[key] = result
+
+        def completed(future):
+            if self._remote_to_local.pop(key, None) is None:
+                return
+            if future.cancelled():
+                self._reply(peerid, _CallFail(obj.callid, asyncio.CancelledError()))
+            elif future.exception() is not None:
+                self._reply(peerid, _CallFail(obj.callid, future.exception()))
+            else:
+                self._reply_return(peerid, obj.callid, future.result())
+        result.add_done_callback(completed)
+
+    def _start(self, function, args, kwargs):
+        """
+        Invokes the function. Coroutines are scheduled as a task, which is
+        returned instead of the coroutine.
+        """
+        result = function(*args, **kwargs)
+        if asyncio.iscoroutine(result):
+            result = self.loop.create_task(result)
+        return result
+
+    def _reply_return(self, peerid, callid, retval):
+        try:
+            data = _dumps(_CallReturn(callid, retval))
+        except Exception as e:
+            self._reply(peerid, _CallFail(callid, e))
+            return
+        self._connectionpool.send(peerid, MESSAGE_TYPE, data).add_done_callback(_log_send_failure)
+
+    def _reply(self, peerid, obj):
+        self._send(peerid, obj).add_done_callback(_log_send_failure)
+
+    def _CallReturn_received(self, peerid, obj):
+        future = self._local_to_remote.pop((peerid, obj.callid), None)
+        if future is None:
+            # Cancelled, the reply was already on its way.
+            logger.debug("Received return value for unknown call %r from %r." % (obj.callid, peerid))
+            return
+        if not future.done():
+            future.set_result(obj.retval)
+
+    def _CallFail_received(self, peerid, obj):
+        future = self._local_to_remote.pop((peerid, obj.callid), None)
+        if future is None:
+            # Cancelled, the reply was already on its way.
+            logger.debug("Received failure for unknown call %r from %r." % (obj.callid, peerid))
+            return
+        if not future.done():
+            e = _as_exception(obj.failure)
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+
+    def _CallCancel_received(self, peerid, obj):
+        # The caller does not expect a reply. Removing the call first
+        # stops `completed` in `_Call_received` from sending one.
+        future = self._remote_to_local.pop((peerid, obj.callid), None)
+        if future is not None:
+            future.cancel()
+
+    def _connection_lost(self, peerid):
+        """
+        Called when the last connection to a peer is closed. Sends the
+        idempotent calls in progress again and fails the others.
+        """
+        for key, future in list(self._local_to_remote.items()):
+            if key[0] != peerid or future.done():
+                continue
+            if key in self._replayable:
+                if key not in self._replay_timers:
+                    self._replay(key, self._max_replays)
+            else:
+                future.set_exception(ConnectionError("Lost connection to %s during call." % peerid))
+
+    def _replay(self, key, attempts):
+        self._replay_timers.pop(key, None)
+        data = self._replayable.get(key, None)
+        if data is None:
+            return
+
+        peerid, callid = key
+        logger.debug("Replaying call %r to %s." % (callid, peerid))
+        sent = self._connectionpool.send(peerid, MESSAGE_TYPE, data)
+
+        def send_completed(sent):
+            if key not in self._replayable or sent.cancelled() or sent.exception() is None:
+                return
+            if attempts > 1:
+                self._replay_timers[key] = self.loop.call_later(REPLAY_DELAY, self._replay, key, attempts - 1)
+            else:
+                future = self._local_to_remote.get(key, None)
+                if future is not None and not future.done():
+                    future.set_exception(sent.exception())
+        sent.add_done_callback(send_completed)
+
+    def _forget_replay(self, key):
+        self._replayable.pop(key, None)
+        timer = self._replay_timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+
+    def _ping(self, peerid, callid):
+        """
+        Called from remote to ask if a call made to here is still in progress.
+        """
+        if (peerid, callid) not in self._remote_to_local:
+            raise ValueError("No call %s from %s in progress." % (callid, peerid))
+
+
+class _RPCFunctionStub(object):
+    def __init__(self, peerid, functionid, rpcsystem, idempotent=False):
+        self.peerid = peerid
+        self.functionid = functionid
+        self.rpcsystem = rpcsystem
+        self.idempotent = idempotent
+
+    def __call__(self, *args, **kwargs):
+        return self.rpcsystem._invoke_function(self.peerid, self.functionid, args, kwargs, self.idempotent)
+
+    def __repr__(self):
+        return "RPCStub(%r, %r)" % (self.peerid, self.functionid)
+
+    def __eq__(self, other):
+        return self.peerid == other.peerid and self.functionid == other.functionid
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.peerid) + hash(self.functionid)
+
+    def __getstate__(self):
+        return {"peerid": self.peerid,
+                "functionid": self.functionid,
+                "idempotent": self.idempotent}
+
+    def __setstate__(self, state):
+        rpcsystem = RPCSystem.default
+        if rpcsystem is None:
+            raise ValueError("Cannot unpickle function stubs without RPCSystem.default set.")
+        self.peerid = state["peerid"]
+        self.functionid = state["functionid"]
+        self.idempotent = state.get("idempotent", False)
+        self.rpcsystem = rpcsystem
+
+
+class _Call(object):
+    def __init__(self, callid, functionid, args, kwargs):
+        self.callid = callid
+        self.functionid = functionid
+        self.args = args
+        self.kwargs = kwargs
+
+    def __repr__(self):
+        return "_Call(%s, %s)" % (repr(self.callid), repr(self.functionid))
+
+
+class _PackedCall(_Call):
+    """
+    Call with pickled arguments, as sent by :meth:`anycall.rpc.RPCSystem.broadcast`.
+    """
+    def __init__(self, callid, functionid, payload):
+        self.callid = callid
+        self.functionid = functionid
+        self.payload = payload
+        self._unpacked = None
+
+    @property
+    def args(self):
+        return self._unpack()[0]
+
+    @property
+    def kwargs(self):
+        return self._unpack()[1]
+
+    def _unpack(self):
+        if self._unpacked is None:
+            payload = self.payload
+            if isinstance(payload, str):
+                payload = payload.encode("latin-1")
+            self._unpacked = _loads(payload)
+        return self._unpacked
+
+    def __getstate__(self):
+        return {"callid": self.callid, "functionid": self.functionid, "payload": self.payload}
+
+    def __setstate__(self, state):
+        self.__init__(state["callid"], state["functionid"], state["payload"])
+
+
+class _CallReturn(object):
+    def __init__(self, callid, retval):
+        self.callid = callid
+        self.retval = retval
+
+    def __repr__(self):
+        return "_CallReturn(%s)" % (repr(self.callid))
+
+
+class UnpicklableFailure(Exception):
+    def __init__(self, stringrep):
+        Exception.__init__(self, stringrep)
+
+
+class _CallFail(object):
+    def __init__(self, callid, failure):
+        self.callid = callid
+        try:
+            _loads(_dumps(failure))
+        except Exception:
+            failure = UnpicklableFailure("".join(traceback.format_exception(type(failure), failure,
+                                                                            failure.__traceback__)))
+        self.failure = failure
+
+    def __repr__(self):
+        return "_CallFail(%s, %s)" % (repr(self.callid), repr(self.failure))
+
+
+class _CallCancel(object):
+    def __init__(self, callid):
+        self.callid = callid
+
+    def __repr__(self):
+        return "_CallCancel(%s)" % (repr(self.callid))
+
+
+class RemoteError(Exception):
+    """
+    Base of the exceptions we create for remote exception classes
+    that we cannot import.
+    """
+
+
+class RemoteFailure(RemoteError):
+    """
+    Unpickled `twisted.python.failure.Failure`. The remote exception
+    is in :attr:`value`.
+    """
+    value = None
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+
+_WIRE_CLASSES = dict((cls.__name__, cls) for cls in (_Call, _PackedCall, _CallReturn, _CallFail,
+                                                    _CallCancel, UnpicklableFailure, _RPCFunctionStub))
+
+_remote_classes = {}
+
+#: Sent in place of :class:`asyncio.CancelledError` so that Twisted peers
+#: understand it.
+_TWISTED_CANCELLED = ("twisted.internet.defer", "CancelledError")
+
+
+class _WirePickler(pickle._Pickler):
+    """
+    Pickles our message classes under the names used by :mod:`anycall.rpc`.
+    """
+
+    def save_global(self, obj, name=None):
+        if _WIRE_CLASSES.get(getattr(obj, "__name__", None), None) is obj:
+            self.write(pickle.GLOBAL + ("%s\n%s\n" % (_WIRE_MODULE, obj.__name__)).encode("ascii"))
+            self.memoize(obj)
+        elif obj is asyncio.CancelledError:
+            self.write(pickle.GLOBAL + ("%s\n%s\n" % _TWISTED_CANCELLED).encode("ascii"))
+            self.memoize(obj)
+        else:
+            pickle._Pickler.save_global(self, obj, name)
+
+
+class _WireUnpickler(pickle.Unpickler):
+    """
+    Maps the classes of :mod:`anycall.rpc` and Twisted's failures to ours.
+    """
+
+    def find_class(self, module, name):
+        if (module, name) == _TWISTED_CANCELLED:
+            return asyncio.CancelledError
+        if module == _WIRE_MODULE and name in _WIRE_CLASSES:
+            return _WIRE_CLASSES[name]
+        if (module, name) == ("twisted.python.failure", "Failure"):
+            return RemoteFailure
+        try:
+            return pickle.Unpickler.find_class(self, module, name)
+        except (ImportError, AttributeError):
+            cls = _remote_classes.get((module, name), None)
+            if cls is None:
+                cls = type(name, (RemoteError,), {"__module__": module})
+                _remote_classes[(module, name)] = cls
+            return cls
+
+
+def _dumps(obj):
+    f = io.BytesIO()
+    _WirePickler(f, 2).dump(obj)
+    return f.getvalue()
+
+
+def _loads(data):
+    return _WireUnpickler(io.BytesIO(data), encoding="latin-1").load()
+
+
+def _as_exception(failure):
+    if isinstance(failure, RemoteFailure):
+        failure = failure.value
+    if isinstance(failure, BaseException):
+        return failure
+    return RemoteError(repr(failure))
+
+
+def _log_send_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Failed to send reply: %s" % future.exception())
+
+
+def _named_function_id(name):
+    return uuid.uuid5(uuid.NAMESPACE_URL, "anycall:function:%s" % name)
+
+
+def _identity(function):
+    if inspect.ismethod(function):
+        return (id(function.__self__), id(function.__func__))
+    return id(function)
+
+
+def _parse_url(url, collection, kind):
+    """
+    Splits an anycall URL of the form `anycall://peerid/collection/id`.
+
+    :returns: Tuple `(peerid, id)`.
+    """
+    parseresult = urllib.parse.urlparse(url)
+    path = parseresult.path.split("/")
+    if parseresult.scheme != "anycall":
+        raise ValueError("Not an anycall URL: %s" % repr(url))
+    if len(path) != 3 or path[0] != "" or path[1] != collection:
+        raise ValueError("Not an URL for a remote %s: %s" % (kind, repr(url)))
+    try:
+        itemid = uuid.UUID(path[2])
+    except ValueError:
+        raise ValueError("Not a valid URL for a remote %s: %s" % (kind, repr(url)))
+    return parseresult.netloc, itemid
@@ -0,0 +1,278 @@
+# Copyright (c) 2014 Stefan C. Mueller
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Blocking API for synchronous code.
+
+The :class:`RPCSystem` runs on the Twisted reactor in a background
+thread that is shared by all clients of the process. Calls can be made
+from any thread. They are queued and handed to the reactor in batches,
+so many threads calling at once cost one wake-up of the reactor rather
+than one each. Connections stay open between calls.
+
+Usage::
+
+    client = anycall.blocking.shared_client()
+    result = client.call(url, 1, 2)
+
+The reactor thread is not carried over into child processes. Create
+the client after forking.
+"""
+
+import collections
+import logging
+import threading
+
+from twisted.internet import defer, reactor, threads, error
+from twisted.python import threadable
+from twisted.python.failure import Failure
+
+from anycall import rpc
+
+logger = logging.getLogger(__name__)
+
+_reactor_lock = threading.Lock()
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_client(**kwargs):
+    """
+    Returns the client shared by all threads of this process, opening
+    it on first use.
+
+    :param kwargs: Passed to :func:`anycall.rpc.create_tcp_rpc_system`
+      when the client is created. Ignored afterwards.
+    """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = BlockingClient(rpc.create_tcp_rpc_system(**kwargs))
+            _shared.open()
+        return _shared
+
+
+def close_shared_client():
+    """
+    Closes the shared client, if there is one. The next call to
+    :func:`shared_client` opens a new one.
+    """
+    global _shared
+    with _shared_lock:
+        if _shared is not None:
+            _shared.close()
+            _shared = None
+
+
+def ensure_reactor_running():
+    """
+    Starts the reactor in a daemon thread, unless it is running already.
+
+    The reactor cannot be restarted, so the thread runs until the
+    process exits.
+    """
+    with _reactor_lock:
+        if reactor.running:
+            return
+        started = threading.Event()
+        reactor.callWhenRunning(started.set)
+        thread = threading.Thread(target=reactor.run, kwargs={"installSignalHandlers": False},
+                                  name="anycall-reactor")
+        thread.daemon = True
+        thread.start()
+        started.wait()
+
+
+class BlockingClient(object):
+    """
+    Makes calls with an :class:`anycall.rpc.RPCSystem` running on the
+    background reactor. All methods may be called from any thread except
+    the reactor's.
+    """
+
+    def __init__(self, rpcsystem=None, timeout=None):
+        """
+        :param rpcsystem: RPC system to use. Defaults to a new TCP one.
+
+        :param timeout: Seconds :meth:`call` waits for the result before
+          it cancels the call and raises :class:`twisted.internet.error.TimeoutError`.
+          `None` to wait forever.
+        """
+        self.rpcsystem = rpcsystem or rpc.create_tcp_rpc_system()
+        self.timeout = timeout
+
+        #: Calls not yet handed to the reactor.
+        self._pending = collections.deque()
+        self._lock = threading.Lock()
+
+        #: If a `_flush` is scheduled with the reactor.
+        self._flush_scheduled = False
+
+        #: Maps `url -> stub`. Only used by the reactor thread.
+        self._stubs = {}
+
+    def open(self):
+        """
+        Starts the reactor if needed and opens the RPC system.
+        """
+        ensure_reactor_running()
+        self._blocking(self.rpcsystem.open)
+        return self
+
+    def close(self):
+        """
+        Closes the RPC system. The reactor keeps running.
+        """
+        self._blocking(self._close)
+
+    def get_function_url(self, function, **kwargs):
+        """
+        Registers a function to be called from remote. It will be invoked
+        in the reactor thread. See :meth:`anycall.rpc.RPCSystem.get_function_url`.
+        """
+        return self._blocking(self.rpcsystem.get_function_url, function, **kwargs)
+
+    def call(self, url, *args, **kwargs):
+        """
+        Calls the remote function and waits for its result. Exceptions
+        of the remote function are raised.
+        """
+        return self.submit(url, *args, **kwargs).result(self.timeout)
+
+    def submit(self, url, *args, **kwargs):
+        """
+        Calls the remote function without waiting for the result.
+
+        :returns: :class:`BlockingCall` to get the result from.
+        """
+        call = BlockingCall(self, url, args, kwargs)
+        with self._lock:
+            self._pending.append(call)
+            schedule = not self._flush_scheduled
+            self._flush_scheduled = True
+        if schedule:
+            reactor.callFromThread(self._flush)
+        return call
+
+    def create_function_stub(self, url):
+        """
+        Returns a callable that invokes the remote function and blocks
+        until it returns, like :meth:`call`.
+        """
+        def stub(*args, **kwargs):
+            return self.call(url, *args, **kwargs)
+        return stub
+
+    def _flush(self):
+        """
+        Starts all queued calls. Runs in the reactor thread.
+        """
+        with self._lock:
+            calls = list(self._pending)
+            self._pending.clear()
+            self._flush_scheduled = False
+        for call in calls:
+            call._start()
+
+    def _close(self):
+        self._stubs.clear()
+        return self.rpcsystem.close()
+
+    def _stub(self, url):
+        stub = self._stubs.get(url, None)
+        if stub is None:
+            stub = self.rpcsystem.create_function_stub(url)
+            self._stubs[url] = stub
+        return stub
+
+    def _blocking(self, function, *args, **kwargs):
+        if threadable.isInIOThread():
+            raise RuntimeError("Blocking calls from the reactor thread would deadlock.")
+        return threads.blockingCallFromThread(reactor, function, *args, **kwargs)
+
+
+class BlockingCall(object):
+    """
+    Call made with :meth:`BlockingClient.submit`.
+    """
+
+    def __init__(self, client, url, args, kwargs):
+        self._client = client
+        self._url = url
+        self._args = args
+        self._kwargs = kwargs
+        self._done = threading.Event()
+        self._result = None
+        self._failure = None
+        self._deferred = None
+        self._cancelled = False
+
+    def done(self):
+        """
+        Returns `True` if the call has completed.
+        """
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Waits for the call to complete and returns its result.
+
+        :param timeout: Seconds to wait. If the call has not completed by
+          then it is cancelled and :class:`twisted.internet.error.TimeoutError`
+          is raised. `None` to wait forever.
+        """
+        if not self._done.wait(timeout):
+            self.cancel()
+            raise error.TimeoutError("No result within %ss." % timeout)
+        if self._failure is not None:
+            self._failure.raiseException()
+        return self._result
+
+    def cancel(self):
+        """
+        Cancels the call, if it has not completed yet.
+        """
+        reactor.callFromThread(self._cancel)
+
+    def _start(self):
+        if self._cancelled:
+            self._failed(Failure(defer.CancelledError()))
+            return
+        try:
+            d = self._client._stub(self._url)(*self._args, **self._kwargs)
+        except:
+            self._failed(Failure())
+            return
+        self._deferred = d
+        d.addCallbacks(self._succeeded, self._failed)
+
+    def _cancel(self):
+        self._cancelled = True
+        if self._deferred is not None:
+            self._deferred.cancel()
+
+    def _succeeded(self, result):
+        self._result = result
+        self._done.set()
+
+    def _failed(self, failure):
+        self._failure = failure
+        self._done.set()
@@ -18,20 +18,54 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
-from twisted.internet import protocol, defer
+from twisted.internet import protocol, defer, task, reactor
 import logging
+import random
+import collections
 from anycall import packetprotocol
 
 logger = logging.getLogger(__name__)
 
 
+class SendQueueFull(Exception):
+    """
+    Raised if too many packets are waiting for a connection to a peer.
+    """
+
+
+class PeerUnavailable(Exception):
+    """
+    Raised when sending to a peer to which the last connection attempt
+    failed and the backoff delay has not passed yet, or which is :data:`DOWN`.
+    """
+
+#: No connection to the peer and we are not trying to open one. Sends
+#: open a connection.
+DISCONNECTED = "disconnected"
+
+#: We are trying to connect to the peer.
+CONNECTING = "connecting"
+
+#: There is at least one connection to the peer.
+UP = "up"
+
+#: The last connection attempt has failed. Sends fail immediately until the 
+#: backoff delay has passed.
+BACKOFF = "backoff"
+
+#: The last `down_after` connection attempts have failed. Sends fail
+#: immediately until a probe succeeds, see :meth:`ConnectionPool.probe`.
+DOWN = "down"
 
 
 class ConnectionPool(object):
     """
     To avoid opening a new connection for each communication,
     we use this class to pool them. Each connection is opened on first
-    use and automatically closed if unused for a certain time. 
+    use and automatically closed if unused for `idle_timeout` seconds.
+    If there are more than `max_connections` connections, the least recently
+    used ones are closed. Connections to peers with calls in progress
+    (see :attr:`busy_peers`) are never closed.
     
 
     This class has some abstract methods:
@@ -42,7 +76,10 @@ class ConnectionPool(object):
     the pool.
     """
     
-    def __init__(self, stream_server_endpoint, make_client_endpoint, ownid_factory):
+    def __init__(self, stream_server_endpoint, make_client_endpoint, ownid_factory,
+                 idle_timeout=None, max_connections=None, connections_per_peer=1,
+                 max_queued_packets=10000, reconnect_delay=0.1, max_reconnect_delay=30, down_after=10,
+                 address_ttl=300, shared_server_endpoint=None, shared_id_factory=None):
         """
         :param stream_server_endpoint: `IStreamServerEndpoint` implementation. We will listen
           on this for incomming connections.
@@ -53,6 +90,40 @@ class ConnectionPool(object):
           
         :param ownid: Identification string (such as hostname and port) that peers can use
           to connect to us.
+          
+        :param idle_timeout: Connections that have not been used for this many seconds
+          are closed. `None` to keep them open.
+          
+        :param max_connections: Maximal number of open connections. `None` for no limit.
+        
+        :param connections_per_peer: Number of parallel connections we open to each
+          peer. Packets are sent over the connection with the fewest bytes waiting
+          in its send buffer.
+          
+        :param max_queued_packets: Maximal number of packets per peer that wait
+          for the connection to be established. Further sends fail with 
+          :class:`SendQueueFull`.
+          
+        :param reconnect_delay: Seconds to wait after the first failed connection
+          attempt to a peer before we try again. The delay doubles with each 
+          further failure, up to `max_reconnect_delay`, and is randomized to 
+          avoid that many peers retry at the same time.
+          
+        :param down_after: Number of failed connection attempts in a row after
+          which the peer is :data:`DOWN`. We then probe it every
+          `max_reconnect_delay` seconds in the background instead of letting
+          sends try again. `None` to keep backing off forever.
+          
+        :param address_ttl: Seconds we remember the network address of a peer
+          we connected to. See :attr:`address_cache`.
+          
+        :param shared_server_endpoint: Optional second endpoint to listen on, 
+          shared with other processes (for example through `SO_REUSEPORT`).
+          Connections accepted there identify as `shared_id` in the handshake,
+          so that peers can connect to any of the processes. Peers learn the 
+          process's own id too (see :attr:`PoolProtocol.worker`).
+          
+        :param shared_id_factory: Like `ownid_factory` for the shared endpoint.
         """
         self.stream_server_endpoint = stream_server_endpoint
         self.ownid_factory = ownid_factory
@@ -60,9 +131,77 @@ class ConnectionPool(object):
         
         self._listeningport = None
         
+        self.shared_server_endpoint = shared_server_endpoint
+        self.shared_id_factory = shared_id_factory
+        self._shared_listeningport = None
+        
+        #: Id shared by all processes listening on `shared_server_endpoint`.
+        self.shared_id = None
+        
         self._connections = {}
         self._ongoing_sends = set()
         
+        #: Connections we are closing, but that are not closed yet.
+        self._closing = set()
+        
+        self.idle_timeout = idle_timeout
+        self.max_connections = max_connections
+        self.connections_per_peer = connections_per_peer
+        
+        #: Peers to which we are opening an additional connection.
+        self._extra_connects = set()
+        
+        #: Connection attempts shared by all senders.
+        #: Maps `peer -> Deferred`.
+        self._pending_connects = {}
+        
+        #: Deferreds waiting for the outcome of a pending connection attempt.
+        #: Maps `peer -> [Deferred]`.
+        self._connect_waiters = {}
+        
+        #: Packets waiting for a connection.
+        #: Maps `peer -> deque([(typename, data, affinity, deferred)])`
+        self._send_queues = {}
+        self.max_queued_packets = max_queued_packets
+        
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.down_after = down_after
+        
+        #: Maps `peer -> _PeerState`.
+        self._peer_states = {}
+        
+        #: Addresses of the peers we connected to. `make_client_endpoint`
+        #: may use it to avoid resolving host names again.
+        self.address_cache = AddressCache(address_ttl)
+        
+        #: Packets sent with the same affinity key go over the same connection.
+        #: Maps `(peer, key) -> protocol`.
+        self._affinities = {}
+        
+        #: Peers we reconnect to whenever we lose the connection.
+        #: See :meth:`pre_connect_many`.
+        self._warm_peers = set()
+        
+        #: Maps `peer -> IDelayedCall` of the scheduled reconnects.
+        self._warm_timers = {}
+        
+        #: Maps `peer -> IDelayedCall` of the background probes of `DOWN` peers.
+        self._probe_timers = {}
+        
+        self.clock = reactor
+        self._reaper = None
+        
+        self._counters = {"opened": 0,
+                          "reaped": 0,
+                          "evicted": 0}
+        
+        #: Maps `peer -> _PeerTraffic`.
+        self._traffic = {}
+        
+        #: Totals of the peers removed from `_traffic` by the reaper.
+        self._retired_traffic = _PeerTraffic()
+        
         #: invoked when we receive data from a connection.
         #: Set via :meth:`open`
         #self.packet_received = None
@@ -71,6 +210,20 @@ class ConnectionPool(object):
         #: peer's id for every connection that is opened.
         self.connection_established = None
         
+        #: Optional callback returning the set of peers we
+        #: must not disconnect from, since there are calls in progress.
+        self.busy_peers = None
+        
+        #: Optional callback invoked with the peer's id
+        #: when the last connection to that peer is closed.
+        self.connection_lost = None
+        
+        #: Optional callback invoked with the transport of each new
+        #: connection (accepted or opened), for example to set socket options.
+        #: May return a dict with the effective settings which is reported
+        #: in :meth:`stats`.
+        self.configure_transport = None
+        
         self._typenames = set()
         self._dummy_protocol = packetprotocol.PacketProtocol()
         
@@ -102,13 +255,30 @@ class ConnectionPool(object):
             self._listeningport = listeningport
             self.ownid = self.ownid_factory(listeningport)
             logger.debug("Port opened. Own-ID:%s" % self.ownid)
+            if self.idle_timeout is not None:
+                self._reaper = task.LoopingCall(self._reap_idle)
+                self._reaper.clock = self.clock
+                self._reaper.start(self.idle_timeout / 2.0, now=False)
             return None
         
+        def open_shared(_):
+            if self.shared_server_endpoint is None:
+                return None
+            d = self.shared_server_endpoint.listen(PoolFactory(self, self._typenames, shared=True))
+            d.addCallback(shared_port_open)
+            return d
+        
+        def shared_port_open(listeningport):
+            self._shared_listeningport = listeningport
+            self.shared_id = self.shared_id_factory(listeningport)
+            logger.debug("Shared port opened. Shared-ID:%s" % self.shared_id)
+        
         logger.debug("Opening connection pool")
         
         self.packet_received = packet_received
         d = self.stream_server_endpoint.listen(PoolFactory(self, self._typenames))
         d.addCallback(port_open)
+        d.addCallback(open_shared)
         return d
     
     def pre_connect(self, peer):
@@ -123,12 +293,75 @@ class ConnectionPool(object):
         """
         if peer in self._connections:
             return defer.succeed(peer)
-        else:
-            d = self._connect(peer, exact_peer=False)
-            def connected(p):
-                return p.peer
-            d.addCallback(connected)
-            return d
+        unavailable = self._check_backoff(peer)
+        if unavailable is not None:
+            return unavailable
+        d = self._connect_queued(peer, exact_peer=False)
+        d.addCallback(lambda p: p.peer)
+        return d
+        
+    def pre_connect_many(self, peers, concurrency=50, keep_warm=False):
+        """
+        Opens connections to many peers, at most `concurrency` at a time.
+        
+        :param keep_warm: If `True`, the peers we could connect to are
+          reconnected in the background whenever their connections are lost
+          (including idle connections, which are then no longer reaped). 
+          Use :meth:`stop_warm` to stop this.
+        
+        :returns: Deferred that calls back once all attempts have finished, 
+          with a dict mapping each given peer to `(True, peerid)` with the 
+          peer's real id (see :meth:`pre_connect`), or to `(False, failure)`.
+        """
+        semaphore = defer.DeferredSemaphore(concurrency)
+        
+        def connected(peerid):
+            if keep_warm:
+                self._warm_peers.add(peerid)
+            return (True, peerid)
+        
+        def failed(failure):
+            return (False, failure)
+        
+        peers = list(peers)
+        ds = []
+        for peer in peers:
+            d = semaphore.run(self.pre_connect, peer)
+            d.addCallbacks(connected, failed)
+            ds.append(d)
+            
+        d = defer.gatherResults(ds)
+        d.addCallback(lambda results: dict(zip(peers, results)))
+        return d
+    
+    def stop_warm(self, peers=None):
+        """
+        Stops reconnecting to the given peers (all if `None`) in the background.
+        """
+        if peers is None:
+            peers = list(self._warm_peers)
+        for peer in peers:
+            self._warm_peers.discard(peer)
+            timer = self._warm_timers.pop(peer, None)
+            if timer is not None and timer.active():
+                timer.cancel()
+    
+    def _schedule_warm(self, peer):
+        if peer not in self._warm_peers or peer in self._warm_timers:
+            return
+        delay = max(self.reconnect_delay, self.retry_delay(peer))
+        self._warm_timers[peer] = self.clock.callLater(delay, self._rewarm, peer)
+        
+    def _rewarm(self, peer):
+        del self._warm_timers[peer]
+        if peer not in self._warm_peers or peer in self._connections:
+            return
+        logger.debug("Reconnecting to warm peer %s" % peer)
+        
+        def done(_):
+            if peer not in self._connections:
+                self._schedule_warm(peer)
+        self._connect_queued(peer).addBoth(done)
         
     def _connect(self, peer, exact_peer=True):
         logger.debug("Opening connection to %s..." % peer)
@@ -139,7 +372,7 @@ class ConnectionPool(object):
         else:
             expected_peer = None
         
-        d = endpoint.connect(PoolFactory(self, self._typenames, expected_peer))
+        d = endpoint.connect(PoolFactory(self, self._typenames, expected_peer, outgoing=True))
         
         def got_connection(p):
             d = p.wait_for_handshake()
@@ -149,34 +382,326 @@ class ConnectionPool(object):
         d.addCallback(got_connection)
         return d
     
-    def send(self, peer, typename, data):
+    def send(self, peer, typename, data, affinity=None):
         """
         Sends a packet to a peer.
+        
+        :param affinity: Optional key. Packets with the same key are sent
+          over the same connection and therefore arrive in order. Call 
+          :meth:`forget_affinity` once the key is no longer needed.
+        
+        If we have no connection to the peer yet, the packet is queued
+        until the connection is established. Concurrent sends share the
+        same connection attempt and the packets are sent in order.
+        
+        :returns: Deferred that calls back once the packet is handed
+          to the transport.
         """
-
-
-        def attempt_to_send(_):
-            if peer not in self._connections:
-                d = self._connect(peer)
-                d.addCallback(attempt_to_send)
-                return d
-            else:
-                conn = self._connections[peer][0]
-                conn.send_packet(typename, data)            
-                return defer.succeed(None)
+        if peer in self._connections and peer not in self._send_queues:
+            self._send_now(peer, typename, data, affinity)
+            return defer.succeed(None)
+        
+        unavailable = self._check_backoff(peer)
+        if unavailable is not None:
+            return unavailable
         
-        d = attempt_to_send(None)
+        queue = self._send_queues.setdefault(peer, collections.deque())
+        if len(queue) >= self.max_queued_packets:
+            return defer.fail(SendQueueFull("%s packets waiting for connection to %s." % (len(queue), peer)))
+        
+        def canceller(d):
+            try:
+                queue.remove(entry)
+            except ValueError:
+                pass
+            if not queue and self._send_queues.get(peer, None) is queue:
+                del self._send_queues[peer]
+                if not self._connect_waiters.get(peer, None):
+                    # Nobody else is waiting for the connection.
+                    connecting = self._pending_connects.pop(peer, None)
+                    if connecting is not None:
+                        connecting.cancel()
+        
+        d = defer.Deferred(canceller)
+        entry = (typename, data, affinity, d)
+        queue.append(entry)
+        traffic = self._get_traffic(peer)
+        traffic.max_queued = max(traffic.max_queued, len(queue))
         
         self._ongoing_sends.add(d)
         
         def send_completed(result):
-            if d in self._ongoing_sends:
-                self._ongoing_sends.remove(d)
+            self._ongoing_sends.discard(d)
             return result
         
         d.addBoth(send_completed)
+        
+        if peer in self._connections:
+            self._flush_queue(peer)
+        else:
+            self._connect_queued(peer, wait=False)
         return d
     
+    def _send_now(self, peer, typename, data, affinity):
+        conn = self._select_connection(peer, affinity)
+        conn.last_used = self.clock.seconds()
+        conn.packets_sent += 1
+        conn.bytes_sent += len(data)
+        conn.send_packet(typename, data)
+    
+    def _check_backoff(self, peer):
+        """
+        Returns a failed Deferred if we must not try to connect to `peer`
+        yet, `None` otherwise.
+        """
+        peer_state = self._peer_states.get(peer, None)
+        if peer_state is not None and peer_state.state == DOWN:
+            return defer.fail(PeerUnavailable("%s is down after %s failed connection attempts." % 
+                                              (peer, peer_state.failures)))
+        if peer_state is not None and peer_state.state == BACKOFF:
+            if self.clock.seconds() < peer_state.retry_at:
+                return defer.fail(PeerUnavailable("Connecting to %s failed %s times. Next attempt in %.1fs." % 
+                                                  (peer, peer_state.failures, peer_state.retry_at - self.clock.seconds())))
+        return None
+    
+    def _connect_queued(self, peer, exact_peer=True, wait=True):
+        """
+        Opens a connection for the queued packets unless there is one
+        in progress already.
+        
+        :param exact_peer: If the peer has to identify itself as `peer`.
+          If not, `peer` may be an alias, such as an IP address.
+          
+        :param wait: If we want to know the outcome. The queued packets
+          learn it anyway.
+        
+        :returns: Deferred that calls back with the connection's protocol
+          once the attempt (new or in progress) has succeeded, or fails
+          with its failure. `None` if not `wait`.
+        """
+        waiter = defer.Deferred() if wait else None
+        if peer in self._pending_connects:
+            if waiter is not None:
+                self._connect_waiters[peer].append(waiter)
+            return waiter
+        
+        waiters = [waiter] if waiter is not None else []
+        finished = []
+        self._get_peer_state(peer).state = CONNECTING
+        # Errors of `make_client_endpoint` count as failed attempts too.
+        d = defer.maybeDeferred(self._connect, peer, exact_peer)
+        
+        def connected(p):
+            finished.append(True)
+            if self._pending_connects.get(peer, None) is d:
+                del self._pending_connects[peer]
+            if self._connect_waiters.get(peer, None) is waiters:
+                del self._connect_waiters[peer]
+            if p.peer != peer and peer not in self._connections:
+                # Connected to an alias. The connection is known by the real id.
+                self._peer_states.pop(peer, None)
+            for w in waiters:
+                w.callback(p)
+        
+        def failed(failure):
+            finished.append(True)
+            if self._pending_connects.get(peer, None) is d:
+                del self._pending_connects[peer]
+            if self._connect_waiters.get(peer, None) is waiters:
+                del self._connect_waiters[peer]
+            if peer not in self._connections:
+                if failure.check(defer.CancelledError):
+                    # We gave up, for example because we are closing.
+                    # That says nothing about the peer.
+                    peer_state = self._peer_states.pop(peer, None)
+                    if peer_state is not None and peer_state.failures:
+                        peer_state.state = BACKOFF
+                        self._peer_states[peer] = peer_state
+                else:
+                    self.address_cache.invalidate(peer)
+                    self._connect_failed(peer)
+                queue = self._send_queues.pop(peer, ())
+                for _, _, _, send_d in queue:
+                    send_d.errback(failure)
+            for w in waiters:
+                w.errback(failure)
+        
+        d.addCallbacks(connected, failed)
+        if not finished:
+            # The attempt may complete synchronously, in which case
+            # there is nothing pending.
+            self._pending_connects[peer] = d
+            self._connect_waiters[peer] = waiters
+        return waiter
+    
+    def _get_traffic(self, peer):
+        traffic = self._traffic.get(peer, None)
+        if traffic is None:
+            traffic = _PeerTraffic()
+            self._traffic[peer] = traffic
+        traffic.last_used = self.clock.seconds()
+        return traffic
+    
+    def peer_stats(self, peer=None):
+        """
+        Returns traffic statistics per peer, including those we are no
+        longer connected to. Maps `peer -> stats` or, if `peer` is given,
+        returns the stats of that peer only.
+        
+        With an `idle_timeout`, peers we have neither connections nor
+        queued packets for are forgotten after that many seconds. Their
+        traffic is then only included in the `retired_traffic` of :meth:`stats`.
+        
+        Each entry has the number of connections `opened` and `lost`, the
+        total `packets_sent`, `bytes_sent`, `packets_received` and
+        `bytes_received` (without handshakes and packet headers), the
+        largest `max_receive_buffer` of any connection, the mean 
+        `handshake_time` and `lifetime` (of lost connections) in seconds,
+        the number of packets `queued` for a connection now and the
+        `max_queued` so far, and the :meth:`PoolProtocol.utilization` of
+        the open `connections`.
+        """
+        if peer is not None:
+            return self._peer_stats(peer)
+        return dict((p, self._peer_stats(p)) for p in self._traffic)
+    
+    def _peer_stats(self, peer):
+        traffic = self._traffic.get(peer, None) or _PeerTraffic()
+        return traffic.snapshot(self._connections.get(peer, []),
+                                len(self._send_queues.get(peer, ())))
+    
+    def _get_peer_state(self, peer):
+        peer_state = self._peer_states.get(peer, None)
+        if peer_state is None:
+            peer_state = _PeerState()
+            self._peer_states[peer] = peer_state
+        return peer_state
+    
+    def _connect_failed(self, peer):
+        peer_state = self._get_peer_state(peer)
+        peer_state.failures += 1
+        if self.down_after is not None and peer_state.failures >= self.down_after:
+            peer_state.state = DOWN
+            peer_state.retry_at = self.clock.seconds() + self.max_reconnect_delay
+            if peer not in self._probe_timers:
+                self._probe_timers[peer] = self.clock.callLater(self.max_reconnect_delay, 
+                                                                self._background_probe, peer)
+            logger.debug("Connecting to %s failed %s times. Considering it down." % 
+                         (peer, peer_state.failures))
+            return
+        delay = min(self.max_reconnect_delay, self.reconnect_delay * 2 ** (peer_state.failures - 1))
+        delay *= random.uniform(0.5, 1.0)
+        peer_state.state = BACKOFF
+        peer_state.retry_at = self.clock.seconds() + delay
+        logger.debug("Connecting to %s failed. Retry in %.1fs." % (peer, delay))
+    
+    def peer_state(self, peer):
+        """
+        Returns the connection state of the given peer: :data:`DISCONNECTED`,
+        :data:`CONNECTING`, :data:`UP`, :data:`BACKOFF` or :data:`DOWN`.
+        """
+        if peer in self._connections:
+            return UP
+        peer_state = self._peer_states.get(peer, None)
+        if peer_state is None:
+            return DISCONNECTED
+        return peer_state.state
+    
+    def retry_delay(self, peer):
+        """
+        Seconds until we may try to connect to `peer` again, or until the
+        next background probe if it is :data:`DOWN`. Zero otherwise.
+        """
+        peer_state = self._peer_states.get(peer, None)
+        if peer_state is None or peer_state.state not in (BACKOFF, DOWN):
+            return 0
+        return max(0, peer_state.retry_at - self.clock.seconds())
+    
+    def probe(self, peer):
+        """
+        Tries to connect to `peer` now, even if it is in :data:`BACKOFF`
+        or :data:`DOWN`. If the attempt succeeds, sends go through again.
+        
+        :returns: Deferred that calls back with `peer` once we are
+          connected, or fails if the attempt failed.
+        """
+        if peer in self._connections:
+            return defer.succeed(peer)
+        d = self._connect_queued(peer)
+        d.addCallback(lambda _: peer)
+        return d
+    
+    def _background_probe(self, peer):
+        del self._probe_timers[peer]
+        if self.peer_state(peer) != DOWN:
+            return
+        logger.debug("Probing %s, which is down." % peer)
+        self.probe(peer).addErrback(lambda _: None)
+    
+    def _cancel_probe(self, peer):
+        timer = self._probe_timers.pop(peer, None)
+        if timer is not None and timer.active():
+            timer.cancel()
+    
+    def _flush_queue(self, peer):
+        """
+        Sends all packets waiting for a connection to `peer`.
+        """
+        queue = self._send_queues.pop(peer, None)
+        while queue:
+            typename, data, affinity, d = queue.popleft()
+            try:
+                self._send_now(peer, typename, data, affinity)
+            except:
+                d.errback()
+            else:
+                d.callback(None)
+    
+    def forget_affinity(self, peer, key):
+        """
+        Releases an affinity key passed to :meth:`send`.
+        """
+        conn = self._affinities.pop((peer, key), None)
+        if conn is not None:
+            conn.affinities.discard(key)
+    
+    def _select_connection(self, peer, affinity):
+        connections = self._connections[peer]
+        
+        if len(connections) < self.connections_per_peer:
+            self._open_extra_connection(peer)
+        
+        if affinity is not None:
+            conn = self._affinities.get((peer, affinity), None)
+            if conn is not None:
+                return conn
+        
+        if len(connections) == 1:
+            conn = connections[0]
+        else:
+            conn = min(connections, key=lambda c: c.buffered_bytes())
+            
+        if affinity is not None:
+            self._affinities[(peer, affinity)] = conn
+            conn.affinities.add(affinity)
+        return conn
+    
+    def _open_extra_connection(self, peer):
+        if peer in self._extra_connects:
+            return
+        self._extra_connects.add(peer)
+        
+        def done(result):
+            self._extra_connects.discard(peer)
+            return result
+        
+        def failed(failure):
+            logger.warn("Failed to open additional connection to %s: %s" % (peer, failure.getErrorMessage()))
+        
+        d = self._connect(peer)
+        d.addBoth(done)
+        d.addErrback(failed)
+        
     def close(self):
         """
         Stop listing for new connections and close all open connections.
@@ -184,14 +709,23 @@ class ConnectionPool(object):
         :returns: Deferred that calls back once everything is closed.
         """
         
+        if self._reaper is not None and self._reaper.running:
+            self._reaper.stop()
+        self.stop_warm()
+        for peer in list(self._probe_timers):
+            self._cancel_probe(peer)
+        
         def cancel_sends(_):
             logger.debug("Closed port. Cancelling all on-going send operations...")
             while self._ongoing_sends:
                 d = self._ongoing_sends.pop()
                 d.cancel()
+            for d in self._pending_connects.values():
+                d.cancel()
 
         def close_connections(_):
             all_connections = [c for conns in self._connections.itervalues() for c in conns]
+            all_connections.extend(self._closing)
             
             logger.debug("Closing all connections (there are %s)..." % len(all_connections))
             for c in all_connections:
@@ -206,7 +740,12 @@ class ConnectionPool(object):
         
         logger.debug("Closing connection pool...")
         
+        def stop_shared(_):
+            if self._shared_listeningport is not None:
+                return self._shared_listeningport.stopListening()
+        
         d = defer.maybeDeferred(self._listeningport.stopListening)
+        d.addCallback(stop_shared)
         d.addCallback(cancel_sends)
         d.addCallback(close_connections)
         return d
@@ -215,10 +754,31 @@ class ConnectionPool(object):
         peer = protocol.peer
         logger.debug("Connection established with %s" % peer)
         
+        protocol.last_used = self.clock.seconds()
         if peer in self._connections:
             self._connections[peer].append(protocol)
         else:
             self._connections[peer] = [protocol]
+        self._counters["opened"] += 1
+        traffic = self._get_traffic(peer)
+        traffic.opened += 1
+        traffic.handshake_time += protocol.handshake_time
+        
+        peer_state = self._get_peer_state(peer)
+        peer_state.state = UP
+        peer_state.failures = 0
+        self._cancel_probe(peer)
+        
+        if protocol.outgoing:
+            address = getattr(protocol.transport.getPeer(), "host", None)
+            if address is not None:
+                self.address_cache.set(peer, address)
+        
+        if self.max_connections is not None:
+            self._evict(protocol)
+        
+        if peer in self._send_queues:
+            self._flush_queue(peer)
     
         if self.connection_established:
             self.connection_established(peer)
@@ -228,25 +788,312 @@ class ConnectionPool(object):
         
         logger.debug("Lost connection to %s" % peer)
         
-        connections = self._connections[peer]
+        self._get_traffic(peer).connection_lost(protocol, self.clock.seconds())
+        self._closing.discard(protocol)
+        self._drop_affinities(protocol)
+        connections = self._connections.get(peer, [])
+        if protocol in connections:
+            connections.remove(protocol)
+            if not connections:
+                del self._connections[peer]
+                self._peer_disconnected(peer)
+                
+    def _peer_disconnected(self, peer):
+        peer_state = self._peer_states.get(peer, None)
+        if peer_state is not None and peer_state.state == UP:
+            if peer in self._pending_connects:
+                peer_state.state = CONNECTING
+            else:
+                # Forget peers we have no trouble with.
+                del self._peer_states[peer]
+        self._schedule_warm(peer)
+        if self.connection_lost:
+            self.connection_lost(peer)
+    
+    def stats(self):
+        """
+        Returns a dict with the number of open `connections`, the number of
+        `peers` we are connected to, and how many connections have been
+        `opened`, `reaped` (idle timeout) and `evicted` (connection limit) so far.
+        `retired_traffic` sums up the :meth:`peer_stats` of the peers that
+        have been forgotten.
+        """
+        stats = dict(self._counters)
+        stats["connections"] = sum(len(conns) for conns in self._connections.itervalues())
+        stats["peers"] = len(self._connections)
+        stats["queued"] = dict((peer, len(queue)) for peer, queue in self._send_queues.iteritems())
+        stats["peer_states"] = dict((peer, self.peer_state(peer)) for peer in self._peer_states)
+        stats["address_cache"] = self.address_cache.stats()
+        stats["retired_traffic"] = self._retired_traffic.snapshot([], 0)
+        stats["utilization"] = dict((peer, [c.utilization() for c in conns]) 
+                                    for peer, conns in self._connections.iteritems())
+        return stats
+    
+    def _drop_affinities(self, protocol):
+        for key in protocol.affinities:
+            self._affinities.pop((protocol.peer, key), None)
+        protocol.affinities.clear()
+    
+    def _close_connection(self, protocol, reason):
+        """
+        Removes the connection from the pool and closes it.
+        """
+        logger.debug("Closing connection to %s (%s)." % (protocol.peer, reason))
+        connections = self._connections[protocol.peer]
         connections.remove(protocol)
         if not connections:
-            del self._connections[peer]
+            del self._connections[protocol.peer]
+            self._peer_disconnected(protocol.peer)
+        self._drop_affinities(protocol)
+        self._closing.add(protocol)
+        self._counters[reason] += 1
+        protocol.transport.loseConnection()
+        
+    def _get_busy_peers(self):
+        if self.busy_peers is None:
+            return frozenset()
+        return self.busy_peers()
+    
+    def _reap_idle(self):
+        """
+        Called periodically. Closes connections not used for `idle_timeout` seconds.
+        """
+        self.address_cache.purge()
+        deadline = self.clock.seconds() - self.idle_timeout
+        self._retire_traffic(deadline)
+        idle = [c for conns in self._connections.itervalues() for c in conns if c.last_used <= deadline]
+        if not idle:
+            return
+        busy = self._get_busy_peers()
+        for c in idle:
+            if c.peer not in busy and c.peer not in self._warm_peers:
+                self._close_connection(c, "reaped")
+    
+    def _retire_traffic(self, deadline):
+        """
+        Adds the traffic of peers unused since `deadline` to the pool-wide
+        totals, so that `_traffic` does not grow with every peer ever contacted.
+        """
+        for peer, traffic in self._traffic.items():
+            if (traffic.last_used <= deadline and peer not in self._connections and 
+                peer not in self._send_queues and peer not in self._pending_connects):
+                self._retired_traffic.merge(traffic)
+                del self._traffic[peer]
+    
+    def _evict(self, keep):
+        """
+        Closes the least recently used connections until we are within 
+        `max_connections`. Never closes `keep`.
+        """
+        all_connections = [c for conns in self._connections.itervalues() for c in conns]
+        excess = len(all_connections) - self.max_connections
+        if excess <= 0:
+            return
+        busy = self._get_busy_peers()
+        candidates = [c for c in all_connections if c is not keep and c.peer not in busy]
+        candidates.sort(key=lambda c: c.last_used)
+        for c in candidates[:excess]:
+            self._close_connection(c, "evicted")
+        if excess > len(candidates):
+            logger.warn("More than %s connections open, but all are busy." % self.max_connections)
+    
+
+class AddressCache(object):
+    """
+    Remembers the network addresses of peers, so that we don't have to 
+    resolve their host names for each new connection. Entries expire
+    after `ttl` seconds.
+    """
+    
+    def __init__(self, ttl=300, clock=reactor):
+        self.ttl = ttl
+        self.clock = clock
+        
+        #: Maps `peer -> (address, expires)`
+        self._entries = {}
+        
+        self._hits = 0
+        self._misses = 0
+        
+    def get(self, peer):
+        """
+        Returns the cached address of the peer or `None`.
+        """
+        entry = self._entries.get(peer, None)
+        if entry is not None:
+            address, expires = entry
+            if expires > self.clock.seconds():
+                self._hits += 1
+                return address
+            del self._entries[peer]
+        self._misses += 1
+        return None
+    
+    def set(self, peer, address, ttl=None):
+        """
+        Stores the address of a peer for `ttl` seconds (defaults to the 
+        cache's `ttl`).
+        """
+        if ttl is None:
+            ttl = self.ttl
+        self._entries[peer] = (address, self.clock.seconds() + ttl)
+        
+    def seed(self, addresses, ttl=None):
+        """
+        Stores many addresses at once, for example from an inventory.
+        
+        :param addresses: Dict mapping `peer -> address`.
+        """
+        for peer, address in addresses.iteritems():
+            self.set(peer, address, ttl)
+    
+    def invalidate(self, peer):
+        """
+        Removes the address of a peer, for example if it has become unreachable.
+        """
+        self._entries.pop(peer, None)
+        
+    def purge(self):
+        """
+        Removes all expired entries.
+        """
+        now = self.clock.seconds()
+        for peer, (_, expires) in self._entries.items():
+            if expires <= now:
+                del self._entries[peer]
+                
+    def stats(self):
+        """
+        Returns a dict with the number of entries and the `hits` and `misses` so far.
+        """
+        return {"size": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses}
+    
+    def __len__(self):
+        return len(self._entries)
+    
+
+class _PeerTraffic(object):
+    """
+    Traffic with a peer over connections that are closed by now, and
+    totals over all connections.
+    """
+    
+    def __init__(self):
+        #: Connections made and lost.
+        self.opened = 0
+        self.lost = 0
+        
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.packets_received = 0
+        self.bytes_received = 0
+        self.max_receive_buffer = 0
+        
+        #: Sum over all connections made.
+        self.handshake_time = 0.0
+        
+        #: Sum over the connections lost.
+        self.lifetime = 0.0
+        
+        #: Most packets waiting for a connection at once.
+        self.max_queued = 0
+        
+        #: Time a connection was made or lost or a packet was queued.
+        self.last_used = None
+        
+    def connection_lost(self, protocol, now):
+        self.lost += 1
+        self.packets_sent += protocol.packets_sent
+        self.bytes_sent += protocol.bytes_sent
+        self.packets_received += protocol.packets_received
+        self.bytes_received += protocol.bytes_received
+        self.max_receive_buffer = max(self.max_receive_buffer, protocol.max_receive_buffer)
+        self.lifetime += now - protocol.connected_at
+        
+    def merge(self, other):
+        self.opened += other.opened
+        self.lost += other.lost
+        self.packets_sent += other.packets_sent
+        self.bytes_sent += other.bytes_sent
+        self.packets_received += other.packets_received
+        self.bytes_received += other.bytes_received
+        self.max_receive_buffer = max(self.max_receive_buffer, other.max_receive_buffer)
+        self.handshake_time += other.handshake_time
+        self.lifetime += other.lifetime
+        self.max_queued = max(self.max_queued, other.max_queued)
+        
+    def snapshot(self, connections, queued):
+        stats = {"opened": self.opened,
+                 "lost": self.lost,
+                 "packets_sent": self.packets_sent + sum(c.packets_sent for c in connections),
+                 "bytes_sent": self.bytes_sent + sum(c.bytes_sent for c in connections),
+                 "packets_received": self.packets_received + sum(c.packets_received for c in connections),
+                 "bytes_received": self.bytes_received + sum(c.bytes_received for c in connections),
+                 "max_receive_buffer": max([self.max_receive_buffer] + 
+                                           [c.max_receive_buffer for c in connections]),
+                 "handshake_time": self.handshake_time / self.opened if self.opened else None,
+                 "lifetime": self.lifetime / self.lost if self.lost else None,
+                 "queued": queued,
+                 "max_queued": self.max_queued,
+                 "connections": [c.utilization() for c in connections]}
+        return stats
+    
+
+class _PeerState(object):
+    """
+    What we know about the connectivity to a peer.
+    """
+    
+    def __init__(self):
+        self.state = DISCONNECTED
+        
+        #: Number of failed connection attempts since the last success.
+        self.failures = 0
+        
+        #: When we may try again, if in `BACKOFF`.
+        self.retry_at = None
     
 class PoolProtocol(packetprotocol.PacketProtocol):
     
     HANDSHAKE = "PoolProtocol_handshake"
     
-    def __init__(self, pool, ownid, peer=None):
+    def __init__(self, pool, ownid, peer=None, outgoing=False):
         packetprotocol.PacketProtocol.__init__(self)
         self.pool = pool
         self.ownid = ownid
         self.peer = peer
+        
+        #: If we opened this connection, as opposed to the peer.
+        self.outgoing = outgoing
+        
+        #: Own id of the peer's process. Equal to `peer` unless
+        #: the peer accepted this connection on a shared endpoint.
+        self.worker = None
         self.register_type(self.HANDSHAKE)
         
         self.handshake_completed = False
         self.handshake_deferred = defer.Deferred()
         
+        #: Time this connection was last used to send or receive a packet.
+        self.last_used = None
+        
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.packets_received = 0
+        self.bytes_received = 0
+        
+        #: When the connection was made and how long the handshake took.
+        self.connected_at = None
+        self.handshake_time = None
+        
+        #: Settings returned by the pool's `configure_transport`.
+        self.transport_settings = None
+        
+        #: Affinity keys bound to this connection.
+        self.affinities = set()
+        
         def canceller(_):
             self.transport.loseConnection()
         
@@ -259,6 +1106,37 @@ class PoolProtocol(packetprotocol.PacketProtocol):
         self.handshake_deferred.chainDeferred(d)
         return d
         
+    def buffered_bytes(self):
+        """
+        Number of bytes written to the transport but not yet sent.
+        """
+        transport = self.transport
+        pending_bytes = getattr(transport, "pending_bytes", None)
+        if pending_bytes is not None:
+            return pending_bytes()
+        # `FileDescriptor` based transports, such as TCP.
+        buffered = len(getattr(transport, "dataBuffer", "")) - getattr(transport, "offset", 0)
+        return buffered + getattr(transport, "_tempDataLen", 0)
+    
+    def utilization(self):
+        """
+        Returns a dict with the number of `packets_sent`, `bytes_sent`,
+        `packets_received` and `bytes_received` over this connection (not
+        counting the handshake and packet headers), the bytes currently
+        `buffered` for sending, the `max_receive_buffer` in bytes, the
+        `handshake_time` and `lifetime` in seconds, and the transport's 
+        `settings` (see :attr:`ConnectionPool.configure_transport`).
+        """
+        return {"packets_sent": self.packets_sent,
+                "bytes_sent": self.bytes_sent,
+                "packets_received": self.packets_received,
+                "bytes_received": self.bytes_received,
+                "buffered": self.buffered_bytes(),
+                "max_receive_buffer": self.max_receive_buffer,
+                "handshake_time": self.handshake_time,
+                "lifetime": self.pool.clock.seconds() - self.connected_at,
+                "settings": self.transport_settings}
+        
     def wait_for_close(self):
         d = defer.Deferred()
         self.closed_deferred.chainDeferred(d)
@@ -266,6 +1144,9 @@ class PoolProtocol(packetprotocol.PacketProtocol):
         
     def connectionMade(self):
         packetprotocol.PacketProtocol.connectionMade(self)
+        self.connected_at = self.pool.clock.seconds()
+        if self.pool.configure_transport is not None:
+            self.transport_settings = self.pool.configure_transport(self.transport)
         self.send_packet(self.HANDSHAKE, self.ownid)
         
     def connectionLost(self, reason=protocol.connectionDone):
@@ -277,17 +1158,24 @@ class PoolProtocol(packetprotocol.PacketProtocol):
     def packet_received(self, typename, packet):
         try:
             if typename == self.HANDSHAKE:
-                peer = packet
-                if self.peer and self.peer != peer:
+                # "<ownid>\0<sharedid>" if accepted on a shared endpoint.
+                worker, _, shared_id = packet.partition("\0")
+                peer = shared_id or worker
+                if self.peer and self.peer not in (peer, worker):
                     raise ValueError("Peer says it is %s, but we expected %s. Closing connection." %(repr(peer), repr(self.peer)))
                 else:
                     self.handshake_completed = True
-                    self.peer = peer
+                    self.handshake_time = self.pool.clock.seconds() - self.connected_at
+                    self.peer = self.peer or peer
+                    self.worker = worker
                     self.pool._connection_made(self)
                     self.handshake_deferred.callback(None)
             elif not self.handshake_completed:
                 raise ValueError("Expected handshake, got %s. Closing connection. "%repr(typename))
             else:
+                self.last_used = self.pool.clock.seconds()
+                self.packets_received += 1
+                self.bytes_received += len(packet)
                 self.pool.packet_received(self.peer, typename, packet)
         except ValueError:
             logger.exception("Error while receiving package")
@@ -296,13 +1184,19 @@ class PoolProtocol(packetprotocol.PacketProtocol):
     
 class PoolFactory(protocol.Factory):
 
-    def __init__(self, pool, typenames, peer=None):
+    def __init__(self, pool, typenames, peer=None, outgoing=False, shared=False):
         self.pool = pool
         self.typenames = typenames
         self.peer = peer
+        self.outgoing = outgoing
+        self.shared = shared
         
     def buildProtocol(self, addr):
-        p = PoolProtocol(self.pool, self.pool.ownid, self.peer)
+        if self.shared:
+            ownid = "%s\0%s" % (self.pool.ownid, self.pool.shared_id)
+        else:
+            ownid = self.pool.ownid
+        p = PoolProtocol(self.pool, ownid, self.peer, self.outgoing)
         for t in self.typenames:
             p.register_type(t)
         return p
\ No newline at end of file
@@ -0,0 +1,160 @@
+# Copyright (c) 2014 Stefan C. Mueller
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+"""
+In-memory ring of fixed-size binary event records.
+
+The hot paths of :class:`anycall.rpc.RPCSystem` record what happens to
+each message here instead of formatting log messages. Recording packs a
+few numbers into a preallocated buffer. Nothing is formatted until the
+events are read with :meth:`EventRing.events` or :meth:`EventRing.dump`,
+so the ring can be left on in production and dumped when something
+goes wrong::
+
+    rpcsystem.enable_events()
+    ...
+    rpcsystem.events.dump(sys.stderr)
+
+Once the ring is full the oldest events are overwritten.
+"""
+
+import collections
+import struct
+import time
+import uuid
+
+#: Number of events kept by default.
+DEFAULT_CAPACITY = 65536
+
+CALL_SENT = 1
+CALL_RECEIVED = 2
+RETURN_SENT = 3
+RETURN_RECEIVED = 4
+FAIL_SENT = 5
+FAIL_RECEIVED = 6
+CANCEL_SENT = 7
+CANCEL_RECEIVED = 8
+DUPLICATE_CALL = 9
+
+#: Maps event code to its name.
+NAMES = {CALL_SENT: "call_sent",
+         CALL_RECEIVED: "call_received",
+         RETURN_SENT: "return_sent",
+         RETURN_RECEIVED: "return_received",
+         FAIL_SENT: "fail_sent",
+         FAIL_RECEIVED: "fail_received",
+         CANCEL_SENT: "cancel_sent",
+         CANCEL_RECEIVED: "cancel_received",
+         DUPLICATE_CALL: "duplicate_call"}
+
+#: Bytes of the peer id stored with each event. Longer ids are cut at
+#: the front, where host names are least specific.
+PEER_SIZE = 32
+
+#: Time, event code, peer id, call id, function id.
+_RECORD = struct.Struct("<dB7x%ds16s16s" % PEER_SIZE)
+
+_NO_ID = b"\0" * 16
+
+#: Event as returned by :meth:`EventRing.events`.
+Event = collections.namedtuple("Event", ["time", "name", "peer", "callid", "functionid"])
+
+
+class EventRing(object):
+    """
+    Keeps the last `capacity` events, each as a record of
+    :attr:`RECORD_SIZE` bytes. The peer id is stored in the record, so
+    the memory used does not depend on the number of peers.
+    """
+
+    #: Bytes per event.
+    RECORD_SIZE = _RECORD.size
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, clock=time.time):
+        """
+        :param capacity: Number of events to keep.
+
+        :param clock: Function returning the current time in seconds.
+        """
+        self.capacity = capacity
+        self.clock = clock
+        self._buffer = bytearray(capacity * _RECORD.size)
+
+        #: Index of the record to write next.
+        self._next = 0
+
+        #: Number of events recorded since the last :meth:`clear`.
+        self.recorded = 0
+
+    def record(self, event, peer, callid, functionid=None):
+        """
+        Records an event.
+
+        :param event: One of the event codes of this module.
+
+        :param callid: :class:`uuid.UUID` of the call.
+
+        :param functionid: :class:`uuid.UUID` of the called function, if known.
+        """
+        if len(peer) > PEER_SIZE:
+            peer = "..." + peer[3 - PEER_SIZE:]
+        _RECORD.pack_into(self._buffer, self._next * _RECORD.size, self.clock(), event, peer,
+                          callid.bytes, functionid.bytes if functionid is not None else _NO_ID)
+        self._next += 1
+        if self._next == self.capacity:
+            self._next = 0
+        self.recorded += 1
+
+    def __len__(self):
+        return min(self.recorded, self.capacity)
+
+    def events(self):
+        """
+        Returns the recorded :class:`Event` tuples, oldest first.
+        """
+        if self.recorded < self.capacity:
+            indices = range(self._next)
+        else:
+            indices = range(self._next, self.capacity) + range(self._next)
+        events = []
+        for i in indices:
+            timestamp, event, peer, callid, functionid = _RECORD.unpack_from(self._buffer, i * _RECORD.size)
+            events.append(Event(timestamp, NAMES.get(event, str(event)), peer.rstrip("\0"),
+                                uuid.UUID(bytes=callid),
+                                uuid.UUID(bytes=functionid) if functionid != _NO_ID else None))
+        return events
+
+    def dump(self, out):
+        """
+        Writes the recorded events to the file-like object `out`, one
+        line each, oldest first.
+        """
+        for event in self.events():
+            out.write("%.6f %-15s %s call=%s function=%s\n" % (
+                event.time, event.name, event.peer, event.callid.hex,
+                event.functionid.hex if event.functionid is not None else "-"))
+
+    def clear(self):
+        """
+        Forgets all events.
+        """
+        self._next = 0
+        self.recorded = 0
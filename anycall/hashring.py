@@ -0,0 +1,125 @@
+# Copyright (c) 2014 Stefan C. Mueller
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import bisect
+import hashlib
+import struct
+
+
+class HashRing(object):
+    """
+    Consistent hash ring mapping keys to nodes.
+
+    Each node is placed on the ring at `vnodes * weight` points. A key
+    belongs to the node of the next point clockwise of the key's hash.
+    Adding or removing a node only moves the keys of that node.
+    """
+
+    def __init__(self, nodes=(), vnodes=100):
+        """
+        :param nodes: Initial nodes, all with weight 1.
+
+        :param vnodes: Number of points per node and unit of weight.
+        """
+        self.vnodes = vnodes
+
+        #: Maps `node -> weight`.
+        self._weights = {}
+
+        #: Sorted hashes of the points on the ring.
+        self._points = []
+
+        #: Node of each point, same order as `_points`.
+        self._nodes = []
+
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node, weight=1):
+        """
+        Adds a node or changes its weight.
+
+        :param node: String identifying the node.
+
+        :param weight: Relative share of the keys this node should get.
+        """
+        if weight <= 0:
+            raise ValueError("Weight must be positive.")
+        if node in self._weights:
+            self.remove(node)
+        self._weights[node] = weight
+        for i in range(int(round(self.vnodes * weight))):
+            point = _hash("%s#%s" % (node, i))
+            index = bisect.bisect(self._points, point)
+            self._points.insert(index, point)
+            self._nodes.insert(index, node)
+
+    def remove(self, node):
+        """
+        Removes a node. Its keys are spread over the remaining nodes.
+        """
+        del self._weights[node]
+        keep = [(p, n) for p, n in zip(self._points, self._nodes) if n != node]
+        self._points = [p for p, _ in keep]
+        self._nodes = [n for _, n in keep]
+
+    def get(self, key):
+        """
+        Returns the node responsible for the given key.
+
+        :raises LookupError: If the ring is empty.
+        """
+        if not self._points:
+            raise LookupError("No nodes in the hash ring.")
+        index = bisect.bisect(self._points, _hash(key))
+        if index == len(self._points):
+            index = 0
+        return self._nodes[index]
+
+    def weight(self, node):
+        """
+        Returns the weight of the given node.
+        """
+        return self._weights[node]
+
+    @property
+    def nodes(self):
+        """
+        List of the nodes in the ring.
+        """
+        return list(self._weights)
+
+    def __contains__(self, node):
+        return node in self._weights
+
+    def __len__(self):
+        return len(self._weights)
+
+
+def _hash(key):
+    """
+    Position of a key on the ring. Unlike `hash()` it is the same in
+    every process.
+    """
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    elif not isinstance(key, str):
+        key = repr(key)
+    return struct.unpack(">Q", hashlib.md5(key).digest()[:8])[0]
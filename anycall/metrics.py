@@ -0,0 +1,323 @@
+# Copyright (c) 2014 Stefan C. Mueller
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import array
+import bisect
+import struct
+import sys
+import time
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+#: Buckets per power of two. Values are recorded with a relative
+#: error of at most `1 / SUB_BUCKETS`.
+SUB_BUCKETS = 16
+
+#: Percentiles included in :meth:`Histogram.snapshot`.
+PERCENTILES = (0.5, 0.9, 0.99, 0.999)
+
+#: Number of latencies :class:`CallStats` collects before it adds them
+#: to its histogram on the call path. Normally they are added earlier by
+#: :meth:`CallMetrics.fold`.
+FOLD_THRESHOLD = 16384
+
+#: Index of the most significant of the four 16 bit words of a double.
+_HIGH_WORD = 3 if sys.byteorder == "little" else 0
+
+
+class Histogram(object):
+    """
+    Log-linear histogram in the style of HdrHistogram.
+
+    Each power of two is split into :data:`SUB_BUCKETS` equally wide
+    buckets, so the precision is relative to the value and the number of
+    buckets only grows with the logarithm of the range. Only buckets that
+    have been hit are stored.
+
+    The bucket of a value is the top 16 bits of its IEEE 754
+    representation: the sign, the exponent and the four most significant
+    bits of the mantissa. That lets :meth:`record_many` find the buckets
+    of many values without a Python loop over them.
+    """
+
+    def __init__(self):
+        #: Maps `bucket -> count`.
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        """
+        Adds a non-negative value.
+        """
+        self.record_many((value,))
+
+    def record_many(self, values):
+        """
+        Adds a sequence of non-negative values. Much faster than adding
+        them one by one.
+        """
+        if not values:
+            return
+        buckets = array.array("H", array.array("d", values).tostring())[_HIGH_WORD::4]
+        buckets = sorted(buckets)
+        counts = self.counts
+        lo = 0
+        for bucket in sorted(set(buckets)):
+            hi = bisect.bisect_right(buckets, bucket, lo)
+            # Negative values have the sign bit set, count them as zero.
+            key = 0 if bucket & 0x8000 else bucket
+            counts[key] = counts.get(key, 0) + hi - lo
+            lo = hi
+        self.count += len(values)
+        self.total += sum(values)
+        low, high = min(values), max(values)
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+
+    def percentile(self, q):
+        """
+        Returns the value below which the fraction `q` of the recorded
+        values are, or `None` if there are none.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(_upper_bound(bucket), self.max)
+        return self.max
+
+    def merge(self, other):
+        """
+        Adds the values recorded by another histogram.
+        """
+        for bucket, count in other.counts.iteritems():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def to_dict(self):
+        """
+        Returns the complete state as a dict that can be serialized as
+        JSON, for example to merge the histograms of several processes.
+        See :meth:`from_dict`.
+        """
+        return {"counts": dict((str(bucket), count) for bucket, count in self.counts.iteritems()),
+                "count": self.count,
+                "total": self.total,
+                "min": self.min,
+                "max": self.max}
+
+    @classmethod
+    def from_dict(cls, state):
+        """
+        Creates a histogram from the dict returned by :meth:`to_dict`.
+        """
+        histogram = cls()
+        histogram.counts = dict((int(bucket), count) for bucket, count in state["counts"].iteritems())
+        histogram.count = state["count"]
+        histogram.total = state["total"]
+        histogram.min = state["min"]
+        histogram.max = state["max"]
+        return histogram
+
+    def snapshot(self):
+        """
+        Returns a dict with `count`, `mean`, `min`, `max` and the
+        percentiles in :data:`PERCENTILES` as `p50`, `p90`, `p99` and `p999`.
+        """
+        snapshot = {"count": self.count,
+                    "mean": self.total / self.count if self.count else None,
+                    "min": self.min,
+                    "max": self.max}
+        for q in PERCENTILES:
+            snapshot["p" + ("%g" % (q * 100)).replace(".", "")] = self.percentile(q)
+        return snapshot
+
+
+def _upper_bound(bucket):
+    """
+    Smallest value above the given bucket.
+    """
+    return struct.unpack("<d", struct.pack("<Q", (bucket + 1) << 48))[0]
+
+
+class CallStats(object):
+    """
+    Counters and latencies of the calls of one function with one peer.
+
+    A call only increments :attr:`started` and appends its latency to a
+    list. The latencies are added to the histogram by
+    :meth:`CallMetrics.fold`, on :meth:`snapshot` or once there are
+    :data:`FOLD_THRESHOLD` of them. The number of calls in flight is
+    derived from the two.
+    """
+
+    __slots__ = ("started", "errors", "cancelled", "_latency", "_pending")
+
+    def __init__(self):
+        #: Number of calls started, including those still in flight.
+        self.started = 0
+        self.errors = 0
+        self.cancelled = 0
+        self._latency = Histogram()
+        self._pending = []
+
+    @property
+    def latency(self):
+        """
+        :class:`Histogram` of the latencies of the completed calls.
+        """
+        self._fold()
+        return self._latency
+
+    @property
+    def calls(self):
+        """
+        Number of completed calls, including the failed and cancelled ones.
+        """
+        return self._latency.count + len(self._pending)
+
+    @property
+    def in_flight(self):
+        """
+        Number of calls started but not yet completed.
+        """
+        return self.started - self.calls
+
+    def snapshot(self):
+        return {"calls": self.calls,
+                "errors": self.errors,
+                "cancelled": self.cancelled,
+                "in_flight": self.in_flight,
+                "latency": self.latency.snapshot()}
+
+    def _fold(self):
+        self._latency.record_many(self._pending)
+        del self._pending[:]
+
+
+class CallMetrics(object):
+    """
+    Call statistics of an :class:`anycall.rpc.RPCSystem`, per function
+    and peer.
+
+    `caller` measures the calls we make, from the invocation of the stub
+    until the result arrives. `callee` measures the calls made to us,
+    from the invocation of the function until it returns or its Deferred
+    fires.
+    """
+
+    def __init__(self, clock=time.time):
+        """
+        :param clock: Function returning the current time in seconds.
+        """
+        self.clock = clock
+
+        # The tables are keyed by `functionid.int` as hashing a UUID
+        # runs Python code.
+
+        #: Maps `(functionid.int, peerid) -> CallStats`.
+        self.caller = {}
+
+        #: Maps `(functionid.int, peerid) -> CallStats`.
+        self.callee = {}
+
+    def started(self, table, functionid, peerid):
+        """
+        Records the start of a call.
+
+        :param table: :attr:`caller` or :attr:`callee`.
+
+        :returns: Token to pass to :meth:`finished`.
+        """
+        try:
+            stats = table[functionid.int, peerid]
+        except KeyError:
+            stats = table[functionid.int, peerid] = CallStats()
+        stats.started += 1
+        if len(stats._pending) >= FOLD_THRESHOLD:
+            stats._fold()
+        return stats, self.clock()
+
+    def finished(self, result, token):
+        """
+        Records the end of a call. Can be added to a Deferred with
+        `addBoth`, `result` is passed through.
+        """
+        stats, start = token
+        stats._pending.append(self.clock() - start)
+        if isinstance(result, Failure):
+            if result.check(defer.CancelledError):
+                stats.cancelled += 1
+            else:
+                stats.errors += 1
+        return result
+
+    def fold(self):
+        """
+        Adds the latencies collected since the last call to the
+        histograms. Bucketing them costs about as much as recording them,
+        so :class:`anycall.rpc.RPCSystem` does this periodically rather
+        than on every call.
+        """
+        for table in (self.caller, self.callee):
+            for stats in table.itervalues():
+                if stats._pending:
+                    stats._fold()
+
+    def snapshot(self):
+        """
+        Returns `{"caller": {functionid: {peerid: stats}}, "callee": ...}`
+        with the function ids in hex, as in URLs, and the stats as
+        returned by :meth:`CallStats.snapshot`.
+        """
+        return {"caller": _snapshot_table(self.caller),
+                "callee": _snapshot_table(self.callee)}
+
+    def reset(self):
+        """
+        Forgets the statistics of completed calls. Calls in progress are
+        still counted in `in_flight` and recorded once they finish.
+        """
+        for table in (self.caller, self.callee):
+            for key, stats in table.items():
+                in_flight = stats.in_flight
+                if in_flight:
+                    stats.__init__()
+                    stats.started = in_flight
+                else:
+                    del table[key]
+
+
+def _snapshot_table(table):
+    snapshot = {}
+    for (functionid, peerid), stats in table.iteritems():
+        snapshot.setdefault("%032x" % functionid, {})[peerid] = stats.snapshot()
+    return snapshot
@@ -50,6 +50,10 @@ class PacketProtocol(protocol.Protocol):
         self._header = struct.Struct(">II")
         self._type_register = {}
         
+        #: Largest number of received bytes buffered at once, waiting for
+        #: the rest of their packet.
+        self.max_receive_buffer = 0
+        
     def register_type(self, typename):
         """
         Registers a type name so that it may be used to send and receive packages.
@@ -77,7 +81,9 @@ class PacketProtocol(protocol.Protocol):
         """
         
         self._unprocessed_data.enqueue(data)
-        
+        buffered = len(self._unprocessed_data)
+        if buffered > self.max_receive_buffer:
+            self.max_receive_buffer = buffered
         
         while True:
             if len(self._unprocessed_data) < self._header.size:
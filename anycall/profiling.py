@@ -0,0 +1,229 @@
+# Copyright (c) 2014 Stefan C. Mueller
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+"""
+Breakdown of where the time of remote calls goes.
+
+Enabled at runtime with :meth:`anycall.rpc.RPCSystem.start_profiling`.
+The time spent on each message is split into phases, recorded per
+message kind (`call`, `return`, `fail`, `cancel`) and per function:
+
+`pickle`
+  Pickling the message.
+`frame`
+  Handing the pickled message to the connection pool, which frames it
+  and writes it to the transport's buffer.
+`send_queue`
+  Waiting in the connection pool until the message could be written,
+  for example while the connection is being established.
+`unpickle`
+  Unpickling a received message, including the arguments of a call.
+`dispatch`
+  From the unpickled call until its function is invoked.
+`execute`
+  From the invocation of the function until it returns or its
+  Deferred fires.
+
+The function of received `return` and `fail` messages is not known,
+they are only counted per kind.
+"""
+
+import heapq
+import itertools
+import time
+
+#: Phases in the order they happen.
+PHASES = ("pickle", "frame", "send_queue", "unpickle", "dispatch", "execute")
+
+
+class PhaseStats(object):
+    """
+    Number, total and maximum duration of one phase.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def snapshot(self):
+        return {"count": self.count,
+                "total": self.total,
+                "mean": self.total / self.count if self.count else None,
+                "max": self.max}
+
+
+class CallProfile(object):
+    """
+    Timings of one call made to us, from the arrival of the call until
+    its reply has been sent.
+    """
+
+    def __init__(self, profiler, functionid, peerid, request_bytes, received, unpickle):
+        """
+        :param request_bytes: Size of the pickled call, mostly its arguments.
+
+        :param received: Time the call arrived.
+
+        :param unpickle: Seconds it took to unpickle the call.
+        """
+        self._profiler = profiler
+        self.functionid = functionid
+        self.peerid = peerid
+        self.request_bytes = request_bytes
+        self.received = received
+        self.unpickle = unpickle
+        self.dispatch = None
+        self.execute = None
+        self.pickle = None
+        self.reply_bytes = None
+        self.total = None
+        self._execute_start = None
+
+    def dispatched(self):
+        """
+        Records that the function is about to be invoked.
+        """
+        now = self._profiler.clock()
+        self.dispatch = now - self.received - self.unpickle
+        self._profiler.record("call", self.functionid, "dispatch", self.dispatch)
+        self._execute_start = now
+
+    def executed(self, result):
+        """
+        Records that the function has completed. Can be added to a
+        Deferred with `addBoth`, `result` is passed through.
+        """
+        self.execute = self._profiler.clock() - self._execute_start
+        self._profiler.record("call", self.functionid, "execute", self.execute)
+        return result
+
+    def replied(self, pickle, reply_bytes):
+        """
+        Records the pickling of the reply.
+        """
+        self.pickle = pickle
+        self.reply_bytes = reply_bytes
+
+    def finish(self):
+        """
+        Records that the reply has been sent.
+        """
+        self.total = self._profiler.clock() - self.received
+        self._profiler.add_call(self)
+
+    def to_dict(self):
+        return {"function": self.functionid.hex,
+                "peer": self.peerid,
+                "request_bytes": self.request_bytes,
+                "reply_bytes": self.reply_bytes,
+                "total": self.total,
+                "unpickle": self.unpickle,
+                "dispatch": self.dispatch,
+                "execute": self.execute,
+                "pickle": self.pickle}
+
+
+class Profiler(object):
+    """
+    Collects the phase timings of an :class:`anycall.rpc.RPCSystem` and
+    keeps the slowest calls made to it.
+    """
+
+    def __init__(self, top=20, clock=time.time):
+        """
+        :param top: Number of slowest calls to keep.
+
+        :param clock: Function returning the current time in seconds.
+        """
+        self.top = top
+        self.clock = clock
+
+        #: Maps `(kind, functionid.int or None, phase) -> PhaseStats`.
+        self.phases = {}
+
+        #: Heap of `(total, seq, CallProfile)` of the slowest calls.
+        self._slowest = []
+        self._seq = itertools.count()
+
+    def record(self, kind, functionid, phase, seconds):
+        """
+        Adds the duration of a phase of a message.
+
+        :param functionid: Function the message belongs to, or `None` if
+          unknown.
+        """
+        key = (kind, functionid.int if functionid is not None else None, phase)
+        try:
+            stats = self.phases[key]
+        except KeyError:
+            stats = self.phases[key] = PhaseStats()
+        stats.add(seconds)
+
+    def add_call(self, profile):
+        """
+        Adds a completed call, keeping it if it is one of the
+        :attr:`top` slowest.
+        """
+        entry = (profile.total, next(self._seq), profile)
+        if len(self._slowest) < self.top:
+            heapq.heappush(self._slowest, entry)
+        elif self._slowest and entry > self._slowest[0]:
+            heapq.heapreplace(self._slowest, entry)
+
+    def slowest(self):
+        """
+        Returns the slowest calls as :class:`CallProfile`, slowest first.
+        """
+        return [profile for _, _, profile in sorted(self._slowest, reverse=True)]
+
+    def snapshot(self):
+        """
+        Returns a dict with the phase statistics per message kind
+        (`kinds`), per function id in hex and kind (`functions`), and the
+        `slowest` calls. The statistics are as returned by
+        :meth:`PhaseStats.snapshot`, the calls as by :meth:`CallProfile.to_dict`.
+        """
+        kinds = {}
+        functions = {}
+        for (kind, functionid, phase), stats in self.phases.iteritems():
+            total = kinds.setdefault(kind, {}).setdefault(phase, PhaseStats())
+            total.merge(stats)
+            if functionid is not None:
+                function = functions.setdefault("%032x" % functionid, {})
+                function.setdefault(kind, {})[phase] = stats.snapshot()
+        for phases in kinds.itervalues():
+            for phase, stats in phases.items():
+                phases[phase] = stats.snapshot()
+        return {"kinds": kinds,
+                "functions": functions,
+                "slowest": [profile.to_dict() for profile in self.slowest()]}
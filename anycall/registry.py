@@ -0,0 +1,261 @@
+# Copyright (c) 2014 Stefan C. Mueller
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import time
+import uuid
+import types
+import weakref
+import collections
+
+
+class FunctionExpired(ValueError):
+    """
+    Raised when a function is invoked that was registered once but
+    has been removed since (unregistered, expired, evicted, or
+    garbage collected).
+    """
+
+
+class FunctionRegistry(object):
+    """
+    Maps function ids to the callables that may be invoked from remote.
+
+    Entries are looked up by identity of the callable, so registering
+    the same function (or the same bound method) twice returns the same id
+    without hashing the callable itself.
+
+    Entries can be weak, in which case they disappear once the callable
+    is garbage collected. Optionally entries expire if they have not been
+    used for `ttl` seconds, and the least recently used entries are evicted
+    if there are more than `max_size`. Pinned entries are never removed
+    automatically.
+    """
+
+    def __init__(self, ttl=None, max_size=None, expired_memory=1024, clock=time.time):
+        """
+        :param ttl: Seconds after the last use until an entry expires.
+          `None` to keep the entries until they are unregistered.
+
+        :param max_size: Maximal number of (non-pinned) entries.
+
+        :param expired_memory: Number of removed function ids we remember
+          in order to tell late callers that the function has expired rather
+          than that it never existed.
+
+        :param clock: Returns the current time in seconds.
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.expired_memory = expired_memory
+        self.clock = clock
+
+        #: Maps `functionid -> _Entry`, least recently used first.
+        self._entries = collections.OrderedDict()
+
+        #: Maps `functionid -> _Entry`, never expire.
+        self._pinned = {}
+
+        #: Maps `identity -> functionid`.
+        self._ids = {}
+
+        #: Recently removed function ids, oldest first.
+        self._removed = collections.OrderedDict()
+
+        self._counters = {"registered": 0,
+                          "unregistered": 0,
+                          "expired": 0,
+                          "evicted": 0,
+                          "collected": 0}
+
+    def register(self, function, functionid=None, weak=False, pinned=False):
+        """
+        Registers the callable (if it isn't already).
+
+        :param functionid: Id to use. A new one is generated if `None`.
+
+        :param weak: Only keep a weak reference to the callable.
+
+        :param pinned: Never remove this entry automatically.
+
+        :returns: The function id.
+        """
+        identity = _identity(function)
+        existing = self._ids.get(identity, None)
+        if existing is not None and (functionid is None or functionid == existing):
+            self._touch(existing)
+            return existing
+
+        self._remove_expired()
+
+        if functionid is None:
+            functionid = uuid.uuid1()
+        elif functionid in self._entries or functionid in self._pinned:
+            self.unregister(functionid)
+
+        entry = _Entry(identity, self._make_ref(function, functionid, weak), weak, self.clock())
+        if pinned:
+            self._pinned[functionid] = entry
+        else:
+            self._entries[functionid] = entry
+        self._ids[identity] = functionid
+        self._removed.pop(functionid, None)
+        self._counters["registered"] += 1
+
+        if self.max_size is not None:
+            while len(self._entries) > self.max_size:
+                oldest = next(iter(self._entries))
+                self._remove(oldest, "evicted")
+        return functionid
+
+    def unregister(self, function_or_id):
+        """
+        Removes a function, given either the callable or its id.
+
+        :returns: `True` if there was such a function.
+        """
+        if isinstance(function_or_id, uuid.UUID):
+            functionid = function_or_id
+        else:
+            functionid = self._ids.get(_identity(function_or_id), None)
+        if functionid is None or functionid not in self:
+            return False
+        self._remove(functionid, "unregistered")
+        return True
+
+    def lookup(self, functionid):
+        """
+        Returns the callable registered under the given id.
+
+        :raises FunctionExpired: If the function has been removed.
+
+        :raises ValueError: If there never was such a function.
+        """
+        entry = self._pinned.get(functionid, None)
+        if entry is not None:
+            return entry.ref()
+
+        self._remove_expired()
+
+        entry = self._entries.get(functionid, None)
+        if entry is not None:
+            function = entry.ref()
+            if function is not None:
+                self._touch(functionid)
+                return function
+            self._remove(functionid, "collected")
+
+        if functionid in self._removed:
+            raise FunctionExpired("Function %s has expired." % functionid)
+        raise ValueError("Call for unregistered function.")
+
+    def find(self, function):
+        """
+        Returns the id of the given callable or `None` if not registered.
+        """
+        return self._ids.get(_identity(function), None)
+
+    def __contains__(self, functionid):
+        return functionid in self._entries or functionid in self._pinned
+
+    def __len__(self):
+        return len(self._entries) + len(self._pinned)
+
+    def stats(self):
+        """
+        Returns a dict with the current table size and the number of
+        entries registered and removed (by reason) so far.
+        """
+        self._remove_expired()
+        stats = dict(self._counters)
+        stats["size"] = len(self)
+        stats["weak"] = sum(1 for e in self._entries.itervalues() if e.weak)
+        return stats
+
+    def _make_ref(self, function, functionid, weak):
+        if not weak:
+            return lambda: function
+
+        def collected(_):
+            entry = self._entries.get(functionid, None)
+            if entry is not None and entry.ref is ref:
+                self._remove(functionid, "collected")
+
+        if isinstance(function, types.MethodType) and function.im_self is not None:
+            self_ref = weakref.ref(function.im_self, collected)
+            func = function.im_func
+            cls = function.im_class
+
+            def ref():
+                obj = self_ref()
+                if obj is None:
+                    return None
+                return types.MethodType(func, obj, cls)
+        else:
+            ref = weakref.ref(function, collected)
+        return ref
+
+    def _touch(self, functionid):
+        entry = self._entries.pop(functionid, None)
+        if entry is not None:
+            entry.last_used = self.clock()
+            self._entries[functionid] = entry
+
+    def _remove_expired(self):
+        if self.ttl is None:
+            return
+        deadline = self.clock() - self.ttl
+        while self._entries:
+            functionid, entry = next(self._entries.iteritems())
+            if entry.last_used > deadline:
+                break
+            self._remove(functionid, "expired")
+
+    def _remove(self, functionid, reason):
+        entry = self._entries.pop(functionid, None)
+        if entry is None:
+            entry = self._pinned.pop(functionid)
+        if self._ids.get(entry.identity, None) == functionid:
+            del self._ids[entry.identity]
+        self._counters[reason] += 1
+
+        self._removed[functionid] = reason
+        while len(self._removed) > self.expired_memory:
+            self._removed.popitem(last=False)
+
+
+class _Entry(object):
+    __slots__ = ("identity", "ref", "weak", "last_used")
+
+    def __init__(self, identity, ref, weak, last_used):
+        self.identity = identity
+        self.ref = ref
+        self.weak = weak
+        self.last_used = last_used
+
+
+def _identity(function):
+    """
+    Key under which we find a callable without hashing it. Bound
+    methods are created on each attribute access, so we use the
+    instance and the underlying function instead.
+    """
+    if isinstance(function, types.MethodType) and function.im_self is not None:
+        return (id(function.im_self), id(function.im_func))
+    return id(function)
@@ -19,12 +19,16 @@
 # IN THE SOFTWARE.
 
 import logging
-import bidict
 import uuid
 import urlparse
 import pickle
 import socket
 import random
+import os
+import weakref
+import tempfile
+import sys
+import collections
 
 import twistit
 from pickle import PicklingError
@@ -32,18 +36,75 @@ from twisted.python.failure import Failure
 
 logger = logging.getLogger(__name__)
 
-from twisted.internet import defer, task, reactor, endpoints
+from twisted.internet import defer, task, reactor, endpoints, error
 
-from anycall import connectionpool
+from anycall import connectionpool, shmtransport, registry, hashring, metrics, tracing, profiling, events
 
 
-def create_tcp_rpc_system(hostname=None, port_range=(0,), ping_interval=1, ping_timeout=0.5):
+#: Socket options for :func:`create_tcp_rpc_system` by profile name.
+#:
+#: `nodelay` disables Nagle's algorithm, `keepalive` enables TCP keep-alive probes
+#: and `sndbuf`/`rcvbuf` set the kernel's send and receive buffer sizes in bytes.
+SOCKET_PROFILES = {
+    "default": {},
+    "low-latency": {"nodelay": True, "keepalive": True},
+    "bulk": {"nodelay": False, "keepalive": True, 
+             "sndbuf": 4 * 1024 * 1024, "rcvbuf": 4 * 1024 * 1024}
+}
+
+
+def create_tcp_rpc_system(hostname=None, port_range=(0,), ping_interval=1, ping_timeout=0.5,
+                          idle_timeout=None, max_connections=None, connections_per_peer=1,
+                          address_ttl=300, socket_profile="default", backlog=50,
+                          shared_port=None, call_metrics=False, tracer=None):
     """
     Creates a TCP based :class:`RPCSystem`.
     
     :param port_range: List of ports to try. If `[0]`, an arbitrary free
         port will be used.
+        
+    :param idle_timeout: Close connections that have not been used for
+        this many seconds. `None` to keep them open.
+        
+    :param max_connections: Maximal number of open connections. If exceeded
+        the least recently used ones are closed.
+        
+    :param connections_per_peer: Number of parallel TCP connections to 
+        open to each peer.
+        
+    :param address_ttl: Seconds we remember the IP address of a peer once
+        connected, so that further connections don't have to resolve its
+        host name. Addresses can also be provided upfront with 
+        :meth:`RPCSystem.seed_addresses`.
+        
+    :param socket_profile: Name of a profile in :data:`SOCKET_PROFILES` or a
+        dict with custom options. Applied to both accepted and opened connections.
+        The effective settings are reported per connection in the pool's stats.
+        
+    :param backlog: Number of pending connections the listening socket may queue.
+    
+    :param shared_port: Port to listen on in addition to our own, shared 
+        with other processes through `SO_REUSEPORT`. The kernel balances the 
+        connections to `hostname:shared_port` among these processes. Only 
+        functions registered under the same name in all of them (see 
+        :meth:`RPCSystem.get_function_url`) should be called there. Each process
+        keeps its own id, so all other URLs still reach the process that created them.
+        
+    :param call_metrics: Count calls and measure their latency, see 
+        :meth:`RPCSystem.call_metrics`.
+        
+    :param tracer: :class:`tracing.Tracer` for distributed tracing.
     """
+    if not isinstance(socket_profile, dict):
+        if socket_profile not in SOCKET_PROFILES:
+            raise ValueError("Unknown socket profile %s." % repr(socket_profile))
+        socket_profile = SOCKET_PROFILES[socket_profile]
+    unknown = set(socket_profile) - set(["nodelay", "keepalive", "sndbuf", "rcvbuf"])
+    if unknown:
+        raise ValueError("Unknown socket options %s." % ", ".join(sorted(unknown)))
+    
+    # `getfqdn()` may block on a DNS query. Do it only once.
+    own_fqdn = socket.getfqdn()
     
     def ownid_factory(listeningport):
         port = listeningport.getHost().port
@@ -51,16 +112,103 @@ def create_tcp_rpc_system(hostname=None, port_range=(0,), ping_interval=1, ping_
 
     def make_client_endpoint(peer):
         host, port = peer.split(":")
-        if host == socket.getfqdn():
+        if host == own_fqdn:
             host = "localhost"
+        address = pool.address_cache.get(peer)
+        if address is not None:
+            host = address
         return endpoints.TCP4ClientEndpoint(reactor, host, int(port), timeout=5)
     
     if hostname is None:
-        hostname = socket.getfqdn()
+        hostname = own_fqdn
+
+    if shared_port is not None:
+        shared_endpoint = TCP4ReusePortServerEndpoint(reactor, shared_port, backlog=backlog)
+    else:
+        shared_endpoint = None
+
+    server_endpointA = TCP4ServerRangeEndpoint(reactor, port_range, backlog=backlog)
+    pool = connectionpool.ConnectionPool(server_endpointA, make_client_endpoint, ownid_factory,
+                                         idle_timeout=idle_timeout, max_connections=max_connections,
+                                         connections_per_peer=connections_per_peer,
+                                         address_ttl=address_ttl,
+                                         shared_server_endpoint=shared_endpoint,
+                                         shared_id_factory=ownid_factory)
+    pool.configure_transport = lambda transport: _apply_socket_options(transport, socket_profile)
+    return RPCSystem(pool, ping_interval=ping_interval, ping_timeout=ping_timeout,
+                     call_metrics=call_metrics, tracer=tracer)
+
+
+def _named_function_id(name):
+    """
+    Function id of a function registered under a well-known name.
+    """
+    return uuid.uuid5(uuid.NAMESPACE_URL, "anycall:function:%s" % name)
+
+
+def _apply_socket_options(transport, options):
+    """
+    Applies the options of a socket profile to a TCP transport.
+    
+    :returns: Dict with the effective settings as reported by the socket.
+    """
+    if "nodelay" in options:
+        transport.setTcpNoDelay(options["nodelay"])
+    if "keepalive" in options:
+        transport.setTcpKeepAlive(options["keepalive"])
+        
+    sock = transport.getHandle()
+    if "sndbuf" in options:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, options["sndbuf"])
+    if "rcvbuf" in options:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, options["rcvbuf"])
+        
+    return {"nodelay": bool(transport.getTcpNoDelay()),
+            "keepalive": bool(transport.getTcpKeepAlive()),
+            "sndbuf": sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF),
+            "rcvbuf": sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)}
+
 
-    server_endpointA = TCP4ServerRangeEndpoint(reactor, port_range)
-    pool = connectionpool.ConnectionPool(server_endpointA, make_client_endpoint, ownid_factory)
-    return RPCSystem(pool, ping_interval=ping_interval, ping_timeout=ping_timeout)
+def create_shm_rpc_system(name, directory=None, capacity=shmtransport.DEFAULT_CAPACITY, 
+                          ping_interval=1, ping_timeout=0.5, call_metrics=False, tracer=None):
+    """
+    Creates a :class:`RPCSystem` for processes on the same host that
+    exchanges the packets through shared memory.
+    
+    :param name: Identification of this process. Peers use this name to
+        connect to us. Must be unique among the processes using the same
+        `directory`.
+        
+    :param directory: Where to place the UNIX sockets used to establish
+        the connections. Defaults to a `anycall` folder in the temp directory.
+        
+    :param capacity: Size of the ring buffer for each direction of a 
+        connection in bytes.
+        
+    :param call_metrics: Count calls and measure their latency, see 
+        :meth:`RPCSystem.call_metrics`.
+        
+    :param tracer: :class:`tracing.Tracer` for distributed tracing.
+    """
+    
+    if directory is None:
+        directory = os.path.join(tempfile.gettempdir(), "anycall")
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    
+    def address(peer):
+        return os.path.join(directory, "%s.sock" % peer)
+    
+    def ownid_factory(listeningport):
+        return name
+
+    def make_client_endpoint(peer):
+        return shmtransport.SHMClientEndpoint(reactor, address(peer), capacity=capacity)
+
+    server_endpoint = shmtransport.SHMServerEndpoint(reactor, address(name))
+    pool = connectionpool.ConnectionPool(server_endpoint, make_client_endpoint, ownid_factory)
+    return RPCSystem(pool, ping_interval=ping_interval, ping_timeout=ping_timeout,
+                     call_metrics=call_metrics, tracer=tracer)
 
 
 class TCP4ServerRangeEndpoint(object):
@@ -102,17 +250,62 @@ class TCP4ServerRangeEndpoint(object):
         return try_open(None)
 
 
+# Not defined by Python 2's socket module.
+_SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15 if sys.platform.startswith("linux") else 0x200)
+
+
+class TCP4ReusePortServerEndpoint(object):
+    """
+    Like a TCP4ServerEndpoint but sets `SO_REUSEPORT`, so that several
+    processes can listen on the same port.
+    """
+    def __init__(self, reactor, port, backlog=50, interface=''):
+        self.reactor = reactor
+        self.port = port
+        self.backlog = backlog
+        self.interface = interface
+        
+    def listen(self, protocolFactory):
+        return defer.execute(self._listen, protocolFactory)
+    
+    def _listen(self, protocolFactory):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setsockopt(socket.SOL_SOCKET, _SO_REUSEPORT, 1)
+            sock.bind((self.interface, self.port))
+            sock.listen(self.backlog)
+            sock.setblocking(False)
+            # The reactor uses a duplicate of the file descriptor.
+            return self.reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, protocolFactory)
+        finally:
+            sock.close()
+
+
 class RPCSystem(object):
     
     _MESSAGE_TYPE = "RPC"
     
     _PING = uuid.uuid5(uuid.NAMESPACE_URL, "ping")
     
+    _OBJECT_CALL = uuid.uuid5(uuid.NAMESPACE_URL, "object_call")
+    
+    _REFERENCES = uuid.uuid5(uuid.NAMESPACE_URL, "references")
+    
+    _BATCH = uuid.uuid5(uuid.NAMESPACE_URL, "batch")
+    
+    _RELAY = uuid.uuid5(uuid.NAMESPACE_URL, "relay")
+    
+    #: `functionid.int` of the internal functions left out of the call metrics.
+    _UNMEASURED = frozenset(functionid.int for functionid in (_PING, _REFERENCES, _RELAY))
+    
     #: Default RPCSystem. Used while unpicking function stubs.
     #: If not set unpicking stubs will fail.
     default = None
     
-    def __init__(self, connectionpool, ping_interval = 5*60, ping_timeout = 60):
+    def __init__(self, connectionpool, ping_interval = 5*60, ping_timeout = 60,
+                 object_lease = 60, gc_interval = 1, function_ttl = None, max_functions = None,
+                 max_replays = 3, call_metrics = False, tracer = None, holder_lease = 60):
         """
         :param connectionpool: Messaging system to use for low-level communication.
         
@@ -125,16 +318,47 @@ class RPCSystem(object):
            dies unexpectantly. In such cases the call might otherwise hang forever .
            
          :param ping_interval: See `ping_interval`-
+         
+        :param object_lease: Objects passed to :meth:`get_object_url` are kept alive
+           for at least `object_lease` seconds, giving peers time to create a stub
+           for them. Afterwards they are released once no peer holds a stub anymore.
+           
+        :param gc_interval: Reference count changes for remote objects are 
+           collected for `gc_interval` seconds and then sent to the owner in
+           a single message. A stub created and dropped within that time
+           causes no traffic at all.
+           
+        :param function_ttl: Functions registered with :meth:`get_function_url` are
+           removed if they have not been invoked for `function_ttl` seconds. 
+           `None` to keep them until they are unregistered.
+           
+        :param max_functions: Maximal number of registered functions. If exceeded,
+           the least recently used ones are removed. 
+           
+        :param max_replays: How often we try to send an idempotent call again
+           if the connection to the peer is lost while the call is in progress.
+           
+        :param call_metrics: Count calls and measure their latency per function
+           and peer, see :meth:`call_metrics`.
+           
+        :param tracer: :class:`tracing.Tracer` to record sampled calls and
+           the calls they cause with. `None` to disable tracing.
+           
+        :param holder_lease: Peers holding stubs for our objects renew their
+           holds every third of `holder_lease` seconds. The holds of a peer
+           that has not done so for `holder_lease` seconds, because it crashed
+           say, are dropped.
         """
         self._connectionpool = connectionpool
         self._connectionpool.register_type(self._MESSAGE_TYPE)
+        self._connectionpool.busy_peers = self._busy_peers
+        self._connectionpool.connection_lost = self._connection_lost
         
         #: If :meth:`open` has finished.
         self._opened = False
         
         #: Local functions that may be invoked from remote.
-        #: maps `functionid <-> callable`
-        self._functions = bidict.bidict()
+        self._functions = registry.FunctionRegistry(ttl=function_ttl, max_size=max_functions)
         
         #: Calls made from remote to here that are currently in progress.
         #: Maps `(peerid, callid)` -> `Deferred`.
@@ -143,13 +367,87 @@ class RPCSystem(object):
         #: Calls made from here to remote functions.
         #: Maps `(peerid, callid)` -> `Deferred`.
         self._local_to_remote = {}
+        
+        #: Calls in `_local_to_remote` that are pings. They are not pinged
+        #: themselves, the callee would not know them once answered.
+        self._pings = set()
+        
+        #: Calls in `_local_to_remote` that may be sent again.
+        #: Maps `(peerid, callid)` -> `_Call`.
+        self._replayable = {}
+        self._max_replays = max_replays
+        
+        #: Maps `(peerid, callid)` -> `IDelayedCall` for replays waiting
+        #: for the reconnect backoff to pass.
+        self._replay_timers = {}
+        
+        #: Number of calls in progress per peer. Maps `peerid -> count`.
+        self._outstanding = collections.Counter()
+        
+        #: :class:`metrics.CallMetrics` or `None` if disabled.
+        self.metrics = metrics.CallMetrics() if call_metrics else None
+        
+        #: :class:`tracing.Tracer` or `None` if disabled.
+        self.tracer = tracer
+        
+        #: :class:`profiling.Profiler` or `None` if disabled.
+        self.profiler = None
+        
+        #: :class:`events.EventRing` the messages sent and received are
+        #: recorded in, or `None` if disabled.
+        self.events = None
 
         self._ping_interval = ping_interval
         self._ping_timeout = ping_timeout
         self._ping_loop = task.LoopingCall(self._ping_loop_iteration)
         self._ping_current_iteration = None # self._ping_loop.cancel() won't cancel an ongoing call, so we use this deferred.
         
-        self._functions[self._PING] = self._ping
+        self._functions.register(self._ping, self._PING, pinned=True)
+        self._functions.register(self._object_call, self._OBJECT_CALL, pinned=True)
+        self._functions.register(self._update_references, self._REFERENCES, pinned=True)
+        self._functions.register(self._batch, self._BATCH, pinned=True)
+        self._functions.register(self._relay, self._RELAY, pinned=True)
+        
+        self._object_lease = object_lease
+        self._gc_interval = gc_interval
+        
+        #: Local objects that may be used from remote.
+        #: Maps `objectid -> object`.
+        self._objects = {}
+        
+        #: Maps `id(object) -> objectid` for all objects in `_objects`.
+        self._object_ids = {}
+        
+        #: Peers holding stubs for our objects.
+        #: Maps `objectid -> {peerid: count}`.
+        self._object_holders = {}
+        
+        #: Keeps objects alive even without holders.
+        #: Maps `objectid -> IDelayedCall`.
+        self._object_leases = {}
+        
+        #: Number of stubs we have for remote objects.
+        #: Maps `(peerid, objectid) -> count`.
+        self._references = {}
+        
+        #: Reference count changes not yet sent to the owners.
+        #: Maps `peerid -> {objectid: delta}`.
+        self._reference_deltas = {}
+        self._reference_flush = None
+        
+        #: Weak references to our stubs, keeps the weakref callbacks alive.
+        self._reference_watchers = set()
+        
+        #: When each peer in `_object_holders` last reported its holds.
+        #: Maps `peerid -> seconds`.
+        self._holder_renewed = {}
+        
+        #: Owners to send a reference message to with the next flush, even
+        #: without changes, to renew our holds.
+        self._renewals = set()
+        
+        self._holder_lease = holder_lease
+        self._holder_loop = task.LoopingCall(self._holder_loop_iteration)
         
     @property
     def connection_established(self):
@@ -170,10 +468,45 @@ class RPCSystem(object):
         100% sure of the peer's identity.
         """
         return self._connectionpool.pre_connect(peer)
+    
+    def pre_connect_many(self, peers, concurrency=50, keep_warm=False):
+        """
+        Ensures that we have open connections to many peers, opening
+        at most `concurrency` at a time.
+        
+        :param keep_warm: Reconnect in the background whenever a connection
+          to one of the peers is lost.
+        
+        :returns: Deferred with a dict mapping each given peer to 
+          `(True, peerid)` with the real peer id (see :meth:`pre_connect`) 
+          or to `(False, failure)` if we could not connect.
+        """
+        return self._connectionpool.pre_connect_many(peers, concurrency, keep_warm)
+    
+    def seed_addresses(self, addresses, ttl=None):
+        """
+        Tells us the network addresses of peers upfront, for example from
+        an inventory, so that we don't have to resolve their names when
+        we first connect.
+        
+        :param addresses: Dict mapping `peer -> address`. For TCP the address
+          is the IP of the peer's host.
+          
+        :param ttl: Seconds until the addresses are forgotten. Defaults to
+          the pool's `address_ttl`.
+        """
+        self._connectionpool.address_cache.seed(addresses, ttl)
         
     @property
     def ownid(self):
         return self._connectionpool.ownid
+    
+    @property
+    def shared_id(self):
+        """
+        Id of the port shared with other processes, or `None`.
+        """
+        return self._connectionpool.shared_id
 
     def open(self):
         """
@@ -182,6 +515,8 @@ class RPCSystem(object):
         :returns: Deferred that callbacks when we are ready to make and receive calls.
         """
         logging.debug("Opening rpc system")
+        if self.events is None and logger.isEnabledFor(logging.DEBUG):
+            self.enable_events()
         d = self._connectionpool.open(self._packet_received)
         
         def opened(_):
@@ -189,6 +524,7 @@ class RPCSystem(object):
             self._opened = True
             logging.debug("Starting ping loop")
             self._ping_loop.start(self._ping_interval, now=False)
+            self._holder_loop.start(self._holder_lease / 3.0, now=False)
         
         d.addCallback(opened)
         return d
@@ -201,47 +537,352 @@ class RPCSystem(object):
         """
         assert self._opened, "RPC System is not opened"
         logger.debug("Closing rpc system. Stopping ping loop")
+        self._opened = False
         self._ping_loop.stop()
         if self._ping_current_iteration:
             self._ping_current_iteration.cancel()
+        if self._holder_loop.running:
+            self._holder_loop.stop()
+        if self._reference_flush and self._reference_flush.active():
+            self._reference_flush.cancel()
+        self._reference_flush = None
+        for lease in self._object_leases.itervalues():
+            if lease.active():
+                lease.cancel()
+        self._object_leases.clear()
+        for timer in self._replay_timers.itervalues():
+            if timer.active():
+                timer.cancel()
+        self._replay_timers.clear()
+        self._replayable.clear()
         return self._connectionpool.close()
 
-    def get_function_url(self, function):
+    def get_function_url(self, function, weak=False, name=None):
         """
         Registers the given callable in the system (if it isn't already)
         and returns the URL that can be used to invoke the given function from remote.
+        
+        :param weak: Only keep a weak reference to the callable. The function
+          is unregistered once it is garbage collected. For bound methods
+          the reference to the instance is weak.
+          
+        :param name: Register the function under a well-known name. Processes
+          registering functions under the same name get the same function id. 
+          Such functions never expire, and their URL points to the 
+          :attr:`shared_id` if we have one, so calls go to any of the processes
+          sharing the port.
         """
         assert self._opened, "RPC System is not opened"
         logging.debug("get_function_url(%s)" % repr(function))
-        if function in ~self._functions:
-            functionid = self._functions[:function]
+        if name is not None:
+            functionid = self._functions.register(function, _named_function_id(name), weak=weak, pinned=True)
+            ownid = self._connectionpool.shared_id or self._connectionpool.ownid
         else:
-            functionid = uuid.uuid1()
-            self._functions[functionid] = function
-        return "anycall://%s/functions/%s" % (self._connectionpool.ownid, functionid.hex)
-
+            functionid = self._functions.register(function, weak=weak)
+            ownid = self._connectionpool.ownid
+        return "anycall://%s/functions/%s" % (ownid, functionid.hex)
+    
+    def unregister_function(self, function_or_url):
+        """
+        Removes a function registered with :meth:`get_function_url`, given either
+        the callable or its URL. Later calls fail with 
+        :class:`anycall.registry.FunctionExpired`.
+        
+        :returns: `True` if the function was registered.
+        """
+        if isinstance(function_or_url, basestring):
+            _, functionid = _parse_url(function_or_url, "functions", "function")
+            return self._functions.unregister(functionid)
+        return self._functions.unregister(function_or_url)
+    
+    def function_stats(self):
+        """
+        Returns a dict with the number of registered functions (`size`, `weak`) and
+        how many have been `registered`, `unregistered`, `expired`, `evicted`, or 
+        garbage `collected` so far.
+        """
+        return self._functions.stats()
+    
+    def call_metrics(self):
+        """
+        Returns the number of calls, `errors`, `cancelled` calls, calls 
+        `in_flight` and a latency histogram, per function and peer, for the
+        calls we made (`caller`) and those made to us (`callee`). See
+        :meth:`metrics.CallMetrics.snapshot`. Empty unless enabled with
+        the `call_metrics` parameter.
+        """
+        if self.metrics is None:
+            return {"caller": {}, "callee": {}}
+        return self.metrics.snapshot()
+    
+    def enable_events(self, capacity=events.DEFAULT_CAPACITY):
+        """
+        Starts recording the messages sent and received in :attr:`events`.
+        Done on :meth:`open` if this module's logger is enabled for `DEBUG`.
+        Replaces the events recorded so far, if any.
+        
+        :param capacity: Number of events to keep.
+        """
+        self.events = events.EventRing(capacity)
+        
+    def disable_events(self):
+        """
+        Stops recording events and forgets those recorded.
+        """
+        self.events = None
+    
+    def start_profiling(self, top=20):
+        """
+        Starts recording how long the calls spend pickling, unpickling,
+        waiting and executing, see :mod:`profiling`. Restarts with empty
+        statistics if profiling is on already.
+        
+        :param top: Number of slowest calls made to us to keep.
+        """
+        self.profiler = profiling.Profiler(top)
+        
+    def stop_profiling(self):
+        """
+        Stops profiling.
+        
+        :returns: The final statistics, see :meth:`profile`.
+        """
+        snapshot = self.profile()
+        self.profiler = None
+        return snapshot
+    
+    def profile(self):
+        """
+        Returns the time spent per phase of each message kind and function,
+        and the slowest calls made to us, see :meth:`profiling.Profiler.snapshot`.
+        Empty unless enabled with :meth:`start_profiling`.
+        """
+        if self.profiler is None:
+            return {"kinds": {}, "functions": {}, "slowest": []}
+        return self.profiler.snapshot()
 
-    def create_function_stub(self, url):
+    def create_function_stub(self, url, idempotent=False):
         """
         Create a callable that will invoke the given remote function.
         
         The stub will return a deferred even if the remote function does not.
+        
+        :param idempotent: If the function can safely be invoked more than
+          once for the same call. If so, calls in progress are sent again when
+          the connection to the peer is lost and re-established.
         """
         assert self._opened, "RPC System is not opened"
         logging.debug("create_function_stub(%s)" % repr(url))
-        parseresult = urlparse.urlparse(url)
-        scheme = parseresult.scheme
-        path = parseresult.path.split("/")
-        if scheme != "anycall":
-            raise ValueError("Not an anycall URL: %s" % repr(url))
-        if len(path) != 3 or path[0] != "" or path[1] != "functions":
-            raise ValueError("Not an URL for a remote function: %s" % repr(url))
-        try:
-            functionid = uuid.UUID(path[2])
-        except ValueError:
-            raise ValueError("Not a valid URL for a remote function: %s" % repr(url))
+        peerid, functionid = _parse_url(url, "functions", "function")
+        return _RPCFunctionStub(peerid, functionid, self, idempotent)
+    
+    def create_replica_stub(self, urls, idempotent=False, choices=2, eject_time=5):
+        """
+        Create a callable that invokes one of several equivalent remote functions,
+        the one on the peer with the fewest calls in progress.
+        
+        :param urls: URLs of the replicas.
+        
+        :param idempotent: See :meth:`create_function_stub`. Calls that fail
+          because a replica is unreachable are also retried on another replica.
+        
+        :param choices: Only compare the load of this many randomly chosen
+          replicas (power-of-two-choices). `None` to compare all of them.
+          
+        :param eject_time: Seconds a replica is skipped after a call to it failed
+          because it was unreachable (unless all replicas are skipped).
+        """
+        assert self._opened, "RPC System is not opened"
+        logging.debug("create_replica_stub(%s)" % repr(urls))
+        replicas = [_parse_url(url, "functions", "function") for url in urls]
+        if not replicas:
+            raise ValueError("Need at least one replica.")
+        return _RPCReplicaStub(replicas, self, idempotent, choices, eject_time)
+    
+    def create_sharded_stub(self, urls, key=None, vnodes=100, weights=None, idempotent=False):
+        """
+        Create a callable that invokes one of several remote functions,
+        chosen by consistent hashing of a key derived from the call's arguments.
+        
+        :param urls: URLs of the shards' functions.
+        
+        :param key: Returns the key when invoked with the call's arguments.
+          Defaults to the first positional argument.
+          
+        :param vnodes: Points per shard on the hash ring, see :class:`anycall.hashring.HashRing`.
+        
+        :param weights: Optional dict mapping URLs to their relative share of the keys.
+        
+        :param idempotent: See :meth:`create_function_stub`.
+        """
+        assert self._opened, "RPC System is not opened"
+        logging.debug("create_sharded_stub(%s)" % repr(urls))
+        stub = _RPCShardedStub(self, key, vnodes, idempotent)
+        weights = weights or {}
+        for url in urls:
+            stub.add_shard(url, weights.get(url, 1))
+        return stub
+    
+    def broadcast(self, urls, args=(), kwargs=None, wait="all", timeout=None, idempotent=False):
+        """
+        Invokes the functions with the given URLs, all with the same arguments.
+        The arguments are pickled only once.
+        
+        :param wait: `"all"` to wait for all calls to complete, or how many
+          have to succeed: `"quorum"` (more than half) or a number. Once 
+          reached (or no longer reachable) the calls still in progress are cancelled.
+          
+        :param timeout: Seconds after which a call is cancelled and counted 
+          as failed with a :class:`twisted.internet.error.TimeoutError`.
+          
+        :param idempotent: See :meth:`create_function_stub`.
+        
+        :returns: Deferred calling back with a tuple `(results, failures)` 
+          of dicts mapping the URLs to the return values or failures. Calls 
+          cancelled because enough have succeeded are in neither.
+        """
+        assert self._opened, "RPC System is not opened"
+        kwargs = kwargs or {}
+        targets = [(url, _parse_url(url, "functions", "function")) for url in urls]
+        if wait == "all":
+            needed = None
+        elif wait == "quorum":
+            needed = len(targets) // 2 + 1
+        else:
+            needed = wait
+        
+        payload = pickle.dumps((args, kwargs), pickle.HIGHEST_PROTOCOL)
+        
+        results = {}
+        failures = {}
         
-        return _RPCFunctionStub(parseresult.netloc, functionid, self)
+        #: Maps `url -> deferred` of the calls in progress.
+        calls = {}
+        state = {"started": False, "finished": False}
+        done = defer.Deferred()
+        
+        def check():
+            if not state["started"] or state["finished"]:
+                return
+            if needed is None:
+                complete = not calls
+            else:
+                complete = len(results) >= needed or len(results) + len(calls) < needed
+            if complete:
+                state["finished"] = True
+                for d in calls.values():
+                    d.cancel()
+                done.callback((results, failures))
+        
+        def call(url, peerid, functionid):
+            d = self._invoke_function(peerid, functionid, args, kwargs, idempotent, payload=payload)
+            calls[url] = d
+            timed_out = []
+            
+            if timeout is not None:
+                def expire():
+                    timed_out.append(True)
+                    d.cancel()
+                timer = reactor.callLater(timeout, expire)  # @UndefinedVariable
+            else:
+                timer = None
+                
+            def completed(result):
+                if timer is not None and timer.active():
+                    timer.cancel()
+                calls.pop(url, None)
+                if state["finished"]:
+                    return
+                if not isinstance(result, Failure):
+                    results[url] = result
+                elif timed_out:
+                    failures[url] = Failure(error.TimeoutError("No reply within %ss." % timeout))
+                else:
+                    failures[url] = result
+                check()
+            d.addBoth(completed)
+            
+        for url, (peerid, functionid) in targets:
+            call(url, peerid, functionid)
+        state["started"] = True
+        check()
+        return done
+    
+    def relay_broadcast(self, urls, args=(), kwargs=None, fanout=8, combiner=None, timeout=None):
+        """
+        Like :meth:`broadcast`, but the calls are relayed along a tree: we
+        call `fanout` peers, each of which calls up to `fanout` further peers, 
+        and so on. This way we send `fanout` instead of `len(urls)` requests.
+        
+        :param combiner: Reduces the results on their way back. Is invoked with
+          a list of results (or of already combined results) and returns the 
+          combined result. It is pickled, so it must be importable on all peers, 
+          for example a module-level function. If `None` the results are 
+          collected in a dict mapping the URLs to the return values.
+          
+        :param timeout: Seconds we wait for each subtree. Each peer waits 80% of 
+          its own timeout for its children, so that partial results still
+          reach us.
+        
+        :returns: Deferred calling back with a tuple `(result, failures)`. 
+          `result` is the combined result (`None` if there is none) or the 
+          dict of results. `failures` maps URLs to failures. If a relaying peer
+          cannot be reached, all URLs of its subtree are in `failures`.
+        """
+        assert self._opened, "RPC System is not opened"
+        payload = pickle.dumps((args, kwargs or {}), pickle.HIGHEST_PROTOCOL)
+        d = self._relay_children(list(urls), payload, fanout, combiner, timeout)
+        
+        def done(reduced):
+            result, failures = reduced
+            if combiner is not None:
+                result = result[0] if result else None
+            failures = dict((url, Failure(e)) for url, e in failures.iteritems())
+            return result, failures
+        d.addCallback(done)
+        return d
+    
+    def outstanding_calls(self, peerid):
+        """
+        Number of calls to the given peer that are in progress.
+        """
+        return self._outstanding.get(peerid, 0)
+    
+    def peer_stats(self, peerid=None):
+        """
+        Traffic statistics per peer, see :meth:`connectionpool.ConnectionPool.peer_stats`.
+        """
+        return self._connectionpool.peer_stats(peerid)
+    
+    def get_object_url(self, obj):
+        """
+        Registers the given object in the system (if it isn't already)
+        and returns the URL that can be used to invoke its methods from remote.
+        
+        The object is kept alive as long as there are stubs for it, but at least
+        for `object_lease` seconds after the last call of this method.
+        """
+        assert self._opened, "RPC System is not opened"
+        logging.debug("get_object_url(%s)" % repr(obj))
+        objectid = self._object_ids.get(id(obj), None)
+        if objectid is None:
+            objectid = uuid.uuid1()
+            self._objects[objectid] = obj
+            self._object_ids[id(obj)] = objectid
+        self._renew_lease(objectid, self._object_lease)
+        return "anycall://%s/objects/%s" % (self._connectionpool.ownid, objectid.hex)
+    
+    def create_object_stub(self, url):
+        """
+        Create a proxy for the given remote object. Calling a method of the 
+        proxy invokes the method of the remote object and returns a deferred.
+        
+        Only public methods (not starting with an underscore) can be invoked.
+        """
+        assert self._opened, "RPC System is not opened"
+        logging.debug("create_object_stub(%s)" % repr(url))
+        peerid, objectid = _parse_url(url, "objects", "object")
+        return _RPCObjectStub(peerid, objectid, self)
     
     def create_local_function_stub(self, func):
         assert self._opened, "RPC System is not opened"
@@ -250,27 +891,72 @@ class RPCSystem(object):
         url = self.get_function_url(func)
         return self.create_function_stub(url)
         
-    def _send(self, peer, obj):
-        logger.debug("Sending %r to %s." % (peer, obj))
+    def _send(self, peer, obj, affinity=None, functionid=None, profile=None):
+        """
+        :param functionid: Function the message belongs to, for profiling.
+        
+        :param profile: :class:`profiling.CallProfile` of the call this
+          message replies to.
+        """
+        if self.events is not None:
+            self.events.record(_MESSAGE_EVENTS[type(obj)][0], peer, obj.callid,
+                               functionid if functionid is not None else getattr(obj, "functionid", None))
+        if self.profiler is not None:
+            return self._send_profiled(self.profiler, peer, obj, affinity, functionid, profile)
         try:
             msg = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
         except:
             logger.exception("Pickling of the value %r has failed." % obj)
             raise
                 
-        return self._connectionpool.send(peer, self._MESSAGE_TYPE, msg)
+        return self._connectionpool.send(peer, self._MESSAGE_TYPE, msg, affinity=affinity)
+    
+    def _send_profiled(self, profiler, peer, obj, affinity, functionid, profile):
+        kind = _MESSAGE_KINDS[type(obj)]
+        if isinstance(obj, _Call):
+            functionid = obj.functionid
+        clock = profiler.clock
+        
+        start = clock()
+        try:
+            msg = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        except:
+            logger.exception("Pickling of the value %r has failed." % obj)
+            raise
+        pickled = clock()
+        d = self._connectionpool.send(peer, self._MESSAGE_TYPE, msg, affinity=affinity)
+        framed = clock()
+        
+        profiler.record(kind, functionid, "pickle", pickled - start)
+        profiler.record(kind, functionid, "frame", framed - pickled)
+        if profile is not None:
+            profile.replied(pickled - start, len(msg))
+        
+        def sent(result):
+            profiler.record(kind, functionid, "send_queue", clock() - framed)
+            if profile is not None:
+                profile.finish()
+            return result
+        d.addCallback(sent)
+        return d
     
     def _packet_received(self, peerid, typename, data):
         try:
             if typename != self._MESSAGE_TYPE:
                 raise ValueError("Received unexpected packet type:%s" % typename)
             
-            obj = pickle.loads(data)
+            if self.profiler is None:
+                obj = pickle.loads(data)
+                profile = None
+            else:
+                obj, profile = self._unpickle_profiled(self.profiler, peerid, data)
     
-            logger.debug("Received %r from %s" % (obj, peerid))
+            if self.events is not None and type(obj) in _MESSAGE_EVENTS:
+                self.events.record(_MESSAGE_EVENTS[type(obj)][1], peerid, obj.callid, 
+                                   getattr(obj, "functionid", None))
             
             if isinstance(obj, _Call):
-                self._Call_received(peerid, obj)
+                self._Call_received(peerid, obj, profile)
             elif isinstance(obj, _CallReturn):
                 self._CallReturn_received(peerid, obj)
             elif isinstance(obj, _CallFail):
@@ -281,24 +967,72 @@ class RPCSystem(object):
                 raise ValueError("Received unknown object type")
         except:
             logger.exception("error while receiving package from %r" %(peerid))
+            
+    def _unpickle_profiled(self, profiler, peerid, data):
+        """
+        :returns: `(obj, profile)` with the :class:`profiling.CallProfile`
+          if `obj` is a call, `None` otherwise.
+        """
+        start = profiler.clock()
+        obj = pickle.loads(data)
+        if isinstance(obj, _PackedCall):
+            # Unpickle the arguments now rather than on invocation.
+            obj._unpack()
+        unpickle = profiler.clock() - start
+        
+        if not isinstance(obj, _Call):
+            profiler.record(_MESSAGE_KINDS.get(type(obj), None), None, "unpickle", unpickle)
+            return obj, None
+        profiler.record("call", obj.functionid, "unpickle", unpickle)
+        profile = profiling.CallProfile(profiler, obj.functionid, peerid, len(data), start, unpickle)
+        return obj, profile
 
-    def _Call_received(self, peerid, obj):
-        if obj.functionid not in self._functions:
-            raise ValueError("Call for unregistered function.")
+    def _Call_received(self, peerid, obj, profile=None):
+        if (peerid, obj.callid) in self._remote_to_local:
+            # The caller replayed the call after a reconnect, but we
+            # are still working on it.
+            if self.events is not None:
+                self.events.record(events.DUPLICATE_CALL, peerid, obj.callid, obj.functionid)
+            return
         
-        func = self._functions[obj.functionid]
+        try:
+            func = self._functions.lookup(obj.functionid)
+        except ValueError as e:
+            # Fail the call right away instead of letting the caller wait.
+            logger.warn("Call %r from %s for unavailable function: %s" % (obj.callid, peerid, e))
+            d = self._send(peerid, _CallFail(obj.callid, e))
+            d.addErrback(lambda failure: logger.error(str(failure)))
+            return
         
-        logger.debug("Invoking %r for peer %s." % (func, peerid))
-        d = defer.maybeDeferred(func, *obj.args, **obj.kwargs)
+        span = None
+        if obj.trace is not None and self.tracer is not None:
+            span = self.tracer.start_server(obj.trace, obj.functionid, peerid)
+        
+        measured = self.metrics is not None and obj.functionid.int not in self._UNMEASURED
+        if measured:
+            token = self.metrics.started(self.metrics.callee, obj.functionid, peerid)
+        if profile is not None:
+            profile.dispatched()
+        if span is not None:
+            self.tracer.mark(span, "execute_start")
+            with tracing.activate(span):
+                d = defer.maybeDeferred(func, *obj.args, **obj.kwargs)
+        else:
+            d = defer.maybeDeferred(func, *obj.args, **obj.kwargs)
+        if measured:
+            d.addBoth(self.metrics.finished, token)
+        if profile is not None:
+            d.addBoth(profile.executed)
+        if span is not None:
+            d.addBoth(_trace_executed, self.tracer, span)
         
         self._remote_to_local[(peerid, obj.callid)] = d
         
         def on_success(retval):
             if (peerid, obj.callid) in self._remote_to_local:
-                logger.debug("Call to %r successful." % func)
-                
                 try:
-                    retval = self._send(peerid, _CallReturn(obj.callid, retval))
+                    retval = self._send(peerid, _CallReturn(obj.callid, retval),
+                                        functionid=obj.functionid, profile=profile)
                     del self._remote_to_local[(peerid, obj.callid)]
                     return retval
                 except PicklingError:
@@ -307,11 +1041,13 @@ class RPCSystem(object):
             
         def on_fail(failure):
             if (peerid, obj.callid) in self._remote_to_local:
-                logger.debug("Failed call to %r: %r" % (func, failure))
                 del self._remote_to_local[(peerid, obj.callid)]
-                return self._send(peerid, _CallFail(obj.callid, failure))
+                return self._send(peerid, _CallFail(obj.callid, failure),
+                                  functionid=obj.functionid, profile=profile)
         
         d.addCallbacks(on_success, on_fail)
+        if span is not None:
+            d.addBoth(lambda result: self.tracer.finish(span, "reply", result))
         
         def uncought(failure):
             logger.error(str(failure))
@@ -322,7 +1058,9 @@ class RPCSystem(object):
         try:
             d = self._local_to_remote.pop((peerid, obj.callid))
         except KeyError:
-            raise ValueError("Received return value for non-existent call.")
+            # Cancelled, the reply was already on its way.
+            logger.debug("Received return value for unknown call %r from %r." % (obj.callid, peerid))
+            return
         if not twistit.has_result(d):
             d.callback(obj.retval)
         else:
@@ -333,8 +1071,9 @@ class RPCSystem(object):
         try:
             d = self._local_to_remote.pop((peerid, obj.callid))
         except KeyError:
-            raise ValueError("Received failure for non-existent call.")
-        logging.debug("Received call failure: %s", repr(obj.failure))
+            # Cancelled, the reply was already on its way.
+            logger.debug("Received failure for unknown call %r from %r." % (obj.callid, peerid))
+            return
         if not twistit.has_result(d):
             d.errback(obj.failure)
         
@@ -347,11 +1086,44 @@ class RPCSystem(object):
             # We have sent the result already.
             pass
         
-    def _invoke_function(self, peerid, functionid, args, kwargs):
+    def _invoke_function(self, peerid, functionid, args, kwargs, idempotent=False, payload=None,
+                         affinity=None):
+        """
+        :param payload: `(args, kwargs)` already pickled. Used instead of
+          `args` and `kwargs` when sending the call to a remote peer.
+          
+        :param affinity: Affinity key of the call this one pings, to send
+          it over the same connection. Only used for pings.
+        """
+        
+        self._outstanding[peerid] += 1
+        measured = self.metrics is not None and functionid.int not in self._UNMEASURED
+        if measured:
+            token = self.metrics.started(self.metrics.caller, functionid, peerid)
+        released = []
+        def release(result):
+            if not released:
+                released.append(True)
+                self._outstanding[peerid] -= 1
+                if not self._outstanding[peerid]:
+                    del self._outstanding[peerid]
+                if measured:
+                    self.metrics.finished(result, token)
         
         if peerid == self.ownid:
-            function = self._functions[functionid]
-            return defer.maybeDeferred(function, *args, **kwargs)
+            try:
+                function = self._functions.lookup(functionid)
+            except ValueError:
+                failure = Failure()
+                release(failure)
+                return defer.fail(failure)
+            
+            def local_completed(result):
+                release(result)
+                return result
+            d = defer.maybeDeferred(function, *args, **kwargs)
+            d.addBoth(local_completed)
+            return d
         
         def canceller(d):
             if (peerid, callid) in self._local_to_remote:
@@ -359,11 +1131,21 @@ class RPCSystem(object):
                 def uncought(failure):
                     logger.error(str(failure))
                 
-                d = self._send(peerid, _CallCancel(callid))
+                d = self._send(peerid, _CallCancel(callid), affinity=send_affinity, functionid=functionid)
                 d.addErrback(uncought)
         
         callid = uuid.uuid1()
-        call = _Call(callid, functionid, args, kwargs)
+        send_affinity = callid if affinity is None else affinity
+        if payload is not None:
+            call = _PackedCall(callid, functionid, payload)
+        else:
+            call = _Call(callid, functionid, args, kwargs)
+        
+        span = None
+        if self.tracer is not None and functionid != self._PING:
+            span = self.tracer.start_client(functionid, peerid)
+            if span is not None:
+                call.trace = (span.trace_id, span.span_id)
         
         # We want to have `_local_to_remote` set before
         # we call `_send`. Just in case we get an answer
@@ -372,14 +1154,44 @@ class RPCSystem(object):
         # on if the send operation has failed.
         d = defer.Deferred(canceller)
         self._local_to_remote[(peerid, callid)] = d
+        if affinity is not None:
+            self._pings.add((peerid, callid))
+        if idempotent:
+            self._replayable[(peerid, callid)] = call
+        
+        def call_completed(result):
+            # The call might have been cancelled, in which case there
+            # will be no reply that would remove it.
+            self._local_to_remote.pop((peerid, callid), None)
+            self._forget_replay(peerid, callid)
+            if affinity is None:
+                self._connectionpool.forget_affinity(peerid, callid)
+            else:
+                self._pings.discard((peerid, callid))
+            release(result)
+            if span is not None:
+                self.tracer.finish(span, "reply", result)
+            return result
+        d.addBoth(call_completed)
         
-        d_send = self._send(peerid, call)
+        # The call and a later cancel have to arrive in order.
+        d_send = self._send(peerid, call, affinity=send_affinity)
         
         def send_success(_):
+            if span is not None:
+                self.tracer.mark(span, "send")
             return d
         
         def send_failed(failure):
             del self._local_to_remote[(peerid, callid)]
+            self._forget_replay(peerid, callid)
+            if affinity is None:
+                self._connectionpool.forget_affinity(peerid, callid)
+            else:
+                self._pings.discard((peerid, callid))
+            release(failure)
+            if span is not None:
+                self.tracer.finish(span, "send", failure)
             return failure
         
         d_send.addCallbacks(send_success, send_failed)
@@ -391,27 +1203,29 @@ class RPCSystem(object):
         Invokes `_ping()` remotely for every ongoing call.
         """
         
+        if self.metrics is not None:
+            # Keeps the bucketing of the latencies off the call path.
+            self.metrics.fold()
+        
         deferredList = []
         
         for peerid, callid in list(self._local_to_remote):
             
-            if (peerid, callid) not in self._local_to_remote:
-                continue # call finished in the meantime
+            if (peerid, callid) not in self._local_to_remote or (peerid, callid) in self._pings:
+                continue # call finished in the meantime, or is a ping
             
-            logger.debug("sending ping")
-            d = self._invoke_function(peerid, self._PING, (self._connectionpool.ownid, callid), {})
+            # Over the connection of the call, so that the ping reaches the
+            # same process even if `peerid` is shared by several.
+            d = self._invoke_function(peerid, self._PING, (self._connectionpool.ownid, callid), {},
+                                      affinity=callid)
             #twistit.timeout_deferred(d, self._ping_timeout, "Lost communication to peer during call.")
             
-            def failed(failure):
+            def failed(failure, peerid, callid):
                 if (peerid, callid) in self._local_to_remote:
                     d = self._local_to_remote.pop((peerid, callid))
                     d.errback(failure)
                     
-            def success(value):
-                logger.debug("received pong")
-                return value
-                    
-            d.addCallbacks(success, failed)
+            d.addErrback(failed, peerid, callid)
             deferredList.append(d)
    
         d = defer.DeferredList(deferredList)
@@ -422,21 +1236,316 @@ class RPCSystem(object):
         d.addBoth(done)
         return d
     
+    def _object_call(self, objectid, method, args, kwargs):
+        """
+        Called from remote to invoke a method of an exported object.
+        """
+        obj = self._objects.get(objectid, None)
+        if obj is None:
+            raise ValueError("Call for unknown or released object.")
+        if method.startswith("_"):
+            raise ValueError("Cannot invoke non-public method %s." % repr(method))
+        return getattr(obj, method)(*args, **kwargs)
+    
+    def _renew_lease(self, objectid, duration):
+        lease = self._object_leases.pop(objectid, None)
+        if lease and lease.active():
+            lease.cancel()
+        self._object_leases[objectid] = reactor.callLater(duration, self._lease_expired, objectid)  # @UndefinedVariable
+    
+    def _lease_expired(self, objectid):
+        del self._object_leases[objectid]
+        if not self._object_holders.get(objectid):
+            logger.debug("Releasing object %s." % objectid)
+            obj = self._objects.pop(objectid, None)
+            self._object_ids.pop(id(obj), None)
+            self._object_holders.pop(objectid, None)
+    
+    def _batch(self, functionid, calls):
+        """
+        Called from remote to invoke a function for each `(args, kwargs)` in `calls`.
+        
+        Returns a list with `(True, result)` or `(False, exception)` per call.
+        """
+        function = self._functions.lookup(functionid)
+        ds = [defer.maybeDeferred(function, *args, **kwargs) for args, kwargs in calls]
+        d = defer.DeferredList(ds, consumeErrors=True)
+        
+        def done(results):
+            return [(success, value if success else _picklable_exception(value))
+                    for success, value in results]
+        d.addCallback(done)
+        return d
+    
+    def _relay(self, url, subtree, payload, fanout, combiner, timeout):
+        """
+        Called from remote to invoke our function with the given URL and
+        relay the call to the `subtree` URLs.
+        
+        Returns `(result, failures)` where `result` is a dict `url -> value`
+        if there is no `combiner`, or a list with the combined value (or an
+        empty list). `failures` maps URLs to exceptions.
+        """
+        if timeout is not None:
+            timeout *= 0.8
+        
+        # Whatever goes wrong here only fails `url`, not the subtree.
+        try:
+            _, functionid = _parse_url(url, "functions", "function")
+            args, kwargs = pickle.loads(payload)
+            function = self._functions.lookup(functionid)
+        except:
+            d_local = defer.fail()
+        else:
+            d_local = defer.maybeDeferred(function, *args, **kwargs)
+            if timeout is not None:
+                timer = reactor.callLater(timeout, d_local.cancel)  # @UndefinedVariable
+                d_local.addBoth(_cancel_timer, timer)
+        
+        d_children = self._relay_children(subtree, payload, fanout, combiner, timeout)
+        
+        d = defer.DeferredList([d_local, d_children])
+        
+        def done(results):
+            (local_success, local_value), (_, (result, failures)) = results
+            if not local_success:
+                if local_value.check(defer.CancelledError):
+                    local_value = Failure(error.TimeoutError("No reply within %ss." % timeout))
+                failures[url] = _picklable_exception(local_value)
+            elif combiner is None:
+                result[url] = local_value
+            else:
+                result = [combiner(result + [local_value])]
+            return result, failures
+        d.addCallback(done)
+        return d
+    
+    def _relay_children(self, urls, payload, fanout, combiner, timeout):
+        """
+        Splits `urls` into `fanout` subtrees and relays the call to the
+        first peer of each.
+        """
+        if not urls:
+            return defer.succeed(({} if combiner is None else [], {}))
+        
+        size = -(-len(urls) // fanout)
+        subtrees = [urls[i:i + size] for i in range(0, len(urls), size)]
+        
+        ds = []
+        for subtree in subtrees:
+            url = subtree[0]
+            peerid, _ = _parse_url(url, "functions", "function")
+            d = self._invoke_function(peerid, self._RELAY, 
+                                      (url, subtree[1:], payload, fanout, combiner, timeout), {})
+            if timeout is not None:
+                timer = reactor.callLater(timeout, d.cancel)  # @UndefinedVariable
+                d.addBoth(_cancel_timer, timer)
+            ds.append(d)
+        
+        d = defer.DeferredList(ds)
+        
+        def done(children):
+            result = {} if combiner is None else []
+            failures = {}
+            for subtree, (success, value) in zip(subtrees, children):
+                if success:
+                    child_result, child_failures = value
+                    failures.update(child_failures)
+                    if combiner is None:
+                        result.update(child_result)
+                    else:
+                        result.extend(child_result)
+                else:
+                    if value.check(defer.CancelledError):
+                        value = Failure(error.TimeoutError("No reply within %ss." % timeout))
+                    e = _picklable_exception(value)
+                    for url in subtree:
+                        failures[url] = e
+            if combiner is not None and len(result) > 1:
+                result = [combiner(result)]
+            return result, failures
+        d.addCallback(done)
+        return d
+    
+    def _update_references(self, peerid, deltas):
+        """
+        Called from remote with the changes in the number of stubs
+        `peerid` holds for our objects. Renews all holds of `peerid`,
+        even if `deltas` is empty.
+        """
+        self._holder_renewed[peerid] = reactor.seconds()  # @UndefinedVariable
+        for objectid, delta in deltas.iteritems():
+            if objectid not in self._objects:
+                continue
+            holders = self._object_holders.setdefault(objectid, {})
+            count = holders.get(peerid, 0) + delta
+            if count > 0:
+                holders[peerid] = count
+            else:
+                holders.pop(peerid, None)
+            if not holders:
+                self._unheld(objectid)
+                
+    def _unheld(self, objectid):
+        """
+        Called when the last peer stopped holding `objectid`.
+        """
+        if objectid not in self._object_leases:
+            # A stub might be in transit to another peer which
+            # has not yet reported it. Give it some time.
+            self._renew_lease(objectid, 3 * self._gc_interval)
+            
+    def _holder_loop_iteration(self):
+        """
+        Called every third of `holder_lease`. Renews our holds on remote
+        objects and drops the holds of peers that did not renew theirs.
+        """
+        for peerid, _ in self._references:
+            if peerid != self.ownid:
+                self._renewals.add(peerid)
+        if self._renewals:
+            self._schedule_reference_flush()
+        
+        deadline = reactor.seconds() - self._holder_lease  # @UndefinedVariable
+        expired = set(peerid for peerid, renewed in self._holder_renewed.iteritems() 
+                      if renewed < deadline and peerid != self.ownid)
+        if not expired:
+            return
+        for peerid in expired:
+            del self._holder_renewed[peerid]
+            logger.warn("Peer %s did not renew its object stubs. Dropping them." % peerid)
+        for objectid, holders in self._object_holders.items():
+            if expired.intersection(holders):
+                for peerid in expired:
+                    holders.pop(peerid, None)
+                if not holders:
+                    self._unheld(objectid)
+    
+    def _acquire_reference(self, stub):
+        """
+        Called for every new stub of a remote object.
+        """
+        key = (stub.peerid, stub.objectid)
+        count = self._references.get(key, 0)
+        self._references[key] = count + 1
+        if count == 0:
+            self._queue_reference_delta(stub.peerid, stub.objectid, 1)
+        
+        def stub_released(watcher):
+            self._reference_watchers.discard(watcher)
+            self._release_reference(key)
+        
+        self._reference_watchers.add(weakref.ref(stub, stub_released))
+        
+    def _release_reference(self, key):
+        count = self._references[key] - 1
+        if count:
+            self._references[key] = count
+        else:
+            del self._references[key]
+            self._queue_reference_delta(key[0], key[1], -1)
+    
+    def _queue_reference_delta(self, peerid, objectid, delta):
+        deltas = self._reference_deltas.setdefault(peerid, {})
+        deltas[objectid] = deltas.get(objectid, 0) + delta
+        self._schedule_reference_flush()
+        
+    def _schedule_reference_flush(self):
+        if self._reference_flush is None and self._opened:
+            self._reference_flush = reactor.callLater(self._gc_interval, self._flush_references)  # @UndefinedVariable
+    
+    def _flush_references(self):
+        """
+        Sends the collected reference count changes, one message per owner.
+        """
+        self._reference_flush = None
+        reference_deltas = self._reference_deltas
+        self._reference_deltas = {}
+        renewals = self._renewals
+        self._renewals = set()
+        
+        def uncought(failure):
+            logger.error(str(failure))
+        
+        for peerid in renewals.union(reference_deltas):
+            deltas = reference_deltas.get(peerid, {})
+            deltas = dict((objectid, delta) for objectid, delta in deltas.iteritems() if delta)
+            if not deltas and peerid not in renewals:
+                continue
+            if peerid == self.ownid:
+                self._update_references(peerid, deltas)
+            else:
+                d = self._invoke_function(peerid, self._REFERENCES, (self.ownid, deltas), {})
+                d.addErrback(uncought)
+    
+    def _connection_lost(self, peerid):
+        """
+        Called when the last connection to a peer is closed.
+        Sends the idempotent calls in progress again.
+        """
+        for (p, callid), call in self._replayable.items():
+            if p == peerid and (p, callid) not in self._replay_timers:
+                self._replay(peerid, call, self._max_replays)
+        
+        # Pings are answered right away, so the connection took any
+        # outstanding ones with it. The ping loop tries again, and must
+        # not wait for them forever.
+        for key in [key for key in self._pings if key[0] == peerid]:
+            d = self._local_to_remote.pop(key, None)
+            if d is not None and not twistit.has_result(d):
+                d.callback(None)
+    
+    def _replay(self, peerid, call, attempts):
+        key = (peerid, call.callid)
+        self._replay_timers.pop(key, None)
+        if key not in self._replayable:
+            return
+        
+        logger.debug("Replaying call %r to %s." % (call.callid, peerid))
+        d = self._send(peerid, call, affinity=call.callid)
+        
+        def failed(failure):
+            if key not in self._replayable:
+                return
+            if attempts > 1:
+                delay = self._connectionpool.retry_delay(peerid)
+                self._replay_timers[key] = reactor.callLater(delay, self._replay, peerid, call, attempts - 1)  # @UndefinedVariable
+            elif key in self._local_to_remote:
+                self._local_to_remote[key].errback(failure)
+        d.addErrback(failed)
+    
+    def _forget_replay(self, peerid, callid):
+        self._replayable.pop((peerid, callid), None)
+        timer = self._replay_timers.pop((peerid, callid), None)
+        if timer is not None and timer.active():
+            timer.cancel()
+    
+    def _busy_peers(self):
+        """
+        Returns the peers with calls in progress in either direction.
+        """
+        busy = set(peerid for peerid, _ in self._local_to_remote)
+        busy.update(peerid for peerid, _ in self._remote_to_local)
+        return busy
+    
     def _ping(self, peerid, callid):
         """
         Called from remote to ask if a call made to here is still in progress.
+        Fails if not, for example because the process that ran it has died
+        and `peerid` reconnected to another one sharing its port.
         """
         if not (peerid, callid) in self._remote_to_local:
-            logger.warn("No remote call %s from %s. Might just be unfoutunate timing." % (callid, peerid))
+            raise ValueError("No call %s from %s in progress." % (callid, peerid))
 
 class _RPCFunctionStub(object):
-    def __init__(self, peerid, functionid, rpcsystem):
+    def __init__(self, peerid, functionid, rpcsystem, idempotent=False):
         self.peerid = peerid
         self.functionid = functionid
         self.rpcsystem = rpcsystem
+        self.idempotent = idempotent
     
     def __call__(self, *args, **kwargs):
-        d = self.rpcsystem._invoke_function(self.peerid, self.functionid, args, kwargs)
+        d = self.rpcsystem._invoke_function(self.peerid, self.functionid, args, kwargs, self.idempotent)
         return d
     
     def __repr__(self):
@@ -457,7 +1566,8 @@ class _RPCFunctionStub(object):
     def __getstate__(self):
         return {
                 "peerid":self.peerid,
-                "functionid":self.functionid
+                "functionid":self.functionid,
+                "idempotent":self.idempotent
         }
         
     def __setstate__(self, state):
@@ -466,9 +1576,258 @@ class _RPCFunctionStub(object):
             raise ValueError("Cannot unpickle function stubs without RPCSystem.default set.")
         self.peerid = state["peerid"]
         self.functionid = state["functionid"]
+        self.idempotent = state.get("idempotent", False)
+        self.rpcsystem = rpcsystem
+
+#: Failures that indicate that a replica is unreachable rather than
+#: that the function raised an exception.
+_UNREACHABLE_ERRORS = (error.ConnectError, 
+                       error.ConnectionClosed,
+                       connectionpool.PeerUnavailable,
+                       connectionpool.SendQueueFull,
+                       registry.FunctionExpired)
+
+
+class _RPCReplicaStub(object):
+    def __init__(self, replicas, rpcsystem, idempotent=False, choices=2, eject_time=5):
+        self.replicas = list(replicas)
+        self.rpcsystem = rpcsystem
+        self.idempotent = idempotent
+        self.choices = choices
+        self.eject_time = eject_time
+        
+        #: Maps `(peerid, functionid) -> time` until which the replica is skipped.
+        self._ejected = {}
+        
+    def __call__(self, *args, **kwargs):
+        return self._invoke(args, kwargs, set())
+    
+    def _invoke(self, args, kwargs, tried):
+        replica = self._select(tried)
+        peerid, functionid = replica
+        d = self.rpcsystem._invoke_function(peerid, functionid, args, kwargs, self.idempotent)
+        
+        def failed(failure):
+            if not failure.check(*_UNREACHABLE_ERRORS):
+                return failure
+            logger.debug("Ejecting replica %s for %ss." % (peerid, self.eject_time))
+            self._ejected[replica] = reactor.seconds() + self.eject_time  # @UndefinedVariable
+            tried.add(replica)
+            if self.idempotent and len(tried) < len(self.replicas):
+                return self._invoke(args, kwargs, tried)
+            return failure
+        d.addErrback(failed)
+        return d
+    
+    def _select(self, tried):
+        now = reactor.seconds()  # @UndefinedVariable
+        for replica, until in self._ejected.items():
+            if until <= now:
+                del self._ejected[replica]
+                
+        candidates = [r for r in self.replicas if r not in tried and r not in self._ejected]
+        if not candidates:
+            candidates = [r for r in self.replicas if r not in tried] or self.replicas
+        if self.choices is not None and len(candidates) > self.choices:
+            candidates = random.sample(candidates, self.choices)
+        return min(candidates, key=lambda r: (self.rpcsystem.outstanding_calls(r[0]), random.random()))
+    
+    def __repr__(self):
+        return "RPCReplicaStub(%r)" % (self.replicas,)
+    
+    def __getstate__(self):
+        return {
+                "replicas":self.replicas,
+                "idempotent":self.idempotent,
+                "choices":self.choices,
+                "eject_time":self.eject_time
+        }
+        
+    def __setstate__(self, state):
+        rpcsystem = RPCSystem.default
+        if rpcsystem is None:
+            raise ValueError("Cannot unpickle function stubs without RPCSystem.default set.")
+        self.__init__(state["replicas"], rpcsystem, state["idempotent"], 
+                      state["choices"], state["eject_time"])
+
+
+class _RPCShardedStub(object):
+    def __init__(self, rpcsystem, key=None, vnodes=100, idempotent=False):
+        self.rpcsystem = rpcsystem
+        self.key = key or (lambda *args, **kwargs: args[0])
+        self.idempotent = idempotent
+        self.ring = hashring.HashRing(vnodes=vnodes)
+        
+        #: Maps `url -> (peerid, functionid)`.
+        self._shards = {}
+        
+        #: Maps `url -> [calls, keys]` since `_stats_since`.
+        self._counters = {}
+        self._stats_since = reactor.seconds()  # @UndefinedVariable
+        
+    def add_shard(self, url, weight=1):
+        """
+        Adds a shard or changes its weight. Only the keys that now belong
+        to this shard are remapped.
+        """
+        self._shards[url] = _parse_url(url, "functions", "function")
+        self._counters.setdefault(url, [0, 0])
+        self.ring.add(url, weight)
+        
+    def remove_shard(self, url):
+        """
+        Removes a shard. Its keys are spread over the remaining shards.
+        """
+        self.ring.remove(url)
+        del self._shards[url]
+        del self._counters[url]
+        
+    def shard_for(self, *args, **kwargs):
+        """
+        Returns the URL of the shard a call with these arguments goes to.
+        """
+        return self.ring.get(self.key(*args, **kwargs))
+        
+    def __call__(self, *args, **kwargs):
+        url = self.shard_for(*args, **kwargs)
+        self._count(url, 1)
+        peerid, functionid = self._shards[url]
+        return self.rpcsystem._invoke_function(peerid, functionid, args, kwargs, self.idempotent)
+    
+    def call_many(self, argslist):
+        """
+        Invokes the function once for each tuple of positional arguments,
+        sending one request per shard.
+        
+        :returns: Deferred with a list of `(True, result)` or `(False, failure)`
+          in the order of `argslist`.
+        """
+        argslist = list(argslist)
+        batches = collections.defaultdict(list)
+        for index, args in enumerate(argslist):
+            batches[self.shard_for(*args)].append(index)
+        
+        results = [None] * len(argslist)
+        ds = []
+        for url, indices in batches.iteritems():
+            self._count(url, len(indices))
+            peerid, functionid = self._shards[url]
+            calls = [(argslist[index], {}) for index in indices]
+            d = self.rpcsystem._invoke_function(peerid, self.rpcsystem._BATCH, 
+                                                (functionid, calls), {}, self.idempotent)
+            
+            def batch_completed(batch_results, indices=indices):
+                for index, (success, value) in zip(indices, batch_results):
+                    results[index] = (success, value if success else Failure(value))
+                    
+            def batch_failed(failure, indices=indices):
+                for index in indices:
+                    results[index] = (False, failure)
+                    
+            d.addCallbacks(batch_completed, batch_failed)
+            ds.append(d)
+            
+        d = defer.gatherResults(ds)
+        d.addCallback(lambda _: results)
+        return d
+    
+    def _count(self, url, keys):
+        counter = self._counters[url]
+        counter[0] += 1
+        counter[1] += keys
+    
+    def stats(self):
+        """
+        Returns a dict mapping each shard's URL to the number of `calls` (requests sent),
+        `keys`, and `rate` (keys per second) since the stub was created or 
+        :meth:`reset_stats` was called.
+        """
+        elapsed = max(reactor.seconds() - self._stats_since, 1e-9)  # @UndefinedVariable
+        return dict((url, {"calls": calls, "keys": keys, "rate": keys / elapsed}) 
+                    for url, (calls, keys) in self._counters.iteritems())
+    
+    def reset_stats(self):
+        """
+        Sets the counters reported by :meth:`stats` to zero.
+        """
+        for url in self._counters:
+            self._counters[url] = [0, 0]
+        self._stats_since = reactor.seconds()  # @UndefinedVariable
+    
+    def __repr__(self):
+        return "RPCShardedStub(%r)" % (sorted(self._shards),)
+
+
+class _RPCObjectStub(object):
+    def __init__(self, peerid, objectid, rpcsystem):
+        self.peerid = peerid
+        self.objectid = objectid
+        self.rpcsystem = rpcsystem
+        rpcsystem._acquire_reference(self)
+    
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        def method_stub(*args, **kwargs):
+            return self.rpcsystem._invoke_function(self.peerid, RPCSystem._OBJECT_CALL, 
+                                                   (self.objectid, name, args, kwargs), {})
+        return method_stub
+    
+    def __repr__(self):
+        return "RPCObjectStub(%r, %r)" % (self.peerid, self.objectid)
+    
+    def __str__(self):
+        return repr(self)
+    
+    def __eq__(self, other):
+        return self.peerid == other.peerid and self.objectid == other.objectid
+    
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    
+    def __hash__(self):
+        return hash(self.peerid) + hash(self.objectid)
+    
+    def __getstate__(self):
+        return {
+                "peerid":self.peerid,
+                "objectid":self.objectid
+        }
+        
+    def __setstate__(self, state):
+        rpcsystem = RPCSystem.default
+        if rpcsystem is None:
+            raise ValueError("Cannot unpickle object stubs without RPCSystem.default set.")
+        self.peerid = state["peerid"]
+        self.objectid = state["objectid"]
         self.rpcsystem = rpcsystem
+        rpcsystem._acquire_reference(self)
+
+def _parse_url(url, collection, kind):
+    """
+    Splits an anycall URL of the form `anycall://peerid/collection/id`.
+    
+    :returns: Tuple `(peerid, id)`.
+    """
+    parseresult = urlparse.urlparse(url)
+    scheme = parseresult.scheme
+    path = parseresult.path.split("/")
+    if scheme != "anycall":
+        raise ValueError("Not an anycall URL: %s" % repr(url))
+    if len(path) != 3 or path[0] != "" or path[1] != collection:
+        raise ValueError("Not an URL for a remote %s: %s" % (kind, repr(url)))
+    try:
+        itemid = uuid.UUID(path[2])
+    except ValueError:
+        raise ValueError("Not a valid URL for a remote %s: %s" % (kind, repr(url)))
+    return parseresult.netloc, itemid
 
 class _Call(object):
+    
+    #: `(trace_id, parent_span_id)` if the call is traced. Only set on
+    #: the instance if so, keeping untraced calls as they were.
+    trace = None
+    
     def __init__(self, callid, functionid, args, kwargs):
         self.callid = callid
         self.functionid = functionid
@@ -477,6 +1836,65 @@ class _Call(object):
     def __repr__(self):
         return "_Call(%s, %s)" %(repr(self.callid), repr(self.functionid))
         
+def _trace_executed(result, tracer, span):
+    tracer.mark(span, "execute_end", result)
+    return result
+
+
+def _cancel_timer(result, timer):
+    if timer.active():
+        timer.cancel()
+    return result
+
+
+def _picklable_exception(failure):
+    """
+    Returns the exception of the failure, or a :class:`UnpicklableFailure`
+    if it cannot be pickled.
+    """
+    try:
+        pickle.dumps(failure.value, pickle.HIGHEST_PROTOCOL)
+        return failure.value
+    except:
+        return UnpicklableFailure(failure.getTraceback())
+    
+    
+class _PackedCall(_Call):
+    """
+    Call with arguments that have been pickled before, so that
+    the same bytes can be sent to many peers. 
+    """
+    def __init__(self, callid, functionid, payload):
+        self.callid = callid
+        self.functionid = functionid
+        self.payload = payload
+        self._unpacked = None
+        
+    @property
+    def args(self):
+        return self._unpack()[0]
+    
+    @property
+    def kwargs(self):
+        return self._unpack()[1]
+    
+    def _unpack(self):
+        if self._unpacked is None:
+            self._unpacked = pickle.loads(self.payload)
+        return self._unpacked
+    
+    def __getstate__(self):
+        state = {"callid": self.callid, "functionid": self.functionid, "payload": self.payload}
+        if self.trace is not None:
+            state["trace"] = self.trace
+        return state
+    
+    def __setstate__(self, state):
+        self.__init__(state["callid"], state["functionid"], state["payload"])
+        if "trace" in state:
+            self.trace = state["trace"]
+        
+        
 class _CallReturn(object):
     def __init__(self, callid, retval):
         self.callid = callid
@@ -507,3 +1925,14 @@ class _CallCancel(object):
     def __repr__(self):
         return "_CallCancel(%s)" %(repr(self.callid))
     
+#: Maps message type to the events recorded when it is `(sent, received)`.
+_MESSAGE_EVENTS = {_Call: (events.CALL_SENT, events.CALL_RECEIVED),
+                   _PackedCall: (events.CALL_SENT, events.CALL_RECEIVED),
+                   _CallReturn: (events.RETURN_SENT, events.RETURN_RECEIVED),
+                   _CallFail: (events.FAIL_SENT, events.FAIL_RECEIVED),
+                   _CallCancel: (events.CANCEL_SENT, events.CANCEL_RECEIVED)}
+
+#: Maps message type to the kind it is profiled as.
+_MESSAGE_KINDS = {_Call: "call", _PackedCall: "call", _CallReturn: "return", 
+                  _CallFail: "fail", _CallCancel: "cancel"}
+    
@@ -0,0 +1,576 @@
+# Copyright (c) 2014 Stefan C. Mueller
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Stream transport between processes on the same host that moves the
+payload through shared memory instead of through the kernel.
+
+Each connection consists of a UNIX domain socket and a memory mapped file
+holding two ring buffers, one per direction. The data written to the
+transport is copied into the outgoing ring buffer. The socket is only used
+to establish the connection and as a doorbell: a single byte tells the other
+side that there is new data in the ring (or new space, if it was blocked).
+Doorbells are coalesced, so a burst of packets written during one reactor
+iteration costs a single system call, independent of the payload size.
+
+The endpoints implement `IStreamServerEndpoint` and `IStreamClientEndpoint`
+and can be passed to :class:`anycall.connectionpool.ConnectionPool` like
+their TCP counterparts.
+
+The server only maps files directly inside its segment directory that
+are owned by the connecting user, and by default only that user may
+connect to its socket.
+"""
+
+import os
+import sys
+import mmap
+import stat
+import socket
+import struct
+import logging
+import tempfile
+
+from zope.interface import implementer
+from twisted.internet import protocol, defer, endpoints, interfaces
+
+from anycall import bytequeue
+
+logger = logging.getLogger(__name__)
+
+#: Default size of each ring buffer in bytes.
+DEFAULT_CAPACITY = 4 * 1024 * 1024
+
+_DOORBELL = "\x00"
+_SETUP = "ANYCALL-SHM"
+_SETUP_OK = "OK"
+
+#: `SO_PEERCRED` socket option, if we know it for this platform.
+_SO_PEERCRED = getattr(socket, "SO_PEERCRED", 17 if sys.platform.startswith("linux") else None)
+
+#: `struct ucred` returned for `SO_PEERCRED`: pid, uid, gid.
+_UCRED = struct.Struct("3i")
+
+#: Retry interval if we are blocked on a full ring. Protects against
+#: a lost wake-up if both sides update the ring header at the same time.
+_BLOCKED_POLL_INTERVAL = 0.01
+
+
+class RingBuffer(object):
+    """
+    Single-producer, single-consumer byte ring in a memory mapped region.
+
+    The header holds the total number of bytes ever written and read.
+    Only the writer updates `head`, only the reader updates `tail`.
+    The `blocked` flag is set by the writer if the ring was full, so
+    that the reader knows that it has to ring the doorbell once it
+    made some room.
+    """
+
+    HEADER_SIZE = 64
+
+    _HEAD = struct.Struct("=Q")
+    _TAIL = struct.Struct("=Q")
+    _BLOCKED = struct.Struct("=I")
+
+    def __init__(self, mm, offset, capacity):
+        """
+        :param mm: `mmap` object.
+
+        :param offset: Start of the ring (including the header) within `mm`.
+
+        :param capacity: Number of payload bytes the ring can hold.
+        """
+        self._mm = mm
+        self._head_offset = offset
+        self._tail_offset = offset + 8
+        self._blocked_offset = offset + 16
+        self._data_offset = offset + self.HEADER_SIZE
+        self.capacity = capacity
+
+    @classmethod
+    def required_size(cls, capacity):
+        """
+        Number of bytes needed for a ring of the given capacity.
+        """
+        return cls.HEADER_SIZE + capacity
+
+    def _get_head(self):
+        return self._HEAD.unpack_from(self._mm, self._head_offset)[0]
+
+    def _get_tail(self):
+        return self._TAIL.unpack_from(self._mm, self._tail_offset)[0]
+
+    @property
+    def blocked(self):
+        return bool(self._BLOCKED.unpack_from(self._mm, self._blocked_offset)[0])
+
+    @blocked.setter
+    def blocked(self, value):
+        self._BLOCKED.pack_into(self._mm, self._blocked_offset, 1 if value else 0)
+
+    def available(self):
+        """
+        Number of bytes that can be read.
+        """
+        return self._get_head() - self._get_tail()
+
+    def free(self):
+        """
+        Number of bytes that can be written.
+        """
+        return self.capacity - self.available()
+
+    def write(self, data):
+        """
+        Copy as much of `data` into the ring as there is room for.
+
+        :returns: Number of bytes written.
+        """
+        head = self._get_head()
+        n = min(len(data), self.capacity - (head - self._get_tail()))
+        if n <= 0:
+            return 0
+
+        pos = head % self.capacity
+        first = min(n, self.capacity - pos)
+        start = self._data_offset + pos
+        self._mm[start:start + first] = data[:first]
+        if first < n:
+            self._mm[self._data_offset:self._data_offset + n - first] = data[first:n]
+
+        # Publish only after the payload is in place.
+        self._HEAD.pack_into(self._mm, self._head_offset, head + n)
+        return n
+
+    def read(self):
+        """
+        Remove and return all bytes currently in the ring.
+        """
+        tail = self._get_tail()
+        n = self._get_head() - tail
+        if n <= 0:
+            return ""
+
+        pos = tail % self.capacity
+        first = min(n, self.capacity - pos)
+        start = self._data_offset + pos
+        data = self._mm[start:start + first]
+        if first < n:
+            data += self._mm[self._data_offset:self._data_offset + n - first]
+
+        self._TAIL.pack_into(self._mm, self._tail_offset, tail + n)
+        return data
+
+
+def _shm_directory():
+    """
+    Directory in which the shared memory files are created.
+    Prefers a RAM backed file system if there is one.
+    """
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def _create_segment(capacity, directory=None):
+    """
+    Creates and maps a new file large enough for two rings.
+
+    :returns: `(path, mmap)`
+    """
+    size = 2 * RingBuffer.required_size(capacity)
+    fd, path = tempfile.mkstemp(prefix="anycall-", suffix=".shm", dir=directory or _shm_directory())
+    try:
+        os.ftruncate(fd, size)
+        mm = mmap.mmap(fd, size)
+    except:
+        os.close(fd)
+        os.unlink(path)
+        raise
+    os.close(fd)
+    return path, mm
+
+
+def _open_segment(path, capacity, directory, owner):
+    """
+    Maps a file previously created with :func:`_create_segment`.
+
+    :param directory: Directory the file has to be in.
+
+    :param owner: User id that has to own the file.
+    """
+    name = os.path.basename(path)
+    if (os.path.realpath(os.path.dirname(path)) != os.path.realpath(directory) or 
+        not name.startswith("anycall-") or not name.endswith(".shm")):
+        raise ValueError("Shared memory segment %r is not in %r." % (path, directory))
+    size = 2 * RingBuffer.required_size(capacity)
+    fd = os.open(path, os.O_RDWR | getattr(os, "O_NOFOLLOW", 0))
+    try:
+        info = os.fstat(fd)
+        if not stat.S_ISREG(info.st_mode) or info.st_nlink != 1 or info.st_uid != owner:
+            raise ValueError("Shared memory segment %r is not a file created by user %s." % (path, owner))
+        if info.st_size != size:
+            raise ValueError("Shared memory segment %r has unexpected size." % path)
+        return mmap.mmap(fd, size)
+    finally:
+        os.close(fd)
+
+
+@implementer(interfaces.ITransport)
+class SHMTransport(object):
+    """
+    Transport handed to the application protocol. Writes go into the
+    outgoing ring, the UNIX socket `channel` is used for wake-ups.
+    """
+
+    def __init__(self, reactor, channel, mm, outgoing, incoming):
+        self._reactor = reactor
+        self._channel = channel
+        self._mm = mm
+        self._outgoing = outgoing
+        self._incoming = incoming
+
+        #: Data that did not fit into the ring yet.
+        self._pending = bytequeue.ByteQueue()
+
+        self._doorbell_call = None
+        self._poll_call = None
+        self._disconnecting = False
+        self._closed = False
+
+    def write(self, data):
+        if self._closed or self._disconnecting or not data:
+            return
+        if self._pending:
+            self._pending.enqueue(data)
+        else:
+            n = self._outgoing.write(data)
+            if n < len(data):
+                self._pending.enqueue(data[n:])
+                self._blocked()
+        self._ring_doorbell()
+
+    def writeSequence(self, data):
+        self.write("".join(data))
+
+    def loseConnection(self):
+        if self._closed or self._disconnecting:
+            return
+        self._disconnecting = True
+        if not self._pending:
+            self._close_channel()
+
+    def abortConnection(self):
+        self._pending = bytequeue.ByteQueue()
+        self._disconnecting = True
+        self._close_channel()
+
+    def getPeer(self):
+        return self._channel.transport.getPeer()
+
+    def getHost(self):
+        return self._channel.transport.getHost()
+
+    def pending_bytes(self):
+        """
+        Number of bytes written but not yet consumed by the peer.
+        """
+        return len(self._pending) + self._outgoing.available()
+
+    def _close_channel(self):
+        self._flush_doorbell()
+        self._channel.transport.loseConnection()
+
+    def _ring_doorbell(self):
+        """
+        Schedule a wake-up for the peer. Multiple calls within
+        the same reactor iteration result in a single doorbell.
+        """
+        if self._doorbell_call is None and not self._closed:
+            self._doorbell_call = self._reactor.callLater(0, self._flush_doorbell)
+
+    def _flush_doorbell(self):
+        if self._doorbell_call is not None:
+            if self._doorbell_call.active():
+                self._doorbell_call.cancel()
+            self._doorbell_call = None
+            self._channel.transport.write(_DOORBELL)
+
+    def _blocked(self):
+        self._outgoing.blocked = True
+        if self._poll_call is None:
+            self._poll_call = self._reactor.callLater(_BLOCKED_POLL_INTERVAL, self._poll)
+
+    def _poll(self):
+        self._poll_call = None
+        self._flush_pending()
+
+    def service(self):
+        """
+        Called when the peer rang the doorbell.
+
+        :returns: Data received from the peer.
+        """
+        data = self._incoming.read()
+        if data and self._incoming.blocked:
+            self._incoming.blocked = False
+            self._ring_doorbell()
+        self._flush_pending()
+        return data
+
+    def _flush_pending(self):
+        """
+        Move data that did not fit earlier into the ring.
+        """
+        if not self._pending:
+            return
+        chunk = self._pending.all()
+        n = self._outgoing.write(chunk)
+        if n:
+            self._pending.drop(n)
+            self._ring_doorbell()
+        if self._pending:
+            self._blocked()
+        else:
+            self._outgoing.blocked = False
+            if self._disconnecting:
+                self._close_channel()
+
+    def _connection_lost(self):
+        """
+        Called once the channel is closed. Returns the data that
+        the peer wrote before closing.
+        """
+        data = self._incoming.read()
+        self._closed = True
+        for call in (self._doorbell_call, self._poll_call):
+            if call is not None and call.active():
+                call.cancel()
+        self._doorbell_call = None
+        self._poll_call = None
+        self._mm.close()
+        return data
+
+
+class _SHMChannel(protocol.Protocol):
+    """
+    Protocol on the UNIX socket. Performs the setup and afterwards
+    forwards doorbells to the :class:`SHMTransport`.
+    """
+
+    def __init__(self, reactor, factory, addr):
+        self.reactor = reactor
+        self.factory = factory
+        self.addr = addr
+        self.shm_transport = None
+        self.application = None
+        self._setup_buffer = ""
+
+    def dataReceived(self, data):
+        if self.shm_transport is None:
+            self._setup_buffer += data
+            line, sep, rest = self._setup_buffer.partition("\n")
+            if not sep:
+                return
+            self._setup_buffer = ""
+            try:
+                self.setup_received(line)
+            except:
+                logger.exception("Shared memory setup failed.")
+                self.transport.loseConnection()
+                return
+            if self.shm_transport is None:
+                # The factory refused the connection.
+                return
+            data = rest
+            if not data:
+                return
+
+        data = self.shm_transport.service()
+        if data:
+            self.application.dataReceived(data)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        if self.shm_transport is not None:
+            data = self.shm_transport._connection_lost()
+            if data:
+                self.application.dataReceived(data)
+            self.application.connectionLost(reason)
+
+    def start_application(self, mm, outgoing, incoming):
+        self.shm_transport = SHMTransport(self.reactor, self, mm, outgoing, incoming)
+        self.application = self.factory.protocolFactory.buildProtocol(self.addr)
+        if self.application is None:
+            self.shm_transport = None
+            mm.close()
+            self.transport.loseConnection()
+            return None
+        self.application.makeConnection(self.shm_transport)
+        return self.application
+
+
+class _SHMServerChannel(_SHMChannel):
+
+    def setup_received(self, line):
+        magic, path, capacity = line.split(" ")
+        if magic != _SETUP:
+            raise ValueError("Unexpected setup message %r." % line)
+        capacity = int(capacity)
+        mm = _open_segment(path, capacity, self.factory.segment_directory, self._peer_uid())
+        size = RingBuffer.required_size(capacity)
+        incoming = RingBuffer(mm, 0, capacity)
+        outgoing = RingBuffer(mm, size, capacity)
+        self.transport.write(_SETUP_OK + "\n")
+        self.start_application(mm, outgoing, incoming)
+
+    def _peer_uid(self):
+        """
+        User id of the connecting process, or our own if we cannot find out.
+        """
+        if _SO_PEERCRED is not None:
+            try:
+                ucred = self.transport.getHandle().getsockopt(socket.SOL_SOCKET, _SO_PEERCRED, _UCRED.size)
+                return _UCRED.unpack(ucred)[1]
+            except (AttributeError, socket.error):
+                pass
+        return os.getuid()
+
+
+class _SHMClientChannel(_SHMChannel):
+
+    def connectionMade(self):
+        try:
+            self._path, self._mm = _create_segment(self.factory.capacity, self.factory.directory)
+        except:
+            self.factory.ready.errback()
+            self.transport.loseConnection()
+            return
+        self.transport.write("%s %s %s\n" % (_SETUP, self._path, self.factory.capacity))
+
+    def setup_received(self, line):
+        self._unlink()
+        if line != _SETUP_OK:
+            raise ValueError("Unexpected setup reply %r." % line)
+        capacity = self.factory.capacity
+        size = RingBuffer.required_size(capacity)
+        outgoing = RingBuffer(self._mm, 0, capacity)
+        incoming = RingBuffer(self._mm, size, capacity)
+        p = self.start_application(self._mm, outgoing, incoming)
+        if p is None:
+            self.factory.ready.errback(ValueError("Protocol factory refused the connection."))
+        else:
+            self.factory.ready.callback(p)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        self._unlink()
+        if self.shm_transport is None:
+            mm = getattr(self, "_mm", None)
+            if mm is not None:
+                mm.close()
+            if not self.factory.ready.called:
+                self.factory.ready.errback(reason)
+        _SHMChannel.connectionLost(self, reason)
+
+    def _unlink(self):
+        path = getattr(self, "_path", None)
+        if path is not None:
+            self._path = None
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+class _SHMServerFactory(protocol.Factory):
+
+    def __init__(self, reactor, protocolFactory, segment_directory):
+        self.reactor = reactor
+        self.protocolFactory = protocolFactory
+        self.segment_directory = segment_directory
+
+    def buildProtocol(self, addr):
+        return _SHMServerChannel(self.reactor, self, addr)
+
+
+class _SHMClientFactory(protocol.Factory):
+
+    def __init__(self, reactor, protocolFactory, capacity, directory):
+        self.reactor = reactor
+        self.protocolFactory = protocolFactory
+        self.capacity = capacity
+        self.directory = directory
+        self.ready = defer.Deferred()
+
+    def buildProtocol(self, addr):
+        return _SHMClientChannel(self.reactor, self, addr)
+
+
+@implementer(interfaces.IStreamServerEndpoint)
+class SHMServerEndpoint(object):
+    """
+    Listens for shared memory connections on the UNIX socket `address`.
+
+    :param mode: Permissions of the socket. By default only our own user
+      may connect.
+
+    :param segment_directory: Only shared memory files in this directory
+      are accepted. Has to match the `directory` of the clients. Defaults
+      to `/dev/shm` if available, like :class:`SHMClientEndpoint`.
+    """
+
+    def __init__(self, reactor, address, backlog=50, mode=0600, segment_directory=None):
+        self.reactor = reactor
+        self.address = address
+        self.backlog = backlog
+        self.mode = mode
+        self.segment_directory = segment_directory or _shm_directory()
+
+    def listen(self, protocolFactory):
+        endpoint = endpoints.UNIXServerEndpoint(self.reactor, self.address,
+                                                backlog=self.backlog, mode=self.mode)
+        return endpoint.listen(_SHMServerFactory(self.reactor, protocolFactory, self.segment_directory))
+
+
+@implementer(interfaces.IStreamClientEndpoint)
+class SHMClientEndpoint(object):
+    """
+    Connects to a :class:`SHMServerEndpoint` listening on `address`.
+
+    :param capacity: Size of each of the two ring buffers in bytes.
+
+    :param directory: Where to create the shared memory file. Defaults
+      to `/dev/shm` if available. The file is unlinked as soon as both
+      sides have mapped it.
+    """
+
+    def __init__(self, reactor, address, capacity=DEFAULT_CAPACITY, directory=None, timeout=30):
+        self.reactor = reactor
+        self.address = address
+        self.capacity = capacity
+        self.directory = directory
+        self.timeout = timeout
+
+    def connect(self, protocolFactory):
+        factory = _SHMClientFactory(self.reactor, protocolFactory, self.capacity, self.directory)
+        endpoint = endpoints.UNIXClientEndpoint(self.reactor, self.address, timeout=self.timeout)
+        d = endpoint.connect(factory)
+        d.addCallback(lambda _: factory.ready)
+        return d
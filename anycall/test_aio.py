@@ -0,0 +1,293 @@
+# Copyright (c) 2014 Stefan C. Mueller
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import functools
+import os
+import sys
+import uuid
+import unittest
+
+if sys.version_info[0] >= 3:
+    import asyncio
+    from anycall import aio
+
+#: Coroutine functions for the tests. Compiled at runtime so that this
+#: module still parses on Python 2.
+COROUTINES = """
+async def later(value, delay):
+    await asyncio.sleep(delay)
+    return value
+
+async def forever(started, cancelled):
+    started.set_result(None)
+    try:
+        await asyncio.sleep(60)
+    except asyncio.CancelledError:
+        cancelled.set_result(True)
+        raise
+
+async def give_up():
+    raise asyncio.CancelledError()
+"""
+
+if sys.version_info[0] >= 3:
+    coroutines = {"asyncio": asyncio}
+    exec(COROUTINES, coroutines)
+
+requires_py3 = unittest.skipIf(sys.version_info[0] < 3, "asyncio backend requires Python 3")
+
+#: Python 2 interpreter with Twisted to test interoperability with.
+TWISTED_PYTHON = os.environ.get("ANYCALL_TWISTED_PYTHON", None)
+
+#: Runs a Twisted peer offering `relay(x)`, which calls the function
+#: with the URL given as argument and returns its result tagged, as well
+#: as `fail()`, `hang()` and `was_cancelled()` which reports whether a
+#: `hang()` call has been cancelled.
+TWISTED_PEER = """
+import sys
+from twisted.internet import reactor, defer
+import anycall
+
+rpcsystem = anycall.create_tcp_rpc_system()
+anycall.RPCSystem.default = rpcsystem
+
+def relay(x):
+    stub = rpcsystem.create_function_stub(sys.argv[1])
+    d = stub(x)
+    d.addCallback(lambda result: ("twisted", result))
+    return d
+
+def fail():
+    return defer.fail(KeyError("missing"))
+
+cancelled = []
+
+def hang():
+    return defer.Deferred(lambda d: cancelled.append(True))
+
+def was_cancelled():
+    return cancelled
+
+def opened(_):
+    urls = [rpcsystem.get_function_url(f) for f in (relay, fail, hang, was_cancelled)]
+    sys.stdout.write(" ".join(urls) + "\\n")
+    sys.stdout.flush()
+
+rpcsystem.open().addCallback(opened)
+reactor.run()
+"""
+
+
+@requires_py3
+class TestPacketProtocol(unittest.TestCase):
+
+    class Transport(object):
+        def __init__(self):
+            self.data = bytearray()
+
+        def writelines(self, data):
+            for d in data:
+                self.data.extend(d)
+
+    class Receiver(aio.PacketProtocol if sys.version_info[0] >= 3 else object):
+        def __init__(self):
+            aio.PacketProtocol.__init__(self)
+            self.packets = []
+
+        def packet_received(self, typename, packet):
+            self.packets.append((typename, packet))
+
+    def test_roundtrip(self):
+        sender = self.Receiver()
+        sender.register_type("RPC")
+        sender.connection_made(self.Transport())
+        sender.send_packet("RPC", b"Hello")
+        sender.send_packet("RPC", b"World!")
+
+        receiver = self.Receiver()
+        receiver.register_type("RPC")
+        data = bytes(sender.transport.data)
+        for i in range(len(data)):
+            receiver.data_received(data[i:i + 1])
+        self.assertEqual([("RPC", b"Hello"), ("RPC", b"World!")], receiver.packets)
+
+    def test_typehash(self):
+        # Same as `binascii.crc32("RPC") & 0xffffffff` on Python 2.
+        self.assertEqual(3306647218, aio.typehash("RPC"))
+
+
+@requires_py3
+class TestWire(unittest.TestCase):
+
+    def test_call_class_name(self):
+        data = aio._dumps(aio._Call(uuid.uuid1(), uuid.uuid1(), (1,), {}))
+        self.assertIn(b"anycall.rpc\n_Call\n", data)
+
+    def test_roundtrip(self):
+        callid = uuid.uuid1()
+        actual = aio._loads(aio._dumps(aio._CallReturn(callid, {"a": [1, 2]})))
+        self.assertIsInstance(actual, aio._CallReturn)
+        self.assertEqual(callid, actual.callid)
+        self.assertEqual({"a": [1, 2]}, actual.retval)
+
+    def test_unknown_class(self):
+        data = aio._dumps(ValueError("x")).replace(b"exceptions", b"nomodule")
+        self.assertIsInstance(aio._loads(data), aio.RemoteError)
+
+
+@requires_py3
+class TestRPC(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.rpcA = aio.create_tcp_rpc_system(loop=self.loop)
+        self.rpcB = aio.create_tcp_rpc_system(loop=self.loop)
+        self.wait(self.rpcA.open())
+        self.wait(self.rpcB.open())
+
+    def tearDown(self):
+        self.wait(self.rpcA.close())
+        self.wait(self.rpcB.close())
+        self.loop.close()
+
+    def wait(self, future):
+        return self.loop.run_until_complete(asyncio.wait_for(future, 5))
+
+    def test_simple_call(self):
+        url = self.rpcA.get_function_url(lambda entity: "Hello %s!" % entity)
+        stub = self.rpcB.create_function_stub(url)
+        self.assertEqual("Hello World!", self.wait(stub("World")))
+
+    def test_exception(self):
+        def fail():
+            raise KeyError("missing")
+        stub = self.rpcB.create_function_stub(self.rpcA.get_function_url(fail))
+        self.assertRaises(KeyError, self.wait, stub())
+
+    def test_future(self):
+        def later(value):
+            future = self.loop.create_future()
+            self.loop.call_later(0.05, future.set_result, value)
+            return future
+        stub = self.rpcB.create_function_stub(self.rpcA.get_function_url(later))
+        self.assertEqual(42, self.wait(stub(42)))
+
+    def test_coroutine(self):
+        stub = self.rpcB.create_function_stub(self.rpcA.get_function_url(coroutines["later"]))
+        self.assertEqual(42, self.wait(stub(42, 0.05)))
+
+    def test_coroutine_local(self):
+        stub = self.rpcA.create_function_stub(self.rpcA.get_function_url(coroutines["later"]))
+        self.assertEqual(42, self.wait(stub(42, 0)))
+
+    def test_cancel(self):
+        started = self.loop.create_future()
+        cancelled = self.loop.create_future()
+        forever = functools.partial(coroutines["forever"], started, cancelled)
+        call = self.rpcB.create_function_stub(self.rpcA.get_function_url(forever))()
+        self.wait(started)
+        call.cancel()
+        self.assertTrue(self.wait(cancelled))
+        self.assertFalse(self.rpcA._remote_to_local)
+
+    def test_cancelled_by_callee(self):
+        call = self.rpcB.create_function_stub(self.rpcA.get_function_url(coroutines["give_up"]))()
+        self.assertRaises(asyncio.CancelledError, self.wait, call)
+        self.assertTrue(call.cancelled())
+
+    def test_unregistered(self):
+        url = self.rpcA.get_function_url(lambda: None)
+        self.assertTrue(self.rpcA.unregister_function(url))
+        self.assertRaises(ValueError, self.wait, self.rpcB.create_function_stub(url)())
+
+    def later_counted(self, invocations, value):
+        invocations.append(value)
+        future = self.loop.create_future()
+        self.loop.call_later(0.2, future.set_result, value)
+        return future
+
+    def drop_connection(self):
+        self.wait(asyncio.sleep(0.05))
+        for protocol in self.rpcB._connectionpool._connections[self.rpcA.ownid]:
+            protocol.transport.close()
+
+    def test_replay_idempotent(self):
+        invocations = []
+        url = self.rpcA.get_function_url(functools.partial(self.later_counted, invocations))
+        call = self.rpcB.create_function_stub(url, idempotent=True)(42)
+        with self.assertLogs("anycall.aio", "DEBUG") as logs:
+            self.drop_connection()
+            self.assertEqual(42, self.wait(call))
+        # The replay reached the callee while the call was still running.
+        self.assertTrue(any("Ignoring duplicate call" in line for line in logs.output))
+        self.assertEqual([42], invocations)
+
+    def test_connection_lost(self):
+        url = self.rpcA.get_function_url(functools.partial(self.later_counted, []))
+        call = self.rpcB.create_function_stub(url)(42)
+        self.drop_connection()
+        self.assertRaises(ConnectionError, self.wait, call)
+
+
+@requires_py3
+@unittest.skipIf(TWISTED_PYTHON is None, "Set ANYCALL_TWISTED_PYTHON to a Python 2 interpreter with Twisted")
+class TestInterop(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.rpc = aio.create_tcp_rpc_system(loop=self.loop)
+        self.wait(self.rpc.open())
+        aio.RPCSystem.default = self.rpc
+
+        url = self.rpc.get_function_url(lambda x: x * 2)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.process = self.wait(asyncio.create_subprocess_exec(
+            TWISTED_PYTHON, "-c", TWISTED_PEER, url,
+            stdout=asyncio.subprocess.PIPE, cwd=root))
+        line = self.wait(self.process.stdout.readline())
+        self.relay_url, self.fail_url, self.hang_url, self.cancelled_url = line.decode("ascii").split()
+
+    def tearDown(self):
+        self.process.terminate()
+        self.wait(self.process.wait())
+        self.wait(self.rpc.close())
+        aio.RPCSystem.default = None
+        self.loop.close()
+
+    def wait(self, future):
+        return self.loop.run_until_complete(asyncio.wait_for(future, 10))
+
+    def test_both_directions(self):
+        stub = self.rpc.create_function_stub(self.relay_url)
+        self.assertEqual(("twisted", 42), tuple(self.wait(stub(21))))
+
+    def test_exception(self):
+        stub = self.rpc.create_function_stub(self.fail_url)
+        with self.assertRaises((KeyError, aio.UnpicklableFailure)) as cm:
+            self.wait(stub())
+        self.assertIn("missing", str(cm.exception))
+
+    def test_cancel(self):
+        call = self.rpc.create_function_stub(self.hang_url)()
+        self.wait(asyncio.sleep(0.2))
+        call.cancel()
+        self.wait(asyncio.sleep(0))  # done callbacks send the cancellation
+        stub = self.rpc.create_function_stub(self.cancelled_url)
+        self.assertEqual([True], self.wait(stub()))
@@ -0,0 +1,114 @@
+# Copyright (c) 2014 Stefan C. Mueller
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import threading
+import time
+import unittest
+
+from twisted.internet import defer, error, reactor, threads
+
+from anycall import blocking, rpc
+
+
+class TestBlockingClient(unittest.TestCase):
+
+    def setUp(self):
+        self.server = blocking.BlockingClient().open()
+        self.client = blocking.BlockingClient(timeout=5).open()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def test_call(self):
+        url = self.server.get_function_url(lambda x: x * 2)
+        self.assertEqual(42, self.client.call(url, 21))
+
+    def test_stub(self):
+        stub = self.client.create_function_stub(self.server.get_function_url(lambda x: x * 2))
+        self.assertEqual([2, 4], [stub(1), stub(2)])
+
+    def test_exception(self):
+        def fail():
+            raise KeyError("missing")
+        url = self.server.get_function_url(fail)
+        self.assertRaises((KeyError, rpc.UnpicklableFailure), self.client.call, url)
+
+    def test_invalid_url(self):
+        self.assertRaises(ValueError, self.client.call, "http://example.com")
+
+    def test_many_threads(self):
+        url = self.server.get_function_url(lambda x: x * 2)
+        results = {}
+
+        def work(i):
+            results[i] = [self.client.call(url, j) for j in range(i, i + 20)]
+        workers = [threading.Thread(target=work, args=(i,)) for i in range(10)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        for i in range(10):
+            self.assertEqual([2 * j for j in range(i, i + 20)], results[i])
+
+        # All calls share the pooled connection.
+        stats = self.client.rpcsystem._connectionpool.stats()
+        self.assertEqual(1, len(stats["utilization"][self.server.rpcsystem.ownid]))
+
+    def test_timeout(self):
+        cancelled = []
+        url = self.server.get_function_url(lambda: defer.Deferred(cancelled.append))
+        call = self.client.submit(url)
+        self.assertRaises(error.TimeoutError, call.result, 0.2)
+
+        # The cancellation reaches the server.
+        for _ in range(50):
+            if cancelled:
+                break
+            time.sleep(0.02)
+        self.assertEqual(1, len(cancelled))
+
+    def test_cancel_before_start(self):
+        url = self.server.get_function_url(lambda: None)
+        call = blocking.BlockingCall(self.client, url, (), {})
+
+        def cancel_and_start():
+            call._cancel()
+            call._start()
+        threads.blockingCallFromThread(reactor, cancel_and_start)
+        self.assertTrue(call.done())
+        self.assertRaises(defer.CancelledError, call.result)
+
+    def test_from_reactor_thread(self):
+        self.assertRaises(RuntimeError, threads.blockingCallFromThread,
+                          reactor, self.client.get_function_url, lambda: None)
+
+
+class TestSharedClient(unittest.TestCase):
+
+    def tearDown(self):
+        blocking.close_shared_client()
+
+    def test_shared(self):
+        client = blocking.shared_client()
+        self.assertIs(client, blocking.shared_client())
+        url = client.get_function_url(lambda: "hello")
+        self.assertEqual("hello", client.call(url))
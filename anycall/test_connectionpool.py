@@ -22,7 +22,7 @@ import unittest
 import socket
 
 import utwist
-from twisted.internet import defer, endpoints, reactor
+from twisted.internet import defer, endpoints, reactor, error, task
 
 from anycall import connectionpool
 from twisted.python.failure import Failure
@@ -61,6 +61,34 @@ class TestConnectionPool(unittest.TestCase):
         self.assertEqual(typename, "msg")
         self.assertEqual(msg, "Hello World!")
     
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_peer_stats(self):
+        for _ in range(3):
+            yield self.poolA.send(self.poolB.ownid, "msg", "x" * 100)
+        for _ in range(3):
+            yield self.poolB.packets.get()
+        
+        stats = self.poolA.peer_stats(self.poolB.ownid)
+        self.assertEqual((1, 0), (stats["opened"], stats["lost"]))
+        self.assertEqual((3, 300), (stats["packets_sent"], stats["bytes_sent"]))
+        self.assertIsNotNone(stats["handshake_time"])
+        self.assertGreaterEqual(stats["max_queued"], 1)
+        self.assertEqual(0, stats["queued"])
+        
+        stats = self.poolB.peer_stats()[self.poolA.ownid]
+        self.assertEqual((3, 300), (stats["packets_received"], stats["bytes_received"]))
+        self.assertGreaterEqual(stats["max_receive_buffer"], 108)
+        
+        # The totals remain once the connection is gone.
+        self.poolA._connections[self.poolB.ownid][0].transport.loseConnection()
+        yield sleep(0.1)
+        stats = self.poolB.peer_stats(self.poolA.ownid)
+        self.assertEqual((1, 1), (stats["opened"], stats["lost"]))
+        self.assertEqual(3, stats["packets_received"])
+        self.assertIsNotNone(stats["lifetime"])
+        self.assertEqual([], stats["connections"])
+        
     @utwist.with_reactor
     @defer.inlineCallbacks
     def test_two(self):
@@ -75,13 +103,359 @@ class TestConnectionPool(unittest.TestCase):
         self.assertEqual(peer, self.poolB.ownid)
         self.assertEqual(typename, "msg")
         self.assertEqual(msg, "Hello World!")
+    
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_single_connect(self):
+        ds = [self.poolA.send(self.poolB.ownid, "msg", str(i)) for i in range(100)]
+        self.assertEqual(100, self.poolA.stats()["queued"][self.poolB.ownid])
+        yield defer.gatherResults(ds)
+        
+        for i in range(100):
+            _, _, msg = yield self.poolB.packets.get()
+            self.assertEqual(str(i), msg)
+        self.assertEqual(1, self.poolA.stats()["opened"])
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_queue_full(self):
+        self.poolA.max_queued_packets = 2
+        d1 = self.poolA.send(self.poolB.ownid, "msg", "1")
+        d2 = self.poolA.send(self.poolB.ownid, "msg", "2")
+        d3 = self.poolA.send(self.poolB.ownid, "msg", "3")
+        
+        try:
+            yield d3
+            self.fail("Expected SendQueueFull")
+        except connectionpool.SendQueueFull:
+            pass
+        yield d1
+        yield d2
+        yield self.poolB.packets.get()
+        yield self.poolB.packets.get()
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_backoff(self):
+        peer = socket.getfqdn() + ":50009"
+        try:
+            yield self.poolA.send(peer, "msg", "Hello World!")
+            self.fail("Expected connection error")
+        except error.ConnectError:
+            pass
+        self.assertEqual(connectionpool.BACKOFF, self.poolA.peer_state(peer))
+        
+        try:
+            yield self.poolA.send(peer, "msg", "Hello World!")
+            self.fail("Expected PeerUnavailable")
+        except connectionpool.PeerUnavailable:
+            pass
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_down(self):
+        self.poolA.down_after = 2
+        self.poolA.reconnect_delay = 0.01
+        self.poolA.max_reconnect_delay = 0.3
+        peer = socket.getfqdn() + ":50009"
+        for _ in range(2):
+            try:
+                yield self.poolA.send(peer, "msg", "Hello World!")
+                self.fail("Expected connection error")
+            except error.ConnectError:
+                pass
+            yield sleep(0.05)
+        self.assertEqual(connectionpool.DOWN, self.poolA.peer_state(peer))
+        try:
+            yield self.poolA.send(peer, "msg", "Hello World!")
+            self.fail("Expected PeerUnavailable")
+        except connectionpool.PeerUnavailable:
+            pass
+        
+        # The background probe finds the peer once it is back.
+        poolC = MockPool(endpoints.TCP4ServerEndpoint(reactor, 50009), peer)
+        poolC.register_type("msg")
+        yield poolC.open()
+        try:
+            yield sleep(0.5)
+            self.assertEqual(connectionpool.UP, self.poolA.peer_state(peer))
+            yield self.poolA.send(peer, "msg", "Hello World!")
+        finally:
+            yield poolC.close()
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_close_while_connecting(self):
+        # Accepts connections, but never sends a handshake.
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(("127.0.0.1", 50009))
+        server.listen(5)
+        peer = socket.getfqdn() + ":50009"
+        poolC = MockPool(endpoints.TCP4ServerEndpoint(reactor, 50002), socket.getfqdn() + ":50002")
+        poolC.register_type("msg")
+        poolC.down_after = 1
+        yield poolC.open()
+        try:
+            d = poolC.send(peer, "msg", "Hello World!")
+            d.addErrback(lambda _: None)
+            yield sleep(0.1)
+            self.assertEqual(connectionpool.CONNECTING, poolC.peer_state(peer))
+        finally:
+            yield poolC.close()
+            server.close()
+        
+        # Giving up on the attempt is no failure of the peer.
+        self.assertNotEqual(connectionpool.DOWN, poolC.peer_state(peer))
+        self.assertEqual({}, poolC._probe_timers)
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_peer_state(self):
+        self.assertEqual(connectionpool.DISCONNECTED, self.poolA.peer_state(self.poolB.ownid))
+        d = self.poolA.send(self.poolB.ownid, "msg", "Hello World!")
+        self.assertEqual(connectionpool.CONNECTING, self.poolA.peer_state(self.poolB.ownid))
+        yield d
+        self.assertEqual(connectionpool.UP, self.poolA.peer_state(self.poolB.ownid))
+        yield self.poolB.packets.get()
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_address_learned(self):
+        yield self.poolA.send(self.poolB.ownid, "msg", "Hello World!")
+        yield self.poolB.packets.get()
+        self.assertEqual("127.0.0.1", self.poolA.address_cache.get(self.poolB.ownid))
+        self.assertIsNone(self.poolB.address_cache.get(self.poolA.ownid))
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_pre_connect_many(self):
+        unreachable = socket.getfqdn() + ":50009"
+        results = yield self.poolA.pre_connect_many([self.poolB.ownid, unreachable], concurrency=1)
+        self.assertEqual((True, self.poolB.ownid), results[self.poolB.ownid])
+        success, failure = results[unreachable]
+        self.assertFalse(success)
+        self.assertTrue(failure.check(error.ConnectionRefusedError))
+        self.assertEqual(connectionpool.UP, self.poolA.peer_state(self.poolB.ownid))
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_keep_warm(self):
+        yield self.poolA.pre_connect_many([self.poolB.ownid], keep_warm=True)
+        self.poolB._connections[self.poolA.ownid][0].transport.loseConnection()
+        yield sleep(0.5)
+        self.assertEqual(connectionpool.UP, self.poolA.peer_state(self.poolB.ownid))
+        
+        self.poolA.stop_warm()
+        self.poolB._connections[self.poolA.ownid][0].transport.loseConnection()
+        yield sleep(0.5)
+        self.assertEqual(connectionpool.DISCONNECTED, self.poolA.peer_state(self.poolB.ownid))
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_pre_connect_shares_attempt(self):
+        d = self.poolA.send(self.poolB.ownid, "msg", "Hello World!")
+        peer = yield self.poolA.pre_connect(self.poolB.ownid)
+        yield d
+        yield self.poolB.packets.get()
+        self.assertEqual(self.poolB.ownid, peer)
+        self.assertEqual(1, self.poolA.stats()["opened"])
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_pre_connect_backoff(self):
+        unreachable = socket.getfqdn() + ":50009"
+        results = yield self.poolA.pre_connect_many([unreachable])
+        self.assertFalse(results[unreachable][0])
+        self.assertEqual(connectionpool.BACKOFF, self.poolA.peer_state(unreachable))
+        try:
+            yield self.poolA.pre_connect(unreachable)
+            self.fail("Expected PeerUnavailable")
+        except connectionpool.PeerUnavailable:
+            pass
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_rewarm_synchronous_failure(self):
+        # Creating the endpoint fails right away for this peer.
+        peer = "invalid"
+        self.poolA.reconnect_delay = 0.05
+        self.poolA._warm_peers.add(peer)
+        self.poolA._schedule_warm(peer)
+        yield sleep(0.2)
+        self.assertEqual(connectionpool.BACKOFF, self.poolA.peer_state(peer))
+        self.assertIn(peer, self.poolA._warm_timers)
+        
+        
+class TestAddressCache(unittest.TestCase):
+    
+    def setUp(self):
+        self.clock = task.Clock()
+        self.target = connectionpool.AddressCache(10, self.clock)
+        
+    def test_miss(self):
+        self.assertIsNone(self.target.get("peer"))
+        self.assertEqual(1, self.target.stats()["misses"])
+        
+    def test_hit(self):
+        self.target.set("peer", "10.0.0.1")
+        self.assertEqual("10.0.0.1", self.target.get("peer"))
+        self.assertEqual(1, self.target.stats()["hits"])
+        
+    def test_expire(self):
+        self.target.set("peer", "10.0.0.1")
+        self.clock.advance(10)
+        self.assertIsNone(self.target.get("peer"))
+        self.assertEqual(0, len(self.target))
+        
+    def test_seed(self):
+        self.target.seed({"a": "10.0.0.1", "b": "10.0.0.2"}, ttl=20)
+        self.clock.advance(15)
+        self.assertEqual("10.0.0.2", self.target.get("b"))
+        
+    def test_invalidate(self):
+        self.target.set("peer", "10.0.0.1")
+        self.target.invalidate("peer")
+        self.assertIsNone(self.target.get("peer"))
+        
+    def test_purge(self):
+        self.target.set("a", "10.0.0.1")
+        self.target.set("b", "10.0.0.2", ttl=20)
+        self.clock.advance(15)
+        self.target.purge()
+        self.assertEqual(1, len(self.target))
+        
+        
+class TestConnectionPoolLimits(unittest.TestCase):
+    
+    @defer.inlineCallbacks
+    def twisted_setup(self):
+        host = socket.getfqdn()
+        self.poolA = MockPool(endpoints.TCP4ServerEndpoint(reactor, 50000), host + ":50000",
+                              idle_timeout=0.2, max_connections=1)
+        self.poolB = MockPool(endpoints.TCP4ServerEndpoint(reactor, 50001), host + ":50001")
+        self.poolC = MockPool(endpoints.TCP4ServerEndpoint(reactor, 50002), host + ":50002")
+        for pool in (self.poolA, self.poolB, self.poolC):
+            pool.register_type("msg")
+            yield pool.open()
+        
+    @defer.inlineCallbacks
+    def twisted_teardown(self):
+        yield self.poolA.close()
+        yield self.poolB.close()
+        yield self.poolC.close()
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_idle(self):
+        yield self.poolA.send(self.poolB.ownid, "msg", "Hello World!")
+        yield self.poolB.packets.get()
+        self.assertEqual(1, self.poolA.stats()["connections"])
+        
+        yield sleep(0.5)
+        self.assertEqual(0, self.poolA.stats()["connections"])
+        self.assertEqual(1, self.poolA.stats()["reaped"])
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_busy_not_reaped(self):
+        self.poolA.busy_peers = lambda: set([self.poolB.ownid])
+        yield self.poolA.send(self.poolB.ownid, "msg", "Hello World!")
+        yield self.poolB.packets.get()
+        
+        yield sleep(0.5)
+        self.assertEqual(1, self.poolA.stats()["connections"])
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_traffic_retired(self):
+        yield self.poolA.send(self.poolB.ownid, "msg", "Hello World!")
+        yield self.poolB.packets.get()
+        try:
+            yield self.poolA.send("localhost:50009", "msg", "Hello World!")
+        except Exception:
+            pass
+        self.assertEqual(2, len(self.poolA.peer_stats()))
+        
+        yield sleep(0.8)
+        self.assertEqual({}, self.poolA.peer_stats())
+        retired = self.poolA.stats()["retired_traffic"]
+        self.assertEqual((1, 1, 1), (retired["opened"], retired["lost"], retired["packets_sent"]))
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_evict(self):
+        yield self.poolA.send(self.poolB.ownid, "msg", "Hello World!")
+        yield self.poolB.packets.get()
+        yield self.poolA.send(self.poolC.ownid, "msg", "Hello World!")
+        yield self.poolC.packets.get()
+        
+        stats = self.poolA.stats()
+        self.assertEqual(1, stats["connections"])
+        self.assertEqual(1, stats["evicted"])
+        self.assertEqual(2, stats["opened"])
+        self.assertEqual([self.poolC.ownid], self.poolA._connections.keys())
+        
+        
+class TestConnectionPoolStriping(unittest.TestCase):
+    
+    @defer.inlineCallbacks
+    def twisted_setup(self):
+        host = socket.getfqdn()
+        self.poolA = MockPool(endpoints.TCP4ServerEndpoint(reactor, 50000), host + ":50000",
+                              connections_per_peer=2)
+        self.poolB = MockPool(endpoints.TCP4ServerEndpoint(reactor, 50001), host + ":50001")
+        for pool in (self.poolA, self.poolB):
+            pool.register_type("msg")
+            yield pool.open()
+        
+    @defer.inlineCallbacks
+    def twisted_teardown(self):
+        yield self.poolA.close()
+        yield self.poolB.close()
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_second_connection(self):
+        yield self.poolA.send(self.poolB.ownid, "msg", "Hello")
+        yield sleep(0.2)
+        yield self.poolA.send(self.poolB.ownid, "msg", "World")
+        
+        yield self.poolB.packets.get()
+        yield self.poolB.packets.get()
+        
+        utilization = self.poolA.stats()["utilization"][self.poolB.ownid]
+        self.assertEqual(2, len(utilization))
+        self.assertEqual(2, sum(u["packets_sent"] for u in utilization))
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_affinity(self):
+        yield self.poolA.send(self.poolB.ownid, "msg", "Hello")
+        yield sleep(0.2)
+        for _ in range(10):
+            yield self.poolA.send(self.poolB.ownid, "msg", "World", affinity="key")
+        for _ in range(11):
+            yield self.poolB.packets.get()
+            
+        utilization = self.poolA.stats()["utilization"][self.poolB.ownid]
+        packets_sent = sorted(u["packets_sent"] for u in utilization)
+        self.assertIn(packets_sent, ([0, 11], [1, 10]))
+        
+        self.poolA.forget_affinity(self.poolB.ownid, "key")
+        self.assertEqual({}, self.poolA._affinities)
+        
+        
+def sleep(seconds):
+    d = defer.Deferred()
+    reactor.callLater(seconds, d.callback, None)  # @UndefinedVariable
+    return d
         
 class MockPool(connectionpool.ConnectionPool):
     
-    def __init__(self, stream_server_endpoint, ownid):
+    def __init__(self, stream_server_endpoint, ownid, **kwargs):
         def ownid_factory(_):
             return ownid
-        connectionpool.ConnectionPool.__init__(self, stream_server_endpoint, self.make_client_endpoint, ownid_factory)
+        connectionpool.ConnectionPool.__init__(self, stream_server_endpoint, self.make_client_endpoint, ownid_factory, **kwargs)
         self.packets = defer.DeferredQueue()
         
     def open(self):
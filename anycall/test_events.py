@@ -0,0 +1,72 @@
+# Copyright (c) 2014 Stefan C. Mueller
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import StringIO as stringio
+import unittest
+import uuid
+
+from anycall import events
+
+
+class TestEventRing(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.target = events.EventRing(3, clock=lambda: self.now)
+
+    def record(self, event, peer="peer", functionid=None):
+        callid = uuid.uuid4()
+        self.now += 1
+        self.target.record(event, peer, callid, functionid)
+        return callid
+
+    def test_record(self):
+        functionid = uuid.uuid4()
+        callid = self.record(events.CALL_SENT, "a", functionid)
+        self.record(events.RETURN_RECEIVED, "b")
+        first, second = self.target.events()
+        self.assertEqual((1.0, "call_sent", "a", callid, functionid), first)
+        self.assertEqual("b", second.peer)
+        self.assertEqual(None, second.functionid)
+
+    def test_long_peer(self):
+        peer = "a-rather-long-host-name.example.com:50000"
+        self.record(events.CALL_SENT, peer)
+        stored = self.target.events()[0].peer
+        self.assertEqual(events.PEER_SIZE, len(stored))
+        self.assertTrue(stored.startswith("..."))
+        self.assertTrue(peer.endswith(stored[3:]))
+
+    def test_wraps(self):
+        callids = [self.record(events.CALL_SENT) for _ in range(5)]
+        self.assertEqual(3, len(self.target))
+        self.assertEqual(callids[2:], [event.callid for event in self.target.events()])
+
+    def test_dump(self):
+        callid = self.record(events.CANCEL_SENT)
+        out = stringio.StringIO()
+        self.target.dump(out)
+        self.assertEqual("1.000000 cancel_sent     peer call=%s function=-\n" % callid.hex, out.getvalue())
+
+    def test_clear(self):
+        self.record(events.CALL_SENT)
+        self.target.clear()
+        self.assertEqual([], self.target.events())
@@ -0,0 +1,66 @@
+# Copyright (c) 2014 Stefan C. Mueller
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import unittest
+import collections
+
+from anycall.hashring import HashRing
+
+
+class TestHashRing(unittest.TestCase):
+
+    def setUp(self):
+        self.target = HashRing(["a", "b", "c"])
+        self.keys = ["key%s" % i for i in range(3000)]
+
+    def test_empty(self):
+        self.assertRaises(LookupError, HashRing().get, "key")
+
+    def test_stable(self):
+        other = HashRing(["c", "a", "b"])
+        for key in self.keys:
+            self.assertEqual(self.target.get(key), other.get(key))
+
+    def test_balanced(self):
+        counts = collections.Counter(self.target.get(key) for key in self.keys)
+        for node in ("a", "b", "c"):
+            self.assertGreater(counts[node], 700)
+
+    def test_weight(self):
+        self.target.add("c", weight=2)
+        counts = collections.Counter(self.target.get(key) for key in self.keys)
+        self.assertGreater(counts["c"], counts["a"])
+        self.assertGreater(counts["c"], counts["b"])
+
+    def test_add_moves_few_keys(self):
+        before = dict((key, self.target.get(key)) for key in self.keys)
+        self.target.add("d")
+        for key in self.keys:
+            node = self.target.get(key)
+            if node != before[key]:
+                self.assertEqual("d", node)
+
+    def test_remove_moves_few_keys(self):
+        before = dict((key, self.target.get(key)) for key in self.keys)
+        self.target.remove("b")
+        self.assertNotIn("b", self.target)
+        for key in self.keys:
+            if before[key] != "b":
+                self.assertEqual(before[key], self.target.get(key))
@@ -0,0 +1,126 @@
+# Copyright (c) 2014 Stefan C. Mueller
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import json
+import unittest
+import uuid
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+from anycall import metrics
+
+
+class TestHistogram(unittest.TestCase):
+
+    def setUp(self):
+        self.target = metrics.Histogram()
+
+    def test_empty(self):
+        self.assertEqual(None, self.target.percentile(0.5))
+        self.assertEqual(0, self.target.snapshot()["count"])
+
+    def test_percentiles(self):
+        values = [0.001 * i for i in range(1, 1001)]
+        self.target.record_many(values)
+        for q in (0.5, 0.9, 0.99):
+            expected = values[int(q * len(values)) - 1]
+            actual = self.target.percentile(q)
+            self.assertLessEqual(abs(actual - expected) / expected, 1.0 / metrics.SUB_BUCKETS)
+
+    def test_snapshot(self):
+        for value in (0.5, 1.0, 1.5):
+            self.target.record(value)
+        snapshot = self.target.snapshot()
+        self.assertEqual(3, snapshot["count"])
+        self.assertEqual(1.0, snapshot["mean"])
+        self.assertEqual(0.5, snapshot["min"])
+        self.assertEqual(1.5, snapshot["max"])
+        self.assertEqual(1.5, snapshot["p999"])
+
+    def test_zero_and_negative(self):
+        self.target.record_many([0.0, -1e-6, 0.25])
+        self.assertEqual(3, sum(self.target.counts.values()))
+        self.assertLess(self.target.percentile(0.5), 1e-300)
+
+    def test_merge(self):
+        other = metrics.Histogram()
+        self.target.record(1.0)
+        other.record_many([2.0, 3.0])
+        self.target.merge(other)
+        self.assertEqual(3, self.target.count)
+        self.assertEqual(3.0, self.target.max)
+        self.assertEqual(1.0, self.target.min)
+
+    def test_to_dict(self):
+        self.target.record_many([0.001, 0.002, 0.5])
+        state = json.loads(json.dumps(self.target.to_dict()))
+        copy = metrics.Histogram.from_dict(state)
+        self.assertEqual(self.target.snapshot(), copy.snapshot())
+
+
+class TestCallMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.time = 0
+        self.target = metrics.CallMetrics(clock=lambda: self.time)
+        self.functionid = uuid.uuid4()
+
+    def call(self, duration, result=None):
+        token = self.target.started(self.target.caller, self.functionid, "peer")
+        self.time += duration
+        self.target.finished(result, token)
+
+    def stats(self):
+        return self.target.snapshot()["caller"][self.functionid.hex]["peer"]
+
+    def test_counts(self):
+        self.call(1)
+        self.call(2, Failure(ValueError()))
+        self.call(3, Failure(defer.CancelledError()))
+        stats = self.stats()
+        self.assertEqual(3, stats["calls"])
+        self.assertEqual(1, stats["errors"])
+        self.assertEqual(1, stats["cancelled"])
+        self.assertEqual(3, stats["latency"]["max"])
+
+    def test_in_flight(self):
+        self.target.started(self.target.caller, self.functionid, "peer")
+        self.assertEqual(1, self.stats()["in_flight"])
+
+    def test_fold(self):
+        for _ in range(metrics.FOLD_THRESHOLD + 1):
+            self.call(1)
+        self.assertEqual(metrics.FOLD_THRESHOLD + 1, self.stats()["calls"])
+
+    def test_fold_all(self):
+        self.call(1)
+        self.target.started(self.target.caller, self.functionid, "peer")
+        self.target.fold()
+        stats = self.target.caller[self.functionid.int, "peer"]
+        self.assertEqual(([], 1, 1), (stats._pending, stats._latency.count, stats.in_flight))
+
+    def test_reset(self):
+        self.call(1)
+        token = self.target.started(self.target.caller, self.functionid, "peer")
+        self.target.reset()
+        self.assertEqual((0, 1), (self.stats()["calls"], self.stats()["in_flight"]))
+        self.target.finished(None, token)
+        self.assertEqual((1, 0), (self.stats()["calls"], self.stats()["in_flight"]))
@@ -0,0 +1,66 @@
+# Copyright (c) 2014 Stefan C. Mueller
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import unittest
+import uuid
+
+from anycall import profiling
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.target = profiling.Profiler(top=2, clock=lambda: self.now)
+        self.functionid = uuid.uuid4()
+
+    def call(self, duration):
+        profile = profiling.CallProfile(self.target, self.functionid, "peer", 100, self.now, 0.0)
+        profile.dispatched()
+        self.now += duration
+        self.assertEqual("result", profile.executed("result"))
+        profile.replied(0.0, 10)
+        profile.finish()
+        return profile
+
+    def test_phases(self):
+        self.target.record("return", None, "unpickle", 1.0)
+        self.target.record("return", self.functionid, "unpickle", 3.0)
+        snapshot = self.target.snapshot()
+        stats = snapshot["kinds"]["return"]["unpickle"]
+        self.assertEqual(2, stats["count"])
+        self.assertEqual(2.0, stats["mean"])
+        self.assertEqual(3.0, stats["max"])
+        self.assertEqual(1, snapshot["functions"][self.functionid.hex]["return"]["unpickle"]["count"])
+
+    def test_call(self):
+        self.call(0.5)
+        snapshot = self.target.snapshot()
+        self.assertEqual(0.5, snapshot["kinds"]["call"]["execute"]["total"])
+        slowest, = snapshot["slowest"]
+        self.assertEqual(0.5, slowest["total"])
+        self.assertEqual(100, slowest["request_bytes"])
+        self.assertEqual(10, slowest["reply_bytes"])
+
+    def test_top(self):
+        for duration in (0.3, 0.1, 0.4, 0.2):
+            self.call(duration)
+        self.assertEqual([0.4, 0.3], [profile.total for profile in self.target.slowest()])
@@ -0,0 +1,107 @@
+# Copyright (c) 2014 Stefan C. Mueller
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING 
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import gc
+import unittest
+
+from anycall.registry import FunctionRegistry, FunctionExpired
+
+
+class TestFunctionRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.target = FunctionRegistry(clock=lambda: self.now)
+
+    def test_register_lookup(self):
+        def myfunc():
+            pass
+        functionid = self.target.register(myfunc)
+        self.assertIs(myfunc, self.target.lookup(functionid))
+
+    def test_register_twice(self):
+        def myfunc():
+            pass
+        self.assertEqual(self.target.register(myfunc), self.target.register(myfunc))
+
+    def test_bound_method_twice(self):
+        obj = Dummy()
+        self.assertEqual(self.target.register(obj.method), self.target.register(obj.method))
+
+    def test_unknown(self):
+        functionid = self.target.register(Dummy().method)
+        self.target.unregister(functionid)
+        self.assertRaises(FunctionExpired, self.target.lookup, functionid)
+
+    def test_never_registered(self):
+        import uuid
+        self.assertRaises(ValueError, self.target.lookup, uuid.uuid4())
+
+    def test_unregister_function(self):
+        def myfunc():
+            pass
+        functionid = self.target.register(myfunc)
+        self.assertTrue(self.target.unregister(myfunc))
+        self.assertFalse(self.target.unregister(myfunc))
+        self.assertNotIn(functionid, self.target)
+
+    def test_weak(self):
+        obj = Dummy()
+        functionid = self.target.register(obj.method, weak=True)
+        self.assertEqual(obj, self.target.lookup(functionid)())
+        del obj
+        gc.collect()
+        self.assertNotIn(functionid, self.target)
+        self.assertEqual(1, self.target.stats()["collected"])
+        self.assertRaises(FunctionExpired, self.target.lookup, functionid)
+
+    def test_ttl(self):
+        self.target.ttl = 10
+        functionid_a = self.target.register(lambda: "a")
+        self.now = 5
+        functionid_b = self.target.register(lambda: "b")
+        self.now = 12
+        self.assertRaises(FunctionExpired, self.target.lookup, functionid_a)
+        self.assertEqual("b", self.target.lookup(functionid_b)())
+        self.assertEqual(1, self.target.stats()["expired"])
+
+    def test_lru(self):
+        self.target.max_size = 2
+        functionid_a = self.target.register(lambda: "a")
+        functionid_b = self.target.register(lambda: "b")
+        self.target.lookup(functionid_a)
+        functionid_c = self.target.register(lambda: "c")
+        self.assertNotIn(functionid_b, self.target)
+        self.assertIn(functionid_a, self.target)
+        self.assertIn(functionid_c, self.target)
+        self.assertEqual(1, self.target.stats()["evicted"])
+
+    def test_pinned(self):
+        self.target.max_size = 0
+        self.target.ttl = 1
+        functionid = self.target.register(lambda: "a", pinned=True)
+        self.now = 100
+        self.assertEqual("a", self.target.lookup(functionid)())
+
+
+class Dummy(object):
+    def method(self):
+        return self
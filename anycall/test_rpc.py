@@ -4,11 +4,13 @@ import unittest
 import pickle
 import cPickle
 import StringIO as stringio
+import uuid
 
 import utwist
-from twisted.internet import defer, reactor
+from twisted.internet import defer, reactor, error, task
+from twisted.python.failure import Failure
 
-from anycall import rpc
+from anycall import rpc, registry, tracing
 from anycall.rpc import RPCSystem
 
 
@@ -140,6 +142,12 @@ class TestRPC(unittest.TestCase):
         yield d
 
 
+    @utwist.with_reactor
+    def test_reply_for_unknown_call(self):
+        # The reply of a cancelled call may still arrive. It is dropped.
+        self.rpcB._CallReturn_received(self.rpcA.ownid, rpc._CallReturn(uuid.uuid1(), 42))
+        self.rpcB._CallFail_received(self.rpcA.ownid, rpc._CallFail(uuid.uuid1(), Failure(ValueError())))
+
     @utwist.with_reactor
     @defer.inlineCallbacks
     def test_cancel_callee(self):
@@ -277,4 +285,800 @@ class TestRPC(unittest.TestCase):
         reactor.callLater(2, slow.callback, "Hello World!")  # @UndefinedVariable
         
         actual = yield myfunc_stub_loaded()
-        self.assertEqual("Hello World!", actual)
\ No newline at end of file
+        self.assertEqual("Hello World!", actual)
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_object_call(self):
+        
+        class Greeter(object):
+            def __init__(self):
+                self.greeting = "Hello"
+            def greet(self, entity):
+                return "%s %s!" % (self.greeting, entity)
+        
+        obj_url = self.rpcA.get_object_url(Greeter())
+        obj_stub = self.rpcB.create_object_stub(obj_url)
+        
+        actual = yield obj_stub.greet("World")
+        self.assertEqual("Hello World!", actual)
+        
+        
+    @utwist.with_reactor
+    def test_object_private_method(self):
+        obj_url = self.rpcA.get_object_url(object())
+        obj_stub = self.rpcB.create_object_stub(obj_url)
+        self.assertRaises(AttributeError, getattr, obj_stub, "__class__x")
+        
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_object_released(self):
+        self.rpcA._object_lease = 0.3
+        self.rpcA._gc_interval = 0.1
+        self.rpcB._gc_interval = 0.1
+        
+        class Counter(object):
+            def increment(self, x):
+                return x + 1
+        
+        obj_url = self.rpcA.get_object_url(Counter())
+        obj_stub = self.rpcB.create_object_stub(obj_url)
+        objectid = obj_stub.objectid
+        
+        yield sleep(0.5)
+        self.assertEqual({self.rpcB.ownid:1}, self.rpcA._object_holders[objectid])
+        actual = yield obj_stub.increment(1)
+        self.assertEqual(2, actual)
+        
+        del obj_stub
+        yield sleep(1)
+        self.assertNotIn(objectid, self.rpcA._objects)
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_object_holder_gone(self):
+        rpcC = rpc.create_tcp_rpc_system(port_range=[50002])
+        yield rpcC.open()
+        for rpcsystem in (self.rpcA, rpcC):
+            rpcsystem._object_lease = 0.1
+            rpcsystem._gc_interval = 0.05
+            rpcsystem._holder_lease = 0.6
+            rpcsystem._holder_loop.stop()
+            rpcsystem._holder_loop.start(0.2, now=False)
+        
+        obj_url = self.rpcA.get_object_url(object())
+        obj_stub = rpcC.create_object_stub(obj_url)
+        objectid = obj_stub.objectid
+        
+        # Renewed holds keep the object alive beyond the lease.
+        yield sleep(1)
+        self.assertEqual({rpcC.ownid: 1}, self.rpcA._object_holders[objectid])
+        
+        # The holder goes away without releasing its stub.
+        yield rpcC.close()
+        yield sleep(1)
+        self.assertNotIn(objectid, self.rpcA._objects)
+        self.assertNotIn(rpcC.ownid, self.rpcA._holder_renewed)
+        del obj_stub
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_seed_addresses(self):
+        
+        def myfunc():
+            return "Hello World!"
+        
+        self.rpcB.seed_addresses({self.rpcA.ownid: "127.0.0.1"})
+        
+        myfunc_url = self.rpcA.get_function_url(myfunc)
+        myfunc_stub = self.rpcB.create_function_stub(myfunc_url)
+        actual = yield myfunc_stub()
+        self.assertEqual("Hello World!", actual)
+        self.assertEqual(1, self.rpcB._connectionpool.address_cache.stats()["hits"])
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_replay_idempotent(self):
+        
+        invocations = []
+        first_called = defer.Deferred()
+        
+        def myfunc():
+            invocations.append(None)
+            if len(invocations) == 1:
+                first_called.callback(None)
+                return defer.Deferred()
+            return "Hello World!"
+        
+        myfunc_url = self.rpcA.get_function_url(myfunc)
+        myfunc_stub = self.rpcB.create_function_stub(myfunc_url, idempotent=True)
+        
+        d = myfunc_stub()
+        yield first_called
+        yield sleep(0.1)
+        
+        # Simulate that A has lost the call together with the connection.
+        self.rpcA._remote_to_local.clear()
+        for c in list(self.rpcB._connectionpool._connections[self.rpcA.ownid]):
+            c.transport.loseConnection()
+        
+        actual = yield d
+        self.assertEqual("Hello World!", actual)
+        self.assertEqual(2, len(invocations))
+        
+
+def sleep(seconds):
+    d = defer.Deferred()
+    reactor.callLater(seconds, d.callback, None)  # @UndefinedVariable
+    return d
+        
+        
+class TestRPCFunctionRegistry(unittest.TestCase):
+    
+    @defer.inlineCallbacks
+    def twisted_setup(self):
+        self.rpcA = rpc.create_tcp_rpc_system(port_range=[50000])
+        self.rpcB = rpc.create_tcp_rpc_system(port_range=[50001])
+        
+        yield self.rpcA.open()
+        yield self.rpcB.open()
+        
+    @defer.inlineCallbacks
+    def twisted_teardown(self):
+        yield self.rpcA.close()
+        yield self.rpcB.close()
+    
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_unregistered(self):
+        
+        def myfunc():
+            return "Hello World!"
+        
+        myfunc_url = self.rpcA.get_function_url(myfunc)
+        myfunc_stub = self.rpcB.create_function_stub(myfunc_url)
+        self.assertTrue(self.rpcA.unregister_function(myfunc_url))
+
+        try:
+            yield myfunc_stub()
+            self.fail("expected FunctionExpired")
+        except registry.FunctionExpired:
+            pass
+        self.assertEqual(1, self.rpcA.function_stats()["unregistered"])
+
+
+class TestRPCSocketOptions(unittest.TestCase):
+    
+    @defer.inlineCallbacks
+    def twisted_setup(self):
+        self.rpcA = rpc.create_tcp_rpc_system(port_range=[50000], socket_profile="low-latency")
+        self.rpcB = rpc.create_tcp_rpc_system(port_range=[50001], socket_profile={"sndbuf": 64 * 1024})
+        
+        yield self.rpcA.open()
+        yield self.rpcB.open()
+        
+    @defer.inlineCallbacks
+    def twisted_teardown(self):
+        yield self.rpcA.close()
+        yield self.rpcB.close()
+    
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_settings(self):
+        
+        def myfunc():
+            return "Hello World!"
+        
+        myfunc_url = self.rpcA.get_function_url(myfunc)
+        myfunc_stub = self.rpcB.create_function_stub(myfunc_url)
+        yield myfunc_stub()
+        
+        settingsA = self.rpcA._connectionpool.stats()["utilization"][self.rpcB.ownid][0]["settings"]
+        settingsB = self.rpcB._connectionpool.stats()["utilization"][self.rpcA.ownid][0]["settings"]
+        self.assertTrue(settingsA["nodelay"])
+        self.assertTrue(settingsA["keepalive"])
+        self.assertGreaterEqual(settingsB["sndbuf"], 64 * 1024)
+        
+    def test_unknown_profile(self):
+        self.assertRaises(ValueError, rpc.create_tcp_rpc_system, socket_profile="fast")
+        self.assertRaises(ValueError, rpc.create_tcp_rpc_system, socket_profile={"nagle": False})
+
+
+class TestRPCSharedPort(unittest.TestCase):
+    
+    @defer.inlineCallbacks
+    def twisted_setup(self):
+        self.worker1 = rpc.create_tcp_rpc_system(port_range=[50000], shared_port=50002)
+        self.worker2 = rpc.create_tcp_rpc_system(port_range=[50001], shared_port=50002)
+        self.client = rpc.create_tcp_rpc_system()
+        
+        yield self.worker1.open()
+        yield self.worker2.open()
+        yield self.client.open()
+        
+    @defer.inlineCallbacks
+    def twisted_teardown(self):
+        for rpcsystem in (self.worker1, self.worker2, self.client):
+            if rpcsystem._opened:
+                yield rpcsystem.close()
+    
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_named_function(self):
+        url1 = self.worker1.get_function_url(lambda: self.worker1.ownid, name="whoami")
+        url2 = self.worker2.get_function_url(lambda: self.worker2.ownid, name="whoami")
+        self.assertEqual(url1, url2)
+        self.assertEqual(self.worker1.shared_id, rpc._parse_url(url1, "functions", "function")[0])
+        
+        actual = yield self.client.create_function_stub(url1)()
+        self.assertIn(actual, (self.worker1.ownid, self.worker2.ownid))
+        
+        protocol = self.client._connectionpool._connections[self.worker1.shared_id][0]
+        self.assertEqual(actual, protocol.worker)
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_named_function_worker_dies(self):
+        started = defer.Deferred()
+        def hang(worker):
+            def hang():
+                started.callback(worker)
+                return defer.Deferred()
+            return hang
+        url = self.worker1.get_function_url(hang(self.worker1), name="hang")
+        self.worker2.get_function_url(hang(self.worker2), name="hang")
+        
+        d = self.client.create_function_stub(url)()
+        worker = yield started
+        
+        # The worker dies and takes the call with it. The client reconnects
+        # to the surviving worker, which does not know the call.
+        worker._remote_to_local.clear()
+        yield worker.close()
+        try:
+            yield d
+            self.fail("Expected the call to fail")
+        except (ValueError, rpc.UnpicklableFailure) as e:
+            self.assertIn("in progress", str(e))
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_worker_function(self):
+        url = self.worker2.get_function_url(lambda: self.worker2.ownid)
+        actual = yield self.client.create_function_stub(url)()
+        self.assertEqual(self.worker2.ownid, actual)
+
+
+class TestRPCReplicas(unittest.TestCase):
+    
+    @defer.inlineCallbacks
+    def twisted_setup(self):
+        self.rpcA = rpc.create_tcp_rpc_system(port_range=[50000])
+        self.rpcB = rpc.create_tcp_rpc_system(port_range=[50001])
+        self.rpcC = rpc.create_tcp_rpc_system(port_range=[50002])
+        
+        yield self.rpcA.open()
+        yield self.rpcB.open()
+        yield self.rpcC.open()
+        
+    @defer.inlineCallbacks
+    def twisted_teardown(self):
+        yield self.rpcA.close()
+        yield self.rpcB.close()
+        yield self.rpcC.close()
+    
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_least_outstanding(self):
+        pendingB = defer.Deferred()
+        pendingC = defer.Deferred()
+        
+        urls = [self.rpcB.get_function_url(lambda: pendingB), 
+                self.rpcC.get_function_url(lambda: pendingC)]
+        stub = self.rpcA.create_replica_stub(urls, choices=None)
+        
+        d1 = stub()
+        d2 = stub()
+        self.assertEqual(1, self.rpcA.outstanding_calls(self.rpcB.ownid))
+        self.assertEqual(1, self.rpcA.outstanding_calls(self.rpcC.ownid))
+        yield sleep(0.1)
+        
+        pendingB.callback("B")
+        pendingC.callback("C")
+        actual = yield defer.gatherResults([d1, d2])
+        self.assertEqual(["B", "C"], sorted(actual))
+        self.assertEqual(0, self.rpcA.outstanding_calls(self.rpcB.ownid))
+        self.assertEqual(0, self.rpcA.outstanding_calls(self.rpcC.ownid))
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_eject(self):
+        
+        def myfunc():
+            return "Hello World!"
+        
+        url = self.rpcB.get_function_url(myfunc)
+        unreachable = url.replace(self.rpcB.ownid, self.rpcB.ownid.split(":")[0] + ":50009")
+        stub = self.rpcA.create_replica_stub([unreachable, url], idempotent=True)
+        
+        for _ in range(3):
+            actual = yield stub()
+            self.assertEqual("Hello World!", actual)
+        self.assertTrue(all(peer != self.rpcB.ownid for peer, _ in stub._ejected))
+
+
+class TestRPCSharded(unittest.TestCase):
+    
+    @defer.inlineCallbacks
+    def twisted_setup(self):
+        self.rpcA = rpc.create_tcp_rpc_system(port_range=[50000])
+        self.rpcB = rpc.create_tcp_rpc_system(port_range=[50001])
+        self.rpcC = rpc.create_tcp_rpc_system(port_range=[50002])
+        
+        yield self.rpcA.open()
+        yield self.rpcB.open()
+        yield self.rpcC.open()
+        
+        def make_shard(rpcsystem):
+            def get(key, default=None):
+                if key == "fail":
+                    raise KeyError(key)
+                if key == "unpicklable":
+                    raise KeyError(lambda: key)
+                return (rpcsystem.ownid, key)
+            return rpcsystem.get_function_url(get)
+        
+        self.urls = [make_shard(self.rpcB), make_shard(self.rpcC)]
+        self.stub = self.rpcA.create_sharded_stub(self.urls)
+        
+    @defer.inlineCallbacks
+    def twisted_teardown(self):
+        yield self.rpcA.close()
+        yield self.rpcB.close()
+        yield self.rpcC.close()
+    
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_call(self):
+        for key in ("x", "y", "z"):
+            peerid, actual = yield self.stub(key)
+            self.assertEqual(key, actual)
+            self.assertIn(peerid, self.stub.shard_for(key))
+            
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_call_many(self):
+        keys = ["key%s" % i for i in range(20)]
+        results = yield self.stub.call_many([(key,) for key in keys] + [("fail",)])
+        
+        for key, (success, (peerid, actual)) in zip(keys, results[:-1]):
+            self.assertTrue(success)
+            self.assertEqual(key, actual)
+            self.assertIn(peerid, self.stub.shard_for(key))
+            
+        success, failure = results[-1]
+        self.assertFalse(success)
+        self.assertTrue(failure.check(KeyError))
+        
+        stats = self.stub.stats()
+        self.assertEqual(21, sum(s["keys"] for s in stats.itervalues()))
+        self.assertEqual(2, sum(s["calls"] for s in stats.itervalues()))
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_call_many_unpicklable_exception(self):
+        keys = ["key%s" % i for i in range(20)]
+        results = yield self.stub.call_many([(key,) for key in keys] + [("unpicklable",)])
+        
+        for key, (success, (_, actual)) in zip(keys, results[:-1]):
+            self.assertTrue(success)
+            self.assertEqual(key, actual)
+            
+        success, failure = results[-1]
+        self.assertFalse(success)
+        self.assertTrue(failure.check(rpc.UnpicklableFailure))
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_remove_shard(self):
+        self.stub.remove_shard(self.urls[0])
+        peerid, _ = yield self.stub("x")
+        self.assertEqual(self.rpcC.ownid, peerid)
+
+
+class TestRPCBroadcast(unittest.TestCase):
+    
+    @defer.inlineCallbacks
+    def twisted_setup(self):
+        self.rpcA = rpc.create_tcp_rpc_system(port_range=[50000])
+        self.rpcB = rpc.create_tcp_rpc_system(port_range=[50001])
+        self.rpcC = rpc.create_tcp_rpc_system(port_range=[50002])
+        
+        yield self.rpcA.open()
+        yield self.rpcB.open()
+        yield self.rpcC.open()
+        
+        self.hang = defer.Deferred()
+        
+        def myfunc(value, hang=False):
+            if hang:
+                return self.hang
+            if value is None:
+                raise ValueError("no value")
+            return value * 2
+        
+        self.urlB = self.rpcB.get_function_url(myfunc)
+        self.urlC = self.rpcC.get_function_url(lambda value, hang=False: myfunc(value))
+        
+    @defer.inlineCallbacks
+    def twisted_teardown(self):
+        yield self.rpcA.close()
+        yield self.rpcB.close()
+        yield self.rpcC.close()
+    
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_all(self):
+        results, failures = yield self.rpcA.broadcast([self.urlB, self.urlC], (21,))
+        self.assertEqual({self.urlB: 42, self.urlC: 42}, results)
+        self.assertEqual({}, failures)
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_failures(self):
+        results, failures = yield self.rpcA.broadcast([self.urlB, self.urlC], (None,))
+        self.assertEqual({}, results)
+        self.assertEqual(set([self.urlB, self.urlC]), set(failures))
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_first(self):
+        results, failures = yield self.rpcA.broadcast([self.urlB, self.urlC], (21,), {"hang": True}, wait=1)
+        self.assertEqual({self.urlC: 42}, results)
+        self.assertEqual({}, failures)
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_timeout(self):
+        results, failures = yield self.rpcA.broadcast([self.urlB, self.urlC], (21,), {"hang": True}, 
+                                                      timeout=0.2)
+        self.assertEqual({self.urlC: 42}, results)
+        self.assertTrue(failures[self.urlB].check(error.TimeoutError))
+
+
+class TestRPCRelayBroadcast(unittest.TestCase):
+    
+    @defer.inlineCallbacks
+    def twisted_setup(self):
+        self.systems = [rpc.create_tcp_rpc_system(port_range=[port]) for port in range(50000, 50005)]
+        for system in self.systems:
+            yield system.open()
+            
+        def make_function(system):
+            def myfunc(value):
+                if value is None:
+                    raise ValueError()
+                return value
+            return system.get_function_url(myfunc)
+        self.urls = [make_function(system) for system in self.systems[1:]]
+        
+    @defer.inlineCallbacks
+    def twisted_teardown(self):
+        for system in self.systems:
+            yield system.close()
+    
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_collect(self):
+        result, failures = yield self.systems[0].relay_broadcast(self.urls, (42,), fanout=2)
+        self.assertEqual(dict((url, 42) for url in self.urls), result)
+        self.assertEqual({}, failures)
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_combiner(self):
+        result, failures = yield self.systems[0].relay_broadcast(self.urls, (3,), fanout=2, combiner=sum)
+        self.assertEqual(12, result)
+        self.assertEqual({}, failures)
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_failures(self):
+        result, failures = yield self.systems[0].relay_broadcast(self.urls, (None,), fanout=2, combiner=sum)
+        self.assertIsNone(result)
+        self.assertEqual(set(self.urls), set(failures))
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_relayer_hangs(self):
+        hanging = self.systems[1].get_function_url(lambda value: defer.Deferred())
+        urls = [hanging] + self.urls[1:]
+        result, failures = yield self.systems[0].relay_broadcast(urls, (42,), fanout=1, timeout=1)
+        self.assertEqual(dict((url, 42) for url in self.urls[1:]), result)
+        self.assertEqual([hanging], failures.keys())
+        self.assertTrue(failures[hanging].check(error.TimeoutError))
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_bad_payload(self):
+        result, failures = yield self.systems[1]._relay(self.urls[0], self.urls[1:], "garbage", 2, None, None)
+        self.assertEqual({}, result)
+        # The children were contacted, each reports its own failure.
+        self.assertEqual(set(self.urls), set(failures))
+
+
+class TestRPCCallMetrics(unittest.TestCase):
+    
+    @defer.inlineCallbacks
+    def twisted_setup(self):
+        self.rpcA = rpc.create_tcp_rpc_system(port_range=[50000], call_metrics=True)
+        self.rpcB = rpc.create_tcp_rpc_system(port_range=[50001], call_metrics=True)
+        yield self.rpcA.open()
+        yield self.rpcB.open()
+        
+    @defer.inlineCallbacks
+    def twisted_teardown(self):
+        yield self.rpcA.close()
+        yield self.rpcB.close()
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_calls(self):
+        url = self.rpcA.get_function_url(lambda x: x)
+        stub = self.rpcB.create_function_stub(url)
+        for i in range(3):
+            yield stub(i)
+        functionid = url.rsplit("/", 1)[1]
+        
+        caller = self.rpcB.call_metrics()["caller"][functionid][self.rpcA.ownid]
+        self.assertEqual(3, caller["calls"])
+        self.assertEqual(0, caller["errors"])
+        self.assertEqual(0, caller["in_flight"])
+        self.assertEqual(3, caller["latency"]["count"])
+        
+        callee = self.rpcA.call_metrics()["callee"][functionid][self.rpcB.ownid]
+        self.assertEqual(3, callee["calls"])
+        self.assertLessEqual(callee["latency"]["max"], caller["latency"]["max"])
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_errors(self):
+        def fail():
+            raise ValueError("fail")
+        url = self.rpcA.get_function_url(fail)
+        try:
+            yield self.rpcB.create_function_stub(url)()
+        except Exception:
+            pass
+        functionid = url.rsplit("/", 1)[1]
+        self.assertEqual(1, self.rpcB.call_metrics()["caller"][functionid][self.rpcA.ownid]["errors"])
+        self.assertEqual(1, self.rpcA.call_metrics()["callee"][functionid][self.rpcB.ownid]["errors"])
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_in_flight_and_cancelled(self):
+        started = defer.Deferred()
+        def hang():
+            started.callback(None)
+            return defer.Deferred()
+        url = self.rpcA.get_function_url(hang)
+        functionid = url.rsplit("/", 1)[1]
+        d = self.rpcB.create_function_stub(url)()
+        yield started
+        self.assertEqual(1, self.rpcB.call_metrics()["caller"][functionid][self.rpcA.ownid]["in_flight"])
+        self.assertEqual(1, self.rpcA.call_metrics()["callee"][functionid][self.rpcB.ownid]["in_flight"])
+        
+        d.cancel()
+        try:
+            yield d
+        except defer.CancelledError:
+            pass
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        caller = self.rpcB.call_metrics()["caller"][functionid][self.rpcA.ownid]
+        callee = self.rpcA.call_metrics()["callee"][functionid][self.rpcB.ownid]
+        self.assertEqual((0, 1), (caller["in_flight"], caller["cancelled"]))
+        self.assertEqual((0, 1), (callee["in_flight"], callee["cancelled"]))
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_internal_calls(self):
+        url = self.rpcA.get_function_url(lambda: defer.Deferred())
+        functionid = url.rsplit("/", 1)[1]
+        d = self.rpcB.create_function_stub(url)()
+        # Long enough for the ping loop to ping the call.
+        yield sleep(1.5)
+        self.assertEqual([functionid], self.rpcB.call_metrics()["caller"].keys())
+        self.assertEqual([functionid], self.rpcA.call_metrics()["callee"].keys())
+        d.cancel()
+        try:
+            yield d
+        except defer.CancelledError:
+            pass
+        
+    @utwist.with_reactor
+    def test_disabled(self):
+        rpcsystem = rpc.create_tcp_rpc_system()
+        self.assertEqual({"caller": {}, "callee": {}}, rpcsystem.call_metrics())
+
+
+class TestRPCTracing(unittest.TestCase):
+    
+    @defer.inlineCallbacks
+    def twisted_setup(self):
+        self.spans = []
+        self.rpcA = rpc.create_tcp_rpc_system(port_range=[50000], 
+                                              tracer=tracing.Tracer(1.0, self.spans.append))
+        self.rpcB = rpc.create_tcp_rpc_system(port_range=[50001], 
+                                              tracer=tracing.Tracer(1.0, self.spans.append))
+        self.rpcC = rpc.create_tcp_rpc_system(port_range=[50002], 
+                                              tracer=tracing.Tracer(1.0, self.spans.append))
+        yield self.rpcA.open()
+        yield self.rpcB.open()
+        yield self.rpcC.open()
+        
+    @defer.inlineCallbacks
+    def twisted_teardown(self):
+        yield self.rpcA.close()
+        yield self.rpcB.close()
+        yield self.rpcC.close()
+        
+    @defer.inlineCallbacks
+    def wait_for_spans(self, count):
+        # The callee finishes its span once the reply is sent, which
+        # may be after the caller got it.
+        for _ in range(100):
+            if len(self.spans) >= count:
+                break
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual(count, len(self.spans))
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_call(self):
+        url = self.rpcA.get_function_url(lambda x: x)
+        yield self.rpcB.create_function_stub(url)(1)
+        yield self.wait_for_spans(2)
+        
+        client, = [span for span in self.spans if span.kind == "client"]
+        server, = [span for span in self.spans if span.kind == "server"]
+        self.assertEqual(client.trace_id, server.trace_id)
+        self.assertEqual(None, client.parent_id)
+        self.assertEqual(client.span_id, server.parent_id)
+        self.assertEqual(self.rpcA.ownid, client.peer)
+        self.assertEqual(self.rpcB.ownid, server.peer)
+        self.assertEqual(set(["start", "send", "reply"]), set(client.events))
+        self.assertEqual(set(["receive", "execute_start", "execute_end", "reply"]), set(server.events))
+        self.assertEqual(None, server.error)
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_nested(self):
+        inner_url = self.rpcC.get_function_url(lambda: "inner")
+        inner_stub = self.rpcA.create_function_stub(inner_url)
+        outer_url = self.rpcA.get_function_url(lambda: inner_stub())
+        actual = yield self.rpcB.create_function_stub(outer_url)()
+        self.assertEqual("inner", actual)
+        yield self.wait_for_spans(4)
+        
+        self.assertEqual(1, len(set(span.trace_id for span in self.spans)))
+        by_id = dict((span.span_id, span) for span in self.spans)
+        inner_server, = [span for span in self.spans if span.kind == "server" and span.peer == self.rpcA.ownid]
+        inner_client = by_id[inner_server.parent_id]
+        outer_server = by_id[inner_client.parent_id]
+        outer_client = by_id[outer_server.parent_id]
+        self.assertEqual(None, outer_client.parent_id)
+        self.assertEqual(self.rpcA.ownid, outer_client.peer)
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_error(self):
+        def fail():
+            raise ValueError("fail")
+        url = self.rpcA.get_function_url(fail)
+        try:
+            yield self.rpcB.create_function_stub(url)()
+        except Exception:
+            pass
+        yield self.wait_for_spans(2)
+        for span in self.spans:
+            self.assertNotEqual(None, span.error)
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_not_sampled(self):
+        self.rpcB.tracer.sample_rate = 0
+        url = self.rpcA.get_function_url(lambda: None)
+        yield self.rpcB.create_function_stub(url)()
+        yield task.deferLater(reactor, 0.05, lambda: None)
+        self.assertEqual([], self.spans)
+
+
+class TestRPCProfiling(unittest.TestCase):
+    
+    @defer.inlineCallbacks
+    def twisted_setup(self):
+        self.rpcA = rpc.create_tcp_rpc_system(port_range=[50000])
+        self.rpcB = rpc.create_tcp_rpc_system(port_range=[50001])
+        yield self.rpcA.open()
+        yield self.rpcB.open()
+        
+    @defer.inlineCallbacks
+    def twisted_teardown(self):
+        yield self.rpcA.close()
+        yield self.rpcB.close()
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_profile(self):
+        self.rpcA.start_profiling(top=2)
+        self.rpcB.start_profiling()
+        url = self.rpcA.get_function_url(lambda data: len(data))
+        stub = self.rpcB.create_function_stub(url)
+        for size in (10, 10000, 100):
+            yield stub("x" * size)
+        functionid = url.rsplit("/", 1)[1]
+        
+        callee = self.rpcA.stop_profiling()
+        for phase in ("unpickle", "dispatch", "execute"):
+            self.assertEqual(3, callee["functions"][functionid]["call"][phase]["count"])
+        for phase in ("pickle", "frame", "send_queue"):
+            self.assertEqual(3, callee["functions"][functionid]["return"][phase]["count"])
+        self.assertEqual(2, len(callee["slowest"]))
+        self.assertEqual(functionid, callee["slowest"][0]["function"])
+        self.assertTrue(all(call["request_bytes"] >= 100 for call in callee["slowest"]))
+        
+        caller = self.rpcB.profile()
+        self.assertEqual(3, caller["functions"][functionid]["call"]["pickle"]["count"])
+        self.assertEqual(3, caller["kinds"]["return"]["unpickle"]["count"])
+        self.assertEqual([], caller["slowest"])
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_disabled(self):
+        url = self.rpcA.get_function_url(lambda: None)
+        yield self.rpcB.create_function_stub(url)()
+        self.assertEqual({"kinds": {}, "functions": {}, "slowest": []}, self.rpcA.profile())
+
+
+class TestRPCEvents(unittest.TestCase):
+    
+    @defer.inlineCallbacks
+    def twisted_setup(self):
+        self.rpcA = rpc.create_tcp_rpc_system(port_range=[50000])
+        self.rpcB = rpc.create_tcp_rpc_system(port_range=[50001])
+        yield self.rpcA.open()
+        yield self.rpcB.open()
+        
+    @defer.inlineCallbacks
+    def twisted_teardown(self):
+        yield self.rpcA.close()
+        yield self.rpcB.close()
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_events(self):
+        self.rpcA.enable_events()
+        self.rpcB.enable_events()
+        url = self.rpcA.get_function_url(lambda: None)
+        functionid = url.rsplit("/", 1)[1]
+        yield self.rpcB.create_function_stub(url)()
+        
+        caller = self.rpcB.events.events()
+        self.assertEqual(["call_sent", "return_received"], [event.name for event in caller])
+        self.assertEqual(functionid, caller[0].functionid.hex)
+        self.assertEqual(self.rpcA.ownid, caller[0].peer)
+        
+        callee = self.rpcA.events.events()
+        self.assertEqual(["call_received", "return_sent"], [event.name for event in callee])
+        self.assertEqual(caller[0].callid, callee[1].callid)
+        self.assertEqual(functionid, callee[1].functionid.hex)
+        
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_disabled(self):
+        url = self.rpcA.get_function_url(lambda: None)
+        self.rpcB.enable_events()
+        self.rpcB.disable_events()
+        yield self.rpcB.create_function_stub(url)()
+        self.assertEqual(None, self.rpcB.events)
@@ -0,0 +1,169 @@
+# Copyright (c) 2014 Stefan C. Mueller
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import unittest
+import os
+import mmap
+import shutil
+import tempfile
+
+import utwist
+from twisted.internet import defer, protocol, reactor
+from twisted.test import proto_helpers
+
+from anycall import rpc, shmtransport
+from anycall.shmtransport import RingBuffer
+from anycall.rpc import RPCSystem
+
+
+class TestRingBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.mm = mmap.mmap(-1, RingBuffer.required_size(8))
+        self.target = RingBuffer(self.mm, 0, 8)
+
+    def tearDown(self):
+        self.mm.close()
+
+    def test_empty(self):
+        self.assertEqual(0, self.target.available())
+        self.assertEqual("", self.target.read())
+
+    def test_write_read(self):
+        self.assertEqual(3, self.target.write("abc"))
+        self.assertEqual("abc", self.target.read())
+        self.assertEqual(8, self.target.free())
+
+    def test_full(self):
+        self.assertEqual(8, self.target.write("0123456789"))
+        self.assertEqual(0, self.target.write("x"))
+        self.assertEqual("01234567", self.target.read())
+
+    def test_wrap_around(self):
+        self.target.write("012345")
+        self.target.read()
+        self.assertEqual(5, self.target.write("abcde"))
+        self.assertEqual("abcde", self.target.read())
+
+    def test_blocked_flag(self):
+        self.assertFalse(self.target.blocked)
+        self.target.blocked = True
+        self.assertTrue(self.target.blocked)
+
+
+class TestOpenSegment(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.other = tempfile.mkdtemp()
+        self.path, mm = shmtransport._create_segment(8, self.other)
+        mm.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        shutil.rmtree(self.other)
+
+    def test_accepted(self):
+        shmtransport._open_segment(self.path, 8, self.other, os.getuid()).close()
+
+    def test_other_directory(self):
+        self.assertRaises(ValueError, shmtransport._open_segment, self.path, 8, self.directory, os.getuid())
+
+    def test_symlink(self):
+        link = os.path.join(self.directory, "anycall-link.shm")
+        os.symlink(self.path, link)
+        self.assertRaises(OSError, shmtransport._open_segment, link, 8, self.directory, os.getuid())
+
+    def test_owner(self):
+        self.assertRaises(ValueError, shmtransport._open_segment, self.path, 8, self.other, os.getuid() + 1)
+
+
+class TestSHMServerChannel(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path, self.mm = shmtransport._create_segment(8, self.directory)
+
+    def tearDown(self):
+        self.mm.close()
+        shutil.rmtree(self.directory)
+
+    def test_refused(self):
+        refusing = protocol.Factory()
+        refusing.buildProtocol = lambda addr: None
+        factory = shmtransport._SHMServerFactory(reactor, refusing, self.directory)
+        channel = factory.buildProtocol(None)
+        channel.makeConnection(proto_helpers.StringTransport())
+
+        # Data right behind the setup line is not serviced.
+        channel.dataReceived("%s %s 8\ndata" % (shmtransport._SETUP, self.path))
+        self.assertIsNone(channel.shm_transport)
+        self.assertTrue(channel.transport.disconnecting)
+
+
+class TestSHMRPC(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def twisted_setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.rpcA = rpc.create_shm_rpc_system("A", directory=self.directory, capacity=64*1024)
+        self.rpcB = rpc.create_shm_rpc_system("B", directory=self.directory, capacity=64*1024)
+
+        yield self.rpcA.open()
+        yield self.rpcB.open()
+
+    @defer.inlineCallbacks
+    def twisted_teardown(self):
+        yield self.rpcA.close()
+        yield self.rpcB.close()
+        RPCSystem.default = None
+        shutil.rmtree(self.directory)
+
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_simple_call(self):
+
+        def myfunc(entity):
+            return "Hello %s!" % entity
+
+        myfunc_url = self.rpcA.get_function_url(myfunc)
+        myfunc_stub = self.rpcB.create_function_stub(myfunc_url)
+
+        actual = yield myfunc_stub("World")
+        self.assertEqual("Hello World!", actual)
+
+    @utwist.with_reactor
+    @defer.inlineCallbacks
+    def test_larger_than_ring(self):
+
+        def myfunc(data):
+            return data[::-1]
+
+        myfunc_url = self.rpcA.get_function_url(myfunc)
+        myfunc_stub = self.rpcB.create_function_stub(myfunc_url)
+
+        data = "".join(chr(i % 256) for i in range(1024*1024))
+        actual = yield myfunc_stub(data)
+        self.assertEqual(data[::-1], actual)
+
+    @utwist.with_reactor
+    def test_socket_mode(self):
+        mode = os.stat(os.path.join(self.directory, "A.sock")).st_mode
+        self.assertEqual(0600, mode & 0777)
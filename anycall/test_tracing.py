@@ -0,0 +1,89 @@
+# Copyright (c) 2014 Stefan C. Mueller
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+
+from twisted.python.failure import Failure
+
+from anycall import tracing
+
+
+class TestTracer(unittest.TestCase):
+
+    def setUp(self):
+        self.spans = []
+        self.now = 0.0
+        self.target = tracing.Tracer(1.0, self.spans.append, clock=lambda: self.now)
+        self.functionid = uuid.uuid4()
+
+    def test_sampling(self):
+        self.assertIsNotNone(self.target.start_client(self.functionid, "peer"))
+        self.target.sample_rate = 0
+        self.assertIsNone(self.target.start_client(self.functionid, "peer"))
+
+    def test_inherits_current(self):
+        self.target.sample_rate = 0
+        parent = self.target.start_server((1, 2), self.functionid, "peer")
+        with tracing.activate(parent):
+            self.assertIs(parent, tracing.current_span())
+            child = self.target.start_client(self.functionid, "other")
+        self.assertIsNone(tracing.current_span())
+        self.assertEqual(1, child.trace_id)
+        self.assertEqual(parent.span_id, child.parent_id)
+
+    def test_finish(self):
+        span = self.target.start_client(self.functionid, "peer")
+        self.now = 1.0
+        self.target.mark(span, "send")
+        self.now = 2.0
+        failure = Failure(ValueError("fail"))
+        self.assertIs(failure, self.target.finish(span, "reply", failure))
+        self.assertEqual({"start": 0.0, "send": 1.0, "reply": 2.0}, span.events)
+        self.assertEqual("ValueError: fail", span.error)
+        self.assertEqual([span], self.spans)
+
+
+class TestFileExporter(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_export(self):
+        path = os.path.join(self.directory, "spans.json")
+        exporter = tracing.FileExporter(path)
+        tracer = tracing.Tracer(1.0, exporter)
+        span = tracer.start_client(uuid.uuid4(), "peer")
+        tracer.finish(span, "reply")
+        exporter.close()
+
+        with open(path) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(1, len(lines))
+        self.assertEqual("%016x" % span.trace_id, lines[0]["trace_id"])
+        self.assertEqual(None, lines[0]["parent_id"])
+        self.assertEqual("client", lines[0]["kind"])
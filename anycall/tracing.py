@@ -0,0 +1,202 @@
+# Copyright (c) 2014 Stefan C. Mueller
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Tracing of calls across processes.
+
+A :class:`Tracer` passed to the :class:`anycall.rpc.RPCSystem` decides
+for each call made outside of a traced call whether to trace it
+(`sample_rate`). Traced calls carry the trace id and the id of the
+caller's span in the `_Call` message. Calls made by a function while it
+handles a traced call belong to the same trace.
+
+Each call results in a `client` span on the caller and a `server` span
+on the callee, handed to the tracer's `exporter` once finished. Client
+spans record when the call was made (`start`), `send` and when the
+`reply` arrived. Server spans record `receive`, `execute_start`,
+`execute_end` and `reply`.
+
+The span of the call being handled is only current while the function
+runs. Calls made later, in callbacks, have to restore it::
+
+    def handler():
+        span = tracing.current_span()
+        d = task.deferLater(reactor, 1, lambda: None)
+        def later(_):
+            with tracing.activate(span):
+                return other_stub()
+        d.addCallback(later)
+        return d
+"""
+
+import contextlib
+import json
+import random
+import time
+
+from twisted.python.failure import Failure
+
+#: Span of the call being handled, if it is traced.
+_current = None
+
+
+def current_span():
+    """
+    Returns the span of the traced call being handled, or `None`.
+    """
+    return _current
+
+
+@contextlib.contextmanager
+def activate(span):
+    """
+    Makes `span` the current span within the `with` block, so that
+    calls made there belong to its trace.
+    """
+    global _current
+    previous = _current
+    _current = span
+    try:
+        yield span
+    finally:
+        _current = previous
+
+
+class Span(object):
+    """
+    One side of a traced call.
+    """
+
+    def __init__(self, trace_id, span_id, parent_id, kind, name, peer):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_id = parent_id
+
+        #: `client` or `server`.
+        self.kind = kind
+
+        #: Function id of the call, in hex.
+        self.name = name
+
+        #: The other side of the call.
+        self.peer = peer
+
+        #: Maps `event -> time`.
+        self.events = {}
+
+        #: Description of the failure, if the call failed.
+        self.error = None
+
+    def to_dict(self):
+        return {"trace_id": "%016x" % self.trace_id,
+                "span_id": "%016x" % self.span_id,
+                "parent_id": "%016x" % self.parent_id if self.parent_id is not None else None,
+                "kind": self.kind,
+                "name": self.name,
+                "peer": self.peer,
+                "events": self.events,
+                "error": self.error}
+
+
+class Tracer(object):
+    """
+    Creates spans for sampled calls and exports them once finished.
+    """
+
+    def __init__(self, sample_rate=0.01, exporter=None, clock=time.time):
+        """
+        :param sample_rate: Fraction of the calls made outside of a
+          traced call that start a new trace.
+
+        :param exporter: Callable invoked with each finished :class:`Span`.
+
+        :param clock: Function returning the current time in seconds.
+        """
+        self.sample_rate = sample_rate
+        self.exporter = exporter
+        self.clock = clock
+
+    def start_client(self, functionid, peerid):
+        """
+        Starts the span for a call we make, if it is traced.
+
+        :returns: :class:`Span` or `None`.
+        """
+        parent = _current
+        if parent is not None:
+            trace_id, parent_id = parent.trace_id, parent.span_id
+        elif self.sample_rate and random.random() < self.sample_rate:
+            trace_id, parent_id = random.getrandbits(64), None
+        else:
+            return None
+        span = Span(trace_id, random.getrandbits(64), parent_id, "client", functionid.hex, peerid)
+        span.events["start"] = self.clock()
+        return span
+
+    def start_server(self, trace, functionid, peerid):
+        """
+        Starts the span for a call made to us.
+
+        :param trace: `(trace_id, parent_span_id)` sent by the caller.
+        """
+        trace_id, parent_id = trace
+        span = Span(trace_id, random.getrandbits(64), parent_id, "server", functionid.hex, peerid)
+        span.events["receive"] = self.clock()
+        return span
+
+    def mark(self, span, event, result=None):
+        """
+        Records the current time for the given event.
+
+        :param result: Outcome of the call so far. Marks the span as
+          failed if it is a :class:`Failure`.
+        """
+        span.events[event] = self.clock()
+        if isinstance(result, Failure):
+            span.error = "%s: %s" % (result.type.__name__, result.getErrorMessage())
+
+    def finish(self, span, event, result=None):
+        """
+        Records the last event and exports the span.
+
+        :returns: `result`, so this can be added to a Deferred.
+        """
+        self.mark(span, event, result)
+        if self.exporter is not None:
+            self.exporter(span)
+        return result
+
+
+class FileExporter(object):
+    """
+    Appends spans to a file, one JSON object per line.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, "a")
+
+    def __call__(self, span):
+        self._file.write(json.dumps(span.to_dict()) + "\n")
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,190 @@
+# Copyright (c) 2014 Stefan C. Mueller
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Compares calls per second and latency of the Twisted and asyncio backends.
+
+Run once per backend::
+
+    python2 benchmarks/bench_backends.py --concurrency 64
+    python3 benchmarks/bench_backends.py --concurrency 64
+
+Python 2 measures :mod:`anycall.rpc`, Python 3 :mod:`anycall.aio`.
+The server is a separate process using the same backend as the client.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BACKEND = "twisted" if sys.version_info[0] < 3 else "asyncio"
+
+
+def echo(data):
+    return data
+
+
+def report(args, latencies, elapsed):
+    latencies.sort()
+
+    def percentile(p):
+        return 1000.0 * latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+    print("%-8s %10.0f calls/s   p50 %7.3f ms   p99 %7.3f ms   (concurrency %d, %d bytes)" % (
+        BACKEND, len(latencies) / elapsed, percentile(0.5), percentile(0.99),
+        args.concurrency, args.size))
+
+
+def twisted_server():
+    from twisted.internet import reactor
+    import anycall
+
+    rpcsystem = anycall.create_tcp_rpc_system()
+
+    def started(_):
+        sys.stdout.write(rpcsystem.get_function_url(echo) + "\n")
+        sys.stdout.flush()
+
+    rpcsystem.open().addCallback(started)
+    reactor.run()
+
+
+def twisted_client(args, url):
+    from twisted.internet import defer, reactor
+    import anycall
+
+    @defer.inlineCallbacks
+    def run():
+        rpcsystem = anycall.create_tcp_rpc_system()
+        yield rpcsystem.open()
+        stub = rpcsystem.create_function_stub(url)
+        data = b"x" * args.size
+        latencies = []
+
+        @defer.inlineCallbacks
+        def caller(calls):
+            for _ in range(calls):
+                start = time.time()
+                yield stub(data)
+                latencies.append(time.time() - start)
+
+        try:
+            yield caller(args.concurrency)  # warm up the connections
+            del latencies[:]
+            start = time.time()
+            yield defer.gatherResults([caller(args.calls // args.concurrency)
+                                       for _ in range(args.concurrency)])
+            report(args, latencies, time.time() - start)
+        finally:
+            yield rpcsystem.close()
+
+    reactor.callWhenRunning(lambda: run().addBoth(lambda _: reactor.stop()))
+    reactor.run()
+
+
+def asyncio_server():
+    import asyncio
+    from anycall import aio
+
+    loop = asyncio.new_event_loop()
+    rpcsystem = aio.create_tcp_rpc_system(loop=loop)
+    loop.run_until_complete(rpcsystem.open())
+    sys.stdout.write(rpcsystem.get_function_url(echo) + "\n")
+    sys.stdout.flush()
+    loop.run_forever()
+
+
+def asyncio_client(args, url):
+    import asyncio
+    from anycall import aio
+
+    loop = asyncio.new_event_loop()
+    rpcsystem = aio.create_tcp_rpc_system(loop=loop)
+    loop.run_until_complete(rpcsystem.open())
+    stub = rpcsystem.create_function_stub(url)
+    data = b"x" * args.size
+    latencies = []
+
+    # Chained callbacks rather than coroutines, so that this file
+    # still parses on Python 2.
+    def caller(calls):
+        done = loop.create_future()
+        state = {"left": calls}
+
+        def call():
+            if not state["left"]:
+                done.set_result(None)
+                return
+            state["left"] -= 1
+            start = time.time()
+
+            def returned(future):
+                if future.exception() is not None:
+                    done.set_exception(future.exception())
+                    return
+                latencies.append(time.time() - start)
+                call()
+            asyncio.ensure_future(stub(data), loop=loop).add_done_callback(returned)
+        call()
+        return done
+
+    def gather(concurrency, calls):
+        return asyncio.gather(*[caller(calls) for _ in range(concurrency)])
+
+    try:
+        loop.run_until_complete(gather(1, args.concurrency))  # warm up the connections
+        del latencies[:]
+        start = time.time()
+        loop.run_until_complete(gather(args.concurrency, args.calls // args.concurrency))
+        report(args, latencies, time.time() - start)
+    finally:
+        loop.run_until_complete(rpcsystem.close())
+        loop.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--calls", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--size", type=int, default=64, help="Bytes of arguments per call.")
+    parser.add_argument("--server", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    server, client = (twisted_server, twisted_client) if BACKEND == "twisted" else (asyncio_server, asyncio_client)
+
+    if args.server:
+        return server()
+
+    process = subprocess.Popen([sys.executable, __file__, "--server"], stdout=subprocess.PIPE)
+    try:
+        url = process.stdout.readline().decode("ascii").strip()
+        client(args, url)
+    finally:
+        process.terminate()
+
+
+if __name__ == "__main__":
+    main()
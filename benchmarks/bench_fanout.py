@@ -0,0 +1,125 @@
+# Copyright (c) 2014 Stefan C. Mueller
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Compares a flat :meth:`RPCSystem.broadcast` with a tree-relayed
+:meth:`RPCSystem.relay_broadcast` to worker processes on this host.
+
+Run with::
+
+    python benchmarks/bench_fanout.py --workers 32 --fanout 4 --size 65536
+
+Each worker is a separate process with its own :class:`RPCSystem`.
+Reports the time per broadcast and the bytes the coordinator sent.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from twisted.internet import defer, reactor
+
+import anycall
+
+
+def payload_length(data):
+    return len(data)
+
+
+def worker():
+    rpcsystem = anycall.create_tcp_rpc_system()
+
+    def started(_):
+        sys.stdout.write(rpcsystem.get_function_url(payload_length) + "\n")
+        sys.stdout.flush()
+
+    rpcsystem.open().addCallback(started)
+    reactor.run()
+
+
+def coordinator_bytes_sent(rpcsystem):
+    utilization = rpcsystem._connectionpool.stats()["utilization"]
+    return sum(u["bytes_sent"] for conns in utilization.itervalues() for u in conns)
+
+
+@defer.inlineCallbacks
+def measure(name, broadcast, rpcsystem, rounds):
+    yield broadcast()  # warm up the connections
+    bytes_before = coordinator_bytes_sent(rpcsystem)
+    start = time.time()
+    for _ in range(rounds):
+        yield broadcast()
+    elapsed = time.time() - start
+    sent = coordinator_bytes_sent(rpcsystem) - bytes_before
+    print "%-6s %8.2f ms/broadcast %12d bytes sent by coordinator/broadcast" % (
+        name, 1000.0 * elapsed / rounds, sent // rounds)
+
+
+@defer.inlineCallbacks
+def run(args, urls):
+    rpcsystem = anycall.create_tcp_rpc_system()
+    yield rpcsystem.open()
+    data = "x" * args.size
+
+    def flat():
+        return rpcsystem.broadcast(urls, (data,))
+
+    def relayed():
+        return rpcsystem.relay_broadcast(urls, (data,), fanout=args.fanout, combiner=sum)
+
+    try:
+        yield measure("flat", flat, rpcsystem, args.rounds)
+        yield measure("relay", relayed, rpcsystem, args.rounds)
+    finally:
+        yield rpcsystem.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--fanout", type=int, default=4)
+    parser.add_argument("--size", type=int, default=64 * 1024, help="Bytes of arguments per call.")
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        return worker()
+
+    processes = [subprocess.Popen([sys.executable, __file__, "--worker"], stdout=subprocess.PIPE)
+                 for _ in range(args.workers)]
+    try:
+        urls = [p.stdout.readline().strip() for p in processes]
+
+        def done(_):
+            reactor.stop()
+        reactor.callWhenRunning(lambda: run(args, urls).addBoth(done))
+        reactor.run()
+    finally:
+        for p in processes:
+            p.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,437 @@
+# Copyright (c) 2014 Stefan C. Mueller
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Load test with several server and client processes on this host.
+
+Run with::
+
+    python benchmarks/bench_load.py --servers 4 --clients 8 --mode open --rate 500
+    python benchmarks/bench_load.py --mode closed --concurrency 32 --mix echo:8,work:1,chain:1
+
+Every server and client is a separate process with its own reactor and
+:class:`anycall.RPCSystem`. The servers offer three functions:
+
+`echo`
+  Returns its argument.
+`work`
+  Keeps the CPU busy for `--cpu-ms` milliseconds.
+`chain`
+  Passes the call on to `--chain-depth - 1` further servers before it
+  returns.
+
+The clients call a function chosen by the weights of `--mix` on a
+random server, with a payload size picked from `--payload`. In
+`closed` mode each client keeps `--concurrency` calls in progress. In
+`open` mode each client starts `--rate` calls per second regardless of
+how many are still in progress, and latencies are measured from the time
+a call was due, so that a server falling behind shows in the latency.
+
+Once the clients are done, the latency histograms of all clients and
+the time the servers spent executing are merged into one report, along
+with the CPU usage of every process. `--json` writes it to a file.
+"""
+
+import argparse
+import json
+import random
+import resource
+import subprocess
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from twisted.internet import defer, reactor, stdio, task
+from twisted.protocols import basic
+
+import anycall
+from anycall import metrics
+
+FUNCTIONS = ("echo", "work", "chain")
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class _Usage(object):
+    """
+    CPU and wall time since :meth:`reset`.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.cpu = cpu_time()
+        self.wall = time.time()
+
+    def snapshot(self):
+        cpu = cpu_time() - self.cpu
+        wall = time.time() - self.wall
+        return {"cpu": cpu, "wall": wall}
+
+
+class _ServerControl(basic.LineReceiver):
+    """
+    Commands from the coordinator on stdin: `start` begins the
+    measurement, `report` writes the report to stdout.
+    """
+    delimiter = "\n"
+
+    def __init__(self, rpcsystem, urls):
+        self.rpcsystem = rpcsystem
+        self.urls = urls
+        self.usage = _Usage()
+
+    def lineReceived(self, line):
+        if line == "start":
+            self.usage.reset()
+            self.rpcsystem.metrics.reset()
+        elif line == "report":
+            self.transport.write(json.dumps(self.report()) + "\n")
+
+    def report(self):
+        names = dict((int(url.rsplit("/", 1)[1], 16), name) for name, url in self.urls.iteritems())
+        histograms = {}
+        errors = dict.fromkeys(FUNCTIONS, 0)
+        for (functionid, _), stats in self.rpcsystem.metrics.callee.iteritems():
+            name = names.get(functionid, None)
+            if name is None:
+                continue
+            histograms.setdefault(name, metrics.Histogram()).merge(stats.latency)
+            errors[name] += stats.errors
+        report = self.usage.snapshot()
+        report["execute"] = dict((name, h.to_dict()) for name, h in histograms.iteritems())
+        report["errors"] = errors
+        return report
+
+
+def server(args):
+    rpcsystem = anycall.create_tcp_rpc_system(call_metrics=True)
+    stubs = {}
+
+    def echo(data):
+        return data
+
+    def work(data, cpu_ms):
+        end = time.time() + cpu_ms / 1000.0
+        while time.time() < end:
+            pass
+        return len(data)
+
+    def chain(data, urls):
+        if not urls:
+            return len(data)
+        stub = stubs.get(urls[0], None)
+        if stub is None:
+            stub = stubs[urls[0]] = rpcsystem.create_function_stub(urls[0])
+        return stub(data, urls[1:])
+
+    def started(_):
+        urls = {"echo": rpcsystem.get_function_url(echo),
+                "work": rpcsystem.get_function_url(work),
+                "chain": rpcsystem.get_function_url(chain)}
+        sys.stdout.write(json.dumps(urls) + "\n")
+        sys.stdout.flush()
+        stdio.StandardIO(_ServerControl(rpcsystem, urls))
+
+    rpcsystem.open().addCallback(started)
+    reactor.run()
+
+
+class _Client(object):
+
+    def __init__(self, rpcsystem, config):
+        self.rpcsystem = rpcsystem
+        self.config = config
+        self.servers = config["servers"]
+        self.payloads = ["x" * size for size in config["payload"]]
+        self.stubs = {}
+
+        names, weights = zip(*sorted(config["mix"].iteritems()))
+        self.names = names
+        self.weights = [sum(weights[:i + 1]) for i in range(len(weights))]
+
+        #: Maps `function -> [latency]`.
+        self.latencies = dict((name, []) for name in FUNCTIONS)
+        self.errors = dict.fromkeys(FUNCTIONS, 0)
+        self.in_progress = 0
+
+    def _stub(self, url):
+        stub = self.stubs.get(url, None)
+        if stub is None:
+            stub = self.stubs[url] = self.rpcsystem.create_function_stub(url)
+        return stub
+
+    def call(self, due):
+        """
+        Makes one call of the mix.
+
+        :param due: Time the latency is measured from.
+        """
+        r = random.uniform(0, self.weights[-1])
+        name = self.names[[i for i, w in enumerate(self.weights) if r <= w][0]]
+        data = random.choice(self.payloads)
+        server = random.choice(self.servers)
+
+        if name == "echo":
+            d = self._stub(server["echo"])(data)
+        elif name == "work":
+            d = self._stub(server["work"])(data, self.config["cpu_ms"])
+        else:
+            hops = [random.choice(self.servers)["chain"] for _ in range(self.config["chain_depth"] - 1)]
+            d = self._stub(server["chain"])(data, hops)
+
+        self.in_progress += 1
+
+        def succeeded(_):
+            self.latencies[name].append(time.time() - due)
+
+        def failed(failure):
+            self.errors[name] += 1
+
+        def done(_):
+            self.in_progress -= 1
+        d.addCallbacks(succeeded, failed)
+        d.addBoth(done)
+        return d
+
+    @defer.inlineCallbacks
+    def closed_loop(self, deadline):
+        @defer.inlineCallbacks
+        def worker():
+            while time.time() < deadline:
+                yield self.call(time.time())
+        yield defer.gatherResults([worker() for _ in range(self.config["concurrency"])])
+
+    def open_loop(self, deadline):
+        """
+        Starts `rate` calls per second until the deadline, then waits
+        up to `drain` seconds for those still in progress.
+        """
+        rate = self.config["rate"]
+        start = time.time()
+        state = {"started": 0}
+        done = defer.Deferred()
+
+        def tick():
+            now = time.time()
+            if now >= deadline:
+                ticker.stop()
+                drain(now + self.config["drain"])
+                return
+            while state["started"] < int((now - start) * rate):
+                self.call(start + state["started"] / float(rate))
+                state["started"] += 1
+
+        def drain(until):
+            if not self.in_progress or time.time() >= until:
+                done.callback(None)
+            else:
+                reactor.callLater(0.01, drain, until)
+
+        ticker = task.LoopingCall(tick)
+        ticker.start(0.001)
+        return done
+
+    def report(self, usage):
+        report = usage.snapshot()
+        histograms = {}
+        for name, latencies in self.latencies.iteritems():
+            if latencies:
+                histogram = metrics.Histogram()
+                histogram.record_many(latencies)
+                histograms[name] = histogram.to_dict()
+        report["latency"] = histograms
+        report["errors"] = self.errors
+        report["unfinished"] = self.in_progress
+        return report
+
+
+def client(args):
+    config = json.loads(args.config)
+    rpcsystem = anycall.create_tcp_rpc_system()
+    target = _Client(rpcsystem, config)
+
+    @defer.inlineCallbacks
+    def run():
+        yield rpcsystem.open()
+        usage = _Usage()
+        deadline = time.time() + config["duration"]
+        if config["mode"] == "open":
+            yield target.open_loop(deadline)
+        else:
+            yield target.closed_loop(deadline)
+        sys.stdout.write(json.dumps(target.report(usage)) + "\n")
+        sys.stdout.flush()
+        yield rpcsystem.close()
+
+    def done(result):
+        reactor.stop()
+        return result
+
+    reactor.callWhenRunning(lambda: run().addBoth(done))
+    reactor.run()
+
+
+def merge_histograms(reports, key):
+    merged = {}
+    for report in reports:
+        for name, state in report[key].iteritems():
+            merged.setdefault(name, metrics.Histogram()).merge(metrics.Histogram.from_dict(state))
+    return merged
+
+
+def summarize(args, server_reports, client_reports):
+    latency = merge_histograms(client_reports, "latency")
+    execute = merge_histograms(server_reports, "execute")
+    functions = {}
+    for name in FUNCTIONS:
+        if name not in latency and name not in execute:
+            continue
+        functions[name] = {
+            "calls_per_s": latency[name].count / args.duration if name in latency else 0.0,
+            "errors": sum(report["errors"][name] for report in client_reports),
+            "latency": latency[name].snapshot() if name in latency else None,
+            "execute": execute[name].snapshot() if name in execute else None}
+    processes = []
+    for role, reports in (("server", server_reports), ("client", client_reports)):
+        for i, report in enumerate(reports):
+            processes.append({"role": role,
+                              "index": i,
+                              "cpu": report["cpu"],
+                              "cpu_percent": 100.0 * report["cpu"] / report["wall"]})
+    return {"config": vars(args),
+            "calls_per_s": sum(f["calls_per_s"] for f in functions.itervalues()),
+            "unfinished": sum(report["unfinished"] for report in client_reports),
+            "functions": functions,
+            "processes": processes}
+
+
+def print_summary(summary):
+    print "%.0f calls/s, %d unfinished" % (summary["calls_per_s"], summary["unfinished"])
+    print
+    print "%-6s %10s %7s %9s %9s %9s %9s %12s" % (
+        "", "calls/s", "errors", "p50 ms", "p90 ms", "p99 ms", "p999 ms", "exec p99 ms")
+    for name, stats in sorted(summary["functions"].iteritems()):
+        latency = stats["latency"] or {}
+
+        def ms(snapshot, key):
+            value = (snapshot or {}).get(key, None)
+            return "%9.3f" % (1000 * value) if value is not None else "%9s" % "-"
+        print "%-6s %10.0f %7d %s %s %s %s    %s" % (
+            name, stats["calls_per_s"], stats["errors"], ms(latency, "p50"), ms(latency, "p90"),
+            ms(latency, "p99"), ms(latency, "p999"), ms(stats["execute"], "p99"))
+    print
+    for process in summary["processes"]:
+        print "%-6s %3d  cpu %7.2fs %6.1f%%" % (process["role"], process["index"],
+                                               process["cpu"], process["cpu_percent"])
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition(":")
+        if name not in FUNCTIONS:
+            raise argparse.ArgumentTypeError("Unknown function %r, expected one of %s." % (name, ", ".join(FUNCTIONS)))
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def parse_sizes(text):
+    return [int(size) for size in text.split(",")]
+
+
+def coordinate(args):
+    command = [sys.executable, os.path.abspath(__file__)]
+    servers = [subprocess.Popen(command + ["--role", "server"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+               for _ in range(args.servers)]
+    clients = []
+    try:
+        urls = [json.loads(p.stdout.readline()) for p in servers]
+        for p in servers:
+            p.stdin.write("start\n")
+            p.stdin.flush()
+
+        config = {"servers": urls,
+                  "mode": args.mode,
+                  "rate": args.rate,
+                  "concurrency": args.concurrency,
+                  "duration": args.duration,
+                  "drain": args.drain,
+                  "payload": args.payload,
+                  "mix": args.mix,
+                  "cpu_ms": args.cpu_ms,
+                  "chain_depth": args.chain_depth}
+        clients = [subprocess.Popen(command + ["--role", "client", "--config", json.dumps(config)],
+                                    stdout=subprocess.PIPE)
+                   for _ in range(args.clients)]
+        client_reports = [json.loads(p.stdout.readline()) for p in clients]
+
+        server_reports = []
+        for p in servers:
+            p.stdin.write("report\n")
+            p.stdin.flush()
+            server_reports.append(json.loads(p.stdout.readline()))
+    finally:
+        for p in servers + clients:
+            if p.poll() is None:
+                p.terminate()
+
+    summary = summarize(args, server_reports, client_reports)
+    print_summary(summary)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--servers", type=int, default=2)
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--mode", choices=("open", "closed"), default="closed")
+    parser.add_argument("--rate", type=float, default=200, help="Calls per second per client in open mode.")
+    parser.add_argument("--concurrency", type=int, default=16, help="Calls in progress per client in closed mode.")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds the clients make calls.")
+    parser.add_argument("--drain", type=float, default=5,
+                        help="Seconds to wait for calls in progress once the duration is over in open mode.")
+    parser.add_argument("--payload", type=parse_sizes, default=[64], help="Comma separated payload sizes in bytes.")
+    parser.add_argument("--mix", type=parse_mix, default={"echo": 1.0},
+                        help="Comma separated `function:weight` pairs of echo, work and chain.")
+    parser.add_argument("--cpu-ms", type=float, default=1.0, help="Milliseconds of CPU per call of `work`.")
+    parser.add_argument("--chain-depth", type=int, default=2, help="Servers a call of `chain` passes through.")
+    parser.add_argument("--json", metavar="PATH", help="Write the report to this file.")
+    parser.add_argument("--role", choices=("server", "client"), help=argparse.SUPPRESS)
+    parser.add_argument("--config", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.role == "server":
+        return server(args)
+    if args.role == "client":
+        return client(args)
+    coordinate(args)
+
+
+if __name__ == "__main__":
+    main()
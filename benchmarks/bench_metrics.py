@@ -0,0 +1,100 @@
+# Copyright (c) 2014 Stefan C. Mueller
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Measures the time :class:`anycall.metrics.CallMetrics` adds to each call.
+
+Run with::
+
+    python benchmarks/bench_metrics.py --calls 10000
+
+The time spent on the call path and the time spent later to add the
+latencies to the histograms are reported separately.
+"""
+
+import argparse
+import os
+import sys
+import timeit
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from anycall import metrics, rpc
+
+
+def measure(target, calls):
+    """
+    Does what :meth:`anycall.rpc.RPCSystem._invoke_function` does for
+    the metrics of a call, including the check if the call is measured
+    and the closure that reports the result.
+
+    :param target: :class:`anycall.metrics.CallMetrics` or `None`.
+
+    :returns: Seconds per call spent on the call path.
+    """
+    functionid = uuid.uuid4()
+    peerid = "localhost:50000"
+    unmeasured = rpc.RPCSystem._UNMEASURED
+
+    def call():
+        measured = target is not None and functionid.int not in unmeasured
+        if measured:
+            token = target.started(target.caller, functionid, peerid)
+        released = []
+        def release(result):
+            if not released:
+                released.append(True)
+                if measured:
+                    target.finished(result, token)
+        release(None)
+
+    # Folds between the runs, like the ping loop does.
+    fold = target.fold if target is not None else (lambda: None)
+    return min(timeit.repeat(call, setup=fold, number=calls, repeat=20)) / calls
+
+
+def measure_fold(calls):
+    """
+    :returns: Seconds per call spent in :meth:`anycall.metrics.CallMetrics.fold`.
+    """
+    target = metrics.CallMetrics()
+    functionid = uuid.uuid4()
+    for _ in xrange(calls):
+        target.finished(None, target.started(target.caller, functionid, "localhost:50000"))
+    return timeit.timeit(target.fold, number=1) / calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--calls", type=int, default=1000000)
+    args = parser.parse_args()
+
+    # Like the ping loop of the RPC system, fold before the threshold
+    # is reached so that no bucketing happens on the call path.
+    calls = min(args.calls, metrics.FOLD_THRESHOLD - 1)
+    baseline = measure(None, calls)
+    enabled = measure(metrics.CallMetrics(), calls)
+    print "%.3f us per call added by the metrics on the call path" % ((enabled - baseline) * 1e6)
+    print "%.3f us per call to fold the latencies into histograms" % (measure_fold(calls) * 1e6)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+# Copyright (c) 2014 Stefan C. Mueller
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Benchmark suite for throughput and latency on a single host.
+
+Run with::
+
+    python benchmarks/bench_suite.py --json before.json
+    python benchmarks/bench_suite.py --json after.json --compare before.json
+
+Covers :class:`anycall.bytequeue.ByteQueue` operations, encoding and
+decoding of packets with :class:`anycall.packetprotocol.PacketProtocol`
+as they arrive in fragments of varying size, and calls with
+:class:`anycall.RPCSystem` over loopback TCP to a server in a separate
+process, for several payload sizes and numbers of concurrent calls.
+
+`--json` writes the results for later comparison. `--compare` reports
+the change of each metric relative to an earlier run and exits with
+status 1 if any got worse by more than `--threshold`.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from twisted.internet import defer, reactor
+
+import anycall
+from anycall import bytequeue, packetprotocol
+
+GROUPS = ("bytequeue", "framing", "rpc")
+
+#: Metrics where a larger value is better. For all others smaller is better.
+HIGHER_IS_BETTER = ("ops_per_s", "mb_per_s", "calls_per_s")
+
+PAYLOAD_SIZES = (64, 4096, 65536)
+FRAGMENT_SIZES = (7, 1460, 65536)
+CONCURRENCIES = (1, 16, 64)
+
+#: Bytes of the header of each packet.
+HEADER_SIZE = 8
+
+
+def echo(data):
+    return data
+
+
+def repeat(batch, duration):
+    """
+    Calls `batch` until `duration` seconds have passed.
+
+    :returns: `(batches, seconds)`.
+    """
+    batches = 0
+    start = time.time()
+    while True:
+        batch()
+        batches += 1
+        elapsed = time.time() - start
+        if elapsed >= duration:
+            return batches, elapsed
+
+
+def bench_bytequeue(args):
+    results = {}
+    packet = 4096
+    for chunk in (16, 1460, 65536):
+        data = "x" * chunk
+        chunks = max(1, 2 ** 20 // chunk)
+        packets = chunks * chunk // packet
+
+        def batch():
+            # Chunks as they arrive from the network, consumed in packets
+            # of another size the way the packet protocol does.
+            queue = bytequeue.ByteQueue()
+            for _ in xrange(chunks):
+                queue.enqueue(data)
+            for _ in xrange(packets):
+                queue.peek(HEADER_SIZE)
+                queue.drop(HEADER_SIZE)
+                queue.dequeue(packet - HEADER_SIZE)
+
+        batches, elapsed = repeat(batch, args.duration)
+        results["bytequeue/chunk_%d" % chunk] = {
+            "ops_per_s": batches * (chunks + 3 * packets) / elapsed,
+            "mb_per_s": batches * chunks * chunk / elapsed / 1e6}
+    return results
+
+
+class _NullTransport(object):
+
+    def writeSequence(self, data):
+        pass
+
+
+class _CountingProtocol(packetprotocol.PacketProtocol):
+
+    def __init__(self):
+        packetprotocol.PacketProtocol.__init__(self)
+        self.register_type("bench")
+        self.received = 0
+
+    def packet_received(self, typename, packet):
+        self.received += 1
+
+
+def bench_framing(args):
+    results = {}
+    for size in PAYLOAD_SIZES:
+        payload = "x" * size
+        packets = max(16, 2 ** 20 // (size + HEADER_SIZE))
+
+        sender = _CountingProtocol()
+        sender.transport = _NullTransport()
+
+        def encode():
+            for _ in xrange(packets):
+                sender.send_packet("bench", payload)
+
+        batches, elapsed = repeat(encode, args.duration)
+        results["framing/encode_%d" % size] = {
+            "ops_per_s": batches * packets / elapsed,
+            "mb_per_s": batches * packets * size / elapsed / 1e6}
+
+        header = sender._header.pack(size, packetprotocol.typehash("bench"))
+        stream = (header + payload) * packets
+        for fragment in FRAGMENT_SIZES:
+            fragments = [stream[i:i + fragment] for i in xrange(0, len(stream), fragment)]
+            receiver = _CountingProtocol()
+            receiver.connectionMade()
+
+            def decode():
+                for data in fragments:
+                    receiver.dataReceived(data)
+
+            batches, elapsed = repeat(decode, args.duration)
+            assert receiver.received == batches * packets
+            results["framing/decode_%d_fragment_%d" % (size, fragment)] = {
+                "ops_per_s": batches * packets / elapsed,
+                "mb_per_s": batches * packets * size / elapsed / 1e6}
+    return results
+
+
+def server():
+    rpcsystem = anycall.create_tcp_rpc_system()
+
+    def started(_):
+        sys.stdout.write(rpcsystem.get_function_url(echo) + "\n")
+        sys.stdout.flush()
+
+    rpcsystem.open().addCallback(started)
+    reactor.run()
+
+
+def wire_bytes(rpcsystem):
+    """
+    Bytes sent and received including packet headers.
+    """
+    total = 0
+    for stats in rpcsystem.peer_stats().itervalues():
+        total += stats["bytes_sent"] + stats["bytes_received"]
+        total += HEADER_SIZE * (stats["packets_sent"] + stats["packets_received"])
+    return total
+
+
+def percentile(latencies, q):
+    return 1000.0 * latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+@defer.inlineCallbacks
+def bench_rpc_calls(rpcsystem, stub, size, concurrency, duration):
+    data = "x" * size
+    latencies = []
+
+    @defer.inlineCallbacks
+    def caller(deadline):
+        while time.time() < deadline:
+            start = time.time()
+            yield stub(data)
+            latencies.append(time.time() - start)
+
+    # Warm up the connection and the buffers.
+    yield defer.gatherResults([caller(time.time() + 0.1) for _ in range(concurrency)])
+    del latencies[:]
+
+    bytes_before = wire_bytes(rpcsystem)
+    start = time.time()
+    yield defer.gatherResults([caller(start + duration) for _ in range(concurrency)])
+    elapsed = time.time() - start
+    calls = len(latencies)
+
+    latencies.sort()
+    defer.returnValue({"calls_per_s": calls / elapsed,
+                       "p50_ms": percentile(latencies, 0.5),
+                       "p99_ms": percentile(latencies, 0.99),
+                       "p999_ms": percentile(latencies, 0.999),
+                       "bytes_per_call": (wire_bytes(rpcsystem) - bytes_before) / float(calls)})
+
+
+def bench_rpc(args):
+    process = subprocess.Popen([sys.executable, __file__, "--server"], stdout=subprocess.PIPE)
+    url = process.stdout.readline().strip()
+    results = {}
+
+    @defer.inlineCallbacks
+    def run():
+        rpcsystem = anycall.create_tcp_rpc_system()
+        yield rpcsystem.open()
+        stub = rpcsystem.create_function_stub(url)
+        try:
+            for size in PAYLOAD_SIZES:
+                for concurrency in CONCURRENCIES:
+                    name = "rpc/payload_%d_concurrency_%d" % (size, concurrency)
+                    results[name] = yield bench_rpc_calls(rpcsystem, stub, size, concurrency,
+                                                          args.duration)
+        finally:
+            yield rpcsystem.close()
+
+    def done(result):
+        reactor.stop()
+        return result
+
+    try:
+        reactor.callWhenRunning(lambda: run().addBoth(done))
+        reactor.run()
+    finally:
+        process.terminate()
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints the change of each metric relative to the baseline.
+
+    :returns: Names of the metrics that got worse by more than `threshold`.
+    """
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        for metric, value in sorted(results[name].iteritems()):
+            old = baseline[name].get(metric, None)
+            if not old or value is None:
+                continue
+            change = (value - old) / float(old)
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            flag = ""
+            if worse > threshold:
+                flag = "  REGRESSION"
+                regressions.append("%s %s" % (name, metric))
+            print "%-44s %-14s %12.4g -> %12.4g %+7.1f%%%s" % (name, metric, old, value,
+                                                             100 * change, flag)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--only", choices=GROUPS, action="append",
+                        help="Run only this group of benchmarks. Can be given more than once.")
+    parser.add_argument("--duration", type=float, default=1.0, help="Seconds per benchmark.")
+    parser.add_argument("--json", metavar="PATH", help="Write the results to this file.")
+    parser.add_argument("--compare", metavar="PATH", help="Results of an earlier run to compare with.")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Relative change of a metric reported as regression.")
+    parser.add_argument("--server", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.server:
+        return server()
+
+    benchmarks = {"bytequeue": bench_bytequeue, "framing": bench_framing, "rpc": bench_rpc}
+    results = {}
+    for group in args.only or GROUPS:
+        results.update(benchmarks[group](args))
+
+    for name in sorted(results):
+        print "%-44s %s" % (name, "  ".join("%s %.4g" % item for item in sorted(results[name].iteritems())))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"python": platform.python_version(),
+                       "platform": platform.platform(),
+                       "time": time.time(),
+                       "duration": args.duration,
+                       "results": results}, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        print
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print "\n%d metrics got worse by more than %.0f%%." % (len(regressions), 100 * args.threshold)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -38,6 +38,5 @@ setup(name='anycall',
       packages=['anycall'],
       install_requires = ['twisted>=15.0.0', 
                           'utwist>=0.1.3', 
-                          'bidict>=0.3.1', 
                           'twistit>=0.2.1'],
      )